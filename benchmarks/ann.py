@@ -0,0 +1,48 @@
+"""Search time and recall of `treemodel.ann.PlaylistIndex` against an exact scan of the same playlist embeddings.
+
+Embeddings are drawn around a few hundred centres in a 6 dimensional PCA-like space and added one at a time, the way
+pushes add them. Recall@k is the share of the exact k nearest playlists that the index also returns.
+
+    python -m benchmarks.ann [num_playlists] [num_queries] [k]
+"""
+import numpy as np
+import time
+import sys
+
+from treemodel.ann import PlaylistIndex
+
+
+def exact(vectors, query, k):
+    distances = ((vectors - query) ** 2).sum(axis=1)
+    return set(np.argsort(distances, kind='stable')[:k].tolist())
+
+
+def main(num_playlists=100000, num_queries=500, k=10):
+    rng = np.random.default_rng(0)
+    centres = rng.normal(0, 2, (300, 6))
+    vectors = (centres[rng.integers(len(centres), size=num_playlists)] + rng.normal(0, 0.5, (num_playlists, 6))).astype(np.float32)
+    queries = vectors[rng.integers(num_playlists, size=num_queries)] + rng.normal(0, 0.1, (num_queries, 6)).astype(np.float32)
+
+    print(f'{num_playlists} playlists, {num_queries} queries, k={k}')
+    print(f'{"nprobe":>8}{"build s":>10}{"search us":>12}{"exact us":>10}{"recall@k":>10}')
+    for nprobe in (1, 4, 8, 16):
+        index = PlaylistIndex(nprobe=nprobe)
+        start = time.perf_counter()
+        for i, v in enumerate(vectors):
+            index.add(v, i)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = [index.search(q, k) for q in queries]
+        search_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        truth = [exact(vectors, q, k) for q in queries]
+        exact_time = time.perf_counter() - start
+
+        recall = np.mean([len(t & {label for label, _ in f}) / k for t, f in zip(truth, found)])
+        print(f'{nprobe:8}{build_time:10.2f}{1e6 * search_time / num_queries:12.1f}{1e6 * exact_time / num_queries:10.1f}{recall:10.3f}')
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,75 @@
+"""Per-node predict time of sklearn classifiers against their compiled kernels (`treemodel.kernels`), and whole tree routing.
+
+Every model is fitted the way `Tree.push` fits a split, on two synthetic playlists, and asked to predict playlists of
+40 tracks. The predictions of kernel and `predict` are checked for equality on every call, float64 and float32 input.
+
+    python -m benchmarks.kernels [num_playlists] [calls]
+"""
+import numpy as np
+import time
+import sys
+
+from sklearn.naive_bayes import GaussianNB
+from sklearn.linear_model import LogisticRegression
+from sklearn.svm import LinearSVC, SVC
+
+from treemodel.tree import Tree
+from treemodel.kernels import compile_classifier
+from benchmarks.trials import synthetic_playlists
+
+MODELS = {
+    'GaussianNB': (GaussianNB, {}),
+    'LogisticRegression': (LogisticRegression, {}),
+    'LinearSVC': (LinearSVC, {}),
+    'SVC': (SVC, {}),
+}
+
+
+def time_calls(fn, inputs):
+    start = time.perf_counter()
+    for X in inputs:
+        fn(X)
+    return (time.perf_counter() - start) / len(inputs)
+
+
+def main(num_playlists=300, calls=2000):
+    playlists = synthetic_playlists(num_playlists + 2, seed=1)
+    rng = np.random.default_rng(0)
+    inputs = [rng.normal(0, 2, (40, playlists[0].shape[1])) for _ in range(calls)]
+
+    print(f'{"model":20}{"predict us":>12}{"kernel us":>12}{"speedup":>9}  identical')
+    for name, (model, model_args) in MODELS.items():
+        X = np.concatenate(playlists[:2])
+        y = np.concatenate((np.zeros(len(playlists[0])), np.ones(len(playlists[1]))))
+        classifier = model(**model_args).fit(X, y)
+        kernel = compile_classifier(classifier)
+        if kernel is None:
+            print(f'{name:20}{1e6 * time_calls(classifier.predict, inputs):12.1f}{"-":>12}{"-":>9}  no kernel, predict is used')
+            continue
+
+        identical = all(np.array_equal(classifier.predict(X), kernel.predict(X)) and
+                        np.array_equal(classifier.predict(X.astype(np.float32)), kernel.predict(X.astype(np.float32)))
+                        for X in inputs)
+        slow = time_calls(classifier.predict, inputs)
+        fast = time_calls(kernel.predict, inputs)
+        print(f'{name:20}{1e6 * slow:12.1f}{1e6 * fast:12.1f}{slow / fast:9.1f}  {identical}')
+
+    print()
+    print(f'GaussianNB tree of {num_playlists} playlists, routing every playlist')
+    tree = Tree(GaussianNB)
+    np.random.seed(0)
+    for i, data in enumerate(playlists[:num_playlists]):
+        tree.push(data, f'p{i}')
+    start = time.perf_counter()
+    plain = [tree.route(d) for d in playlists]
+    plain_time = time.perf_counter() - start
+    tree.use_kernels()
+    start = time.perf_counter()
+    compiled = [tree.route(d) for d in playlists]
+    compiled_time = time.perf_counter() - start
+    print(f'predict {1e6 * plain_time / len(playlists):.0f} us, kernels {1e6 * compiled_time / len(playlists):.0f} us per route '
+          f'(first use compiles), same leaves: {plain == compiled}')
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
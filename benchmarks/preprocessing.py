@@ -0,0 +1,41 @@
+"""Preprocessing of one playlist: the pandas path (`process_features` + `pca.transform`) against the fused `Preprocessor`.
+
+Features come from the made up data of the fake spotify server, the PCA is fitted on them the same way as in the EDA notebook.
+
+    python -m benchmarks.preprocessing [tracks_per_playlist] [batch_size]
+"""
+import numpy as np
+import timeit
+import sys
+
+from sklearn.decomposition import PCA
+
+from spotifyapi.fake_server import fake_features
+from server.processing import process_features, decode_features, Preprocessor
+
+
+def main(tracks=100, batch_size=50, repeat=20):
+    track_ids = [f'track{i}' for i in range(tracks * batch_size)]
+    features = [(t, fake_features(t)) for t in track_ids]
+    playlists = [features[i * tracks:(i + 1) * tracks] for i in range(batch_size)]
+
+    pca = PCA(n_components=6).fit(process_features(features))
+    preprocessor = Preprocessor(pca)
+
+    old = [pca.transform(process_features(p)) for p in playlists]
+    new = [preprocessor.transform(decode_features(p)) for p in playlists]
+    batch = preprocessor.transform_batch([decode_features(p) for p in playlists])
+    error = max(max(np.abs(a - b).max(), np.abs(a - c).max()) for a, b, c in zip(old, new, batch))
+
+    t_old = min(timeit.repeat(lambda: [pca.transform(process_features(p)) for p in playlists], number=1, repeat=repeat))
+    t_new = min(timeit.repeat(lambda: [preprocessor.transform(decode_features(p)) for p in playlists], number=1, repeat=repeat))
+    t_batch = min(timeit.repeat(lambda: preprocessor.transform_batch([decode_features(p) for p in playlists]), number=1, repeat=repeat))
+
+    print(f'{batch_size} playlists x {tracks} tracks, max abs difference to pandas path {error:.2e}')
+    print(f'pandas + pca.transform   {1e3 * t_old / batch_size:8.3f} ms/playlist')
+    print(f'fused, one at a time     {1e3 * t_new / batch_size:8.3f} ms/playlist')
+    print(f'fused, whole batch       {1e3 * t_batch / batch_size:8.3f} ms/playlist')
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,140 @@
+"""Query throughput of read only query workers (`server/workers.py`) against the number of workers.
+
+A GaussianNB tree of synthetic playlists is saved as a snapshot, then 1, 2, 4, ... workers follow it and answer
+`/query/?i=<n>` with the leaf of the n-th held out playlist, all accepting on one socket, while twice as many client
+processes send queries over keep-alive connections. A third of the way through every run the tree grows and a new
+snapshot is published, the clients report which snapshots answered them. Worker memory is read from /proc where there
+is one: PSS counts pages shared with other processes (the mapped leaves, shared libraries) in part, RSS in full.
+Throughput can only grow with the workers up to the number of cores.
+
+    python -m benchmarks.serving [num_playlists] [seconds] [max_workers]
+"""
+import multiprocessing
+import http.client
+import tempfile
+import logging
+import json
+import time
+import sys
+import os
+
+import numpy as np
+from flask import Flask, request
+from sklearn.naive_bayes import GaussianNB
+
+from treemodel.tree import Tree
+import treemodel.snapshot as tree_snapshot
+from server.workers import SnapshotFollower, listen, start_workers, serve
+from benchmarks.trials import synthetic_playlists
+
+NUM_QUERIES = 200
+
+app = Flask(__name__)
+queries = None
+follower = None
+
+
+@app.route('/query/')
+def query():
+    tree = follower.tree
+    return {'ret': tree.query(queries[request.args.get('i', type=int)])[0], 'snapshot': follower.name}
+
+
+def bench_worker(sock, path, port):
+    global queries, follower
+    logging.getLogger('werkzeug').setLevel(logging.ERROR) # no log line per request
+    queries = synthetic_playlists(NUM_QUERIES, seed=2)
+    follower = SnapshotFollower(path, interval=0.2, on_load=lambda tree: tree.use_kernels())
+    follower.poll()
+    follower.start()
+    serve(app, sock, '127.0.0.1', port)
+
+
+def bench_client(port, seconds, results):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    rng = np.random.default_rng(os.getpid())
+    count, snapshots = 0, set()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        conn.request('GET', f'/query/?i={rng.integers(NUM_QUERIES)}')
+        snapshots.add(json.loads(conn.getresponse().read())['snapshot'])
+        count += 1
+    conn.close()
+    results.put((count, snapshots))
+
+
+def memory_kb(pid):
+    try:
+        f = open(f'/proc/{pid}/smaps_rollup', 'r')
+        fields = dict(line.split()[:2] for line in f if line.split()[0] in ('Rss:', 'Pss:'))
+        f.close()
+    except OSError:
+        return None, None
+    return int(fields['Rss:']), int(fields['Pss:'])
+
+
+def wait_ready(port, timeout=60.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/query/?i=0')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError('query workers did not come up')
+
+
+def main(num_playlists=2000, seconds=10, max_workers=4):
+    context = multiprocessing.get_context('spawn')
+    path = tempfile.mkdtemp(prefix='serving-')
+    playlists = synthetic_playlists(num_playlists + 100, seed=1)
+
+    tree = Tree(GaussianNB)
+    np.random.seed(0)
+    for i, data in enumerate(playlists[:num_playlists]):
+        tree.push(data, f'p{i}')
+    tree_snapshot.save(tree, path)
+    leaf_mb = sum(l.nbytes for l in tree.leaves) / 2**20
+    print(f'{num_playlists} playlists, {leaf_mb:.1f} MB of leaves, {os.cpu_count()} cores')
+
+    print(f'{"workers":>8}{"clients":>8}{"queries/s":>11}{"speedup":>9}{"snapshots":>11}{"RSS MB":>9}{"PSS MB":>9}')
+    single = None
+    num_workers = 1
+    while num_workers <= max_workers:
+        sock = listen('127.0.0.1', 0)
+        port = sock.getsockname()[1]
+        workers = start_workers(bench_worker, num_workers, (sock, path, port))
+        wait_ready(port)
+
+        results = context.Queue()
+        clients = [context.Process(target=bench_client, args=(port, seconds, results)) for _ in range(2 * num_workers)]
+        for client in clients:
+            client.start()
+
+        # publish a bigger tree a third of the way through, growing it takes a while with every core busy
+        time.sleep(seconds / 3)
+        for i in range(num_playlists, num_playlists + 10):
+            tree.push(playlists[i], f'p{i}')
+        tree_snapshot.save(tree, path)
+
+        counts, seen = zip(*[results.get() for _ in clients])
+        for client in clients:
+            client.join()
+        rss, pss = zip(*[memory_kb(w.pid) for w in workers])
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        sock.close()
+
+        throughput = sum(counts) / seconds
+        single = single or throughput
+        memory = (f'{sum(rss) / len(rss) / 1024:9.1f}{sum(pss) / len(pss) / 1024:9.1f}' if rss[0] is not None else f'{"-":>9}{"-":>9}')
+        print(f'{num_workers:8}{len(clients):8}{throughput:11.0f}{throughput / single:9.2f}{len(set().union(*seen)):11}{memory}')
+        num_workers *= 2
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
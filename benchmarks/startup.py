@@ -0,0 +1,131 @@
+"""Cold start of `server.server`: time until the port answers `/healthz`, until `/readyz` says ready, and each phase.
+
+A GaussianNB tree of synthetic playlists is saved as a snapshot next to a PCA model, a config and placeholder spotify
+client credentials in a temporary directory, then a server is started there `runs` times with `"authorize": false`.
+Every run reports the seconds from spawning the process until `/healthz` first answers (the port is up) and until
+`/readyz` turns 200, and the phases the server timed itself (`server/startup.py`): `import` of the server module,
+then `auth`, `feature_cache`, `playlist_store`, `pca` (unpickling the model, which is where sklearn gets imported),
+`tree` (restoring the snapshot) and `services`. The times of importing the server module and of the pandas and sklearn
+modules it now leaves until first use are measured in fresh interpreters for comparison.
+
+    python -m benchmarks.startup [num_playlists] [runs]
+"""
+import http.client
+import subprocess
+import tempfile
+import pickle
+import socket
+import json
+import time
+import sys
+import os
+
+import numpy as np
+from sklearn.decomposition import PCA
+from sklearn.naive_bayes import GaussianNB
+
+from treemodel.tree import Tree
+import treemodel.snapshot as tree_snapshot
+from spotifyapi.cache import FEATURE_COLUMNS
+from benchmarks.trials import synthetic_playlists
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def get(port, path):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        conn.request('GET', path)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def setup(path, num_playlists):
+    playlists = synthetic_playlists(num_playlists, seed=1)
+    tree = Tree(GaussianNB)
+    np.random.seed(0)
+    for i, data in enumerate(playlists):
+        tree.push(data, f'p{i}')
+    tree_snapshot.save(tree, os.path.join(path, 'snapshots'))
+
+    pca = PCA(n_components=6).fit(np.random.default_rng(0).normal(size=(2000, len(FEATURE_COLUMNS))))
+    f = open(os.path.join(path, 'pca_reduce.pkl'), 'wb')
+    pickle.dump(pca, f)
+    f.close()
+
+    f = open(os.path.join(path, 'tokens.jsonc'), 'w')
+    json.dump({'client_id': 'benchmark', 'client_secret': 'benchmark'}, f)
+    f.close()
+
+
+def start_once(path, port, timeout=120.0):
+    config = {'server': {'url': '127.0.0.1', 'port': port, 'callback': '/callback/', 'authorize': False,
+                         'snapshot_dir': 'snapshots', 'rebalance_interval': 0}}
+    f = open(os.path.join(path, 'conf.json'), 'w')
+    json.dump(config, f)
+    f.close()
+
+    env = dict(os.environ, PYTHONPATH=REPO)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'server.server'], cwd=path, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    live = ready = None
+    try:
+        while ready is None:
+            if time.perf_counter() - start > timeout or process.poll() is not None:
+                raise RuntimeError('server did not become ready')
+            try:
+                if live is None and get(port, '/healthz')[0] == 200:
+                    live = time.perf_counter() - start
+                if live is not None:
+                    status, body = get(port, '/readyz')
+                    if status == 200:
+                        ready = time.perf_counter() - start
+                        phases = json.loads(body)['ret']['phases']
+            except OSError:
+                pass
+            time.sleep(0.005)
+    finally:
+        try:
+            get(port, '/kill/')
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return live, ready, {p['name']: p['seconds'] for p in phases}
+
+
+def import_seconds(modules):
+    code = f'import time; t = time.perf_counter(); import {modules}; print(time.perf_counter() - t)'
+    return float(subprocess.check_output([sys.executable, '-c', code], cwd=REPO, env=dict(os.environ, PYTHONPATH=REPO)))
+
+
+def main(num_playlists=2000, runs=3):
+    path = tempfile.mkdtemp(prefix='startup-')
+    setup(path, num_playlists)
+    print(f'{num_playlists} playlists in the snapshot, {runs} runs, {os.cpu_count()} cores')
+
+    results = [start_once(path, free_port()) for _ in range(runs)]
+    names = list(results[0][2])
+    print(f'{"run":>4}{"live s":>9}{"ready s":>9}' + ''.join(f'{n:>16}' for n in names))
+    for i, (live, ready, phases) in enumerate(results):
+        print(f'{i:4}{live:9.3f}{ready:9.3f}' + ''.join(f'{phases.get(n, 0.0):16.3f}' for n in names))
+
+    print(f'import server.server:              {min(import_seconds("server.server") for _ in range(runs)):.3f} s')
+    print(f'import pandas, sklearn (deferred): {min(import_seconds("pandas, sklearn.preprocessing") for _ in range(runs)):.3f} s')
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
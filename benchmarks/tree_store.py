@@ -0,0 +1,171 @@
+"""Memory and traversal time of the array backed `treemodel.tree.Tree` against the old linked TreeNode tree.
+
+Both trees are built from the same synthetic playlists with a trivial threshold classifier, so the numbers are
+dominated by the tree representation and not by sklearn.
+
+    python -m benchmarks.tree_store [num_playlists]
+"""
+import numpy as np
+import tracemalloc
+import time
+import sys
+
+from treemodel.tree import Tree, NO_NODE
+
+
+class ThresholdModel():
+    __slots__ = ("threshold", "flip")
+
+    # cheapest possible node model, splits on the first feature half way between the two classes
+    def fit(self, X, y):
+        self.threshold = (X[y == 0, 0].mean() + X[y == 1, 0].mean()) / 2
+        self.flip = X[y == 0, 0].mean() > self.threshold
+        return self
+
+    def predict(self, X):
+        return (X[:, 0] > self.threshold) != self.flip
+
+
+class TreeNode():
+    def __init__(self, elem, label):
+        self.elem = elem
+        self.label = label
+        self.left = None
+        self.right = None
+        self.parent = None
+
+    def is_leaf(self):
+        return self.left is None and self.right is None
+
+
+class LinkedTree():
+    """The tree as it was before the array layout, one TreeNode object per node."""
+    def __init__(self, node_model, **kwargs):
+        self.model = node_model
+        self.model_args = kwargs
+        self.head = None
+
+    def push(self, data, label, ret=False):
+        if self.head is None:
+            self.head = TreeNode(elem=data, label=label)
+            return None
+
+        current = self.head
+        parent_branch = -1
+        while not current.is_leaf():
+            branch = np.average(current.elem.predict(data))
+            if branch < 0.5:
+                current = current.left
+                parent_branch = 0
+            else:
+                current = current.right
+                parent_branch = 1
+
+        new_classifier = self.model(**self.model_args)
+        small, sample = ((current.elem , 'l'), (data, 'r')) if current.elem.shape[0] < data.shape[0] else ((data, 'r'), (current.elem, 'l'))
+        N = small[0].shape[0]
+        sample = (sample[0][np.random.choice(a=sample[0].shape[0], size=N, replace=False), :], sample[1]) if N != sample[0].shape[0] else sample
+        x_concat = (small[0], sample[0]) if small[1] == 'l' else (sample[0], small[0])
+        new_classifier.fit(np.concatenate(x_concat), np.concatenate((np.zeros(N), np.ones(N))))
+
+        classifier_node = TreeNode(elem=new_classifier, label=None)
+        new_playlist_node = TreeNode(elem=data, label=label)
+        classifier_node.left = current
+        classifier_node.right = new_playlist_node
+        if parent_branch == 0:
+            current.parent.left = classifier_node
+            classifier_node.parent = current.parent
+        elif parent_branch == 1:
+            current.parent.right = classifier_node
+            classifier_node.parent = current.parent
+        else:
+            self.head = classifier_node
+        current.parent = classifier_node
+        new_playlist_node.parent = classifier_node
+
+        return current.label if ret else None
+
+
+def walk_linked(tree):
+    n = 0
+    stack = [tree.head]
+    while stack:
+        node = stack.pop()
+        n += 1
+        if not node.is_leaf():
+            stack.append(node.left)
+            stack.append(node.right)
+    return n
+
+
+def walk_array(tree):
+    n = 0
+    left, right = tree.left, tree.right
+    stack = [tree.head]
+    while stack:
+        node = stack.pop()
+        n += 1
+        if left[node] != NO_NODE:
+            stack.append(left[node])
+            stack.append(right[node])
+    return n
+
+
+def descend_linked(tree, data):
+    current = tree.head
+    while not current.is_leaf():
+        current = current.left if np.average(current.elem.predict(data)) < 0.5 else current.right
+    return current.label
+
+
+def descend_array(tree, data):
+    current = tree.head
+    left, right, slot, classifiers = tree.left, tree.right, tree.slot, tree.classifiers
+    while left[current] != NO_NODE:
+        current = left[current] if np.average(classifiers[slot[current]].predict(data)) < 0.5 else right[current]
+    return tree.labels[slot[current]]
+
+
+def build(tree_class, playlists):
+    np.random.seed(0)
+    tracemalloc.start()
+    start = time.perf_counter()
+    tree = tree_class(ThresholdModel)
+    for i, data in enumerate(playlists):
+        tree.push(data, f'p{i}')
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return tree, memory, elapsed
+
+
+def main(num_playlists=10000, num_queries=2000):
+    rng = np.random.default_rng(0)
+    playlists = [rng.normal(rng.normal(0, 3), 1, (rng.integers(10, 60), 8)) for _ in range(num_playlists)]
+    queries = [playlists[i] for i in rng.integers(0, num_playlists, num_queries)]
+    num_nodes = 2 * num_playlists - 1
+
+    linked, linked_memory, linked_build = build(LinkedTree, playlists)
+    array, array_memory, array_build = build(Tree, playlists)
+
+    results = []
+    for name, tree, walk, descend in (('linked', linked, walk_linked, descend_linked), ('array', array, walk_array, descend_array)):
+        start = time.perf_counter()
+        walk(tree)
+        walk_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        labels = [descend(tree, q) for q in queries]
+        descend_time = time.perf_counter() - start
+        results.append((name, walk_time, descend_time, labels))
+
+    assert results[0][3] == results[1][3], 'linked and array trees disagree'
+
+    print(f'{num_playlists} playlists, {num_nodes} nodes, {num_queries} queries')
+    print(f'{"":8}{"bytes/node":>12}{"build s":>10}{"walk us/node":>14}{"descend us":>12}')
+    for (name, walk_time, descend_time, _), memory, build_time in zip(results, (linked_memory, array_memory), (linked_build, array_build)):
+        print(f'{name:8}{memory / num_nodes:12.1f}{build_time:10.3f}{1e6 * walk_time / num_nodes:14.3f}{1e6 * descend_time / num_queries:12.1f}')
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
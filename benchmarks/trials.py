@@ -0,0 +1,318 @@
+"""Offline reproduction of the trial_logs experiments, straight against `treemodel.tree.Tree`.
+
+No network or spotify credentials needed: playlists are synthetic (tracks drawn around one of a few "genre" centres in
+PCA space) or the leaf matrices of a saved tree snapshot (--data). For each classifier and dataset size the tree is
+built one push at a time and every push writes a row in the trial_logs schema:
+
+    ElapsedTime    - seconds for the whole push
+    Score          - accuracy of the new classifier on the two playlists it was fitted on
+    FitTime        - seconds spent in fit
+    AvgBranchTime  - mean seconds per predict on the way down
+    AvgConf        - mean |vote - 0.5| of those predicts
+    LeftBranches   - number of left turns on the way down
+    RightBranches  - number of right turns on the way down
+
+Afterwards held out playlists are queried and a summary row per run (latency percentiles, tree depth, memory) goes to
+summary.csv. `--compare` diffs a summary against a baseline such as benchmarks/baseline/summary.csv.
+
+    python -m benchmarks.trials --sizes 100 500 --compare benchmarks/baseline/summary.csv
+
+With --rebalance every push is followed by `Tree.rebalance`, runs show up as `<model>+rebalance` and their depth can be
+set against log2(Playlists). --sorted pushes the playlists in order of their first feature, the worst case for a tree
+that never rebalances.
+
+With --bulk the tree is built in one go by `Tree.bulk_load` instead of push by push, runs show up as `<model>+bulk`
+with no push rows, BuildTime is the whole bulk load and SelfRecall shows whether the fitted splits still route every
+playlist back to its own leaf.
+
+--leaves runs every model with each leaf policy from treemodel.leaves (full, reservoir:<size>, summary). LeafBytes is
+what the leaves keep, SelfRecall the share of built playlists (up to --queries of them) that a query sends back to their
+own leaf, so the two together show what a smaller leaf costs in routing quality.
+
+--fast-path T turns on centroid routing with margin threshold T (`Tree.use_fast_path`) for pushes and queries, FastShare
+is the share of branch decisions it made without the classifier.
+"""
+import numpy as np
+import pickle as pk
+import argparse
+import warnings
+import math
+import time
+import csv
+import os
+
+from sklearn.naive_bayes import GaussianNB
+from sklearn.svm import SVC
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.neural_network import MLPClassifier
+from sklearn.exceptions import ConvergenceWarning
+
+from treemodel.tree import Tree, NO_NODE
+from treemodel.leaves import parse_policy
+
+MODELS = {
+    'NaiveBayes': (GaussianNB, {}),
+    'SVM': (SVC, {}),
+    'RandomForest': (RandomForestClassifier, {'n_estimators': 10, 'random_state': 0}),
+    'NeuralNet': (MLPClassifier, {'max_iter': 300, 'random_state': 0}),
+}
+
+TRIAL_COLUMNS = ['ElapsedTime', 'Score', 'FitTime', 'AvgBranchTime', 'AvgConf', 'LeftBranches', 'RightBranches']
+SUMMARY_COLUMNS = ['Model', 'Playlists', 'BuildTime', 'PushP50', 'PushP90', 'PushP99', 'QueryP50', 'QueryP90', 'QueryP99',
+                   'MaxDepth', 'MeanDepth', 'TreeBytes', 'MeanScore', 'LeafBytes', 'SelfRecall', 'FastShare']
+# columns that only change when the tree itself changes, the rest are timings and depend on the machine
+EXACT_COLUMNS = ['MaxDepth', 'MeanDepth', 'TreeBytes', 'MeanScore', 'LeafBytes', 'SelfRecall', 'FastShare']
+
+
+class Recorder():
+    def __init__(self):
+        self.active = True
+        self.reset()
+
+    def reset(self):
+        self.fit_time = 0.0
+        self.score = 0.0
+        self.branch_times = []
+        self.confs = []
+        self.left = 0
+        self.right = 0
+
+
+def instrumented(model, recorder):
+    """Subclass of `model` that reports its fit and predict calls to `recorder`."""
+    class Instrumented(model):
+        def fit(self, X, y):
+            start = time.perf_counter()
+            super().fit(X, y)
+            recorder.fit_time = time.perf_counter() - start
+
+            active, recorder.active = recorder.active, False
+            recorder.score = self.score(X, y)
+            recorder.active = active
+            return self
+
+        def predict(self, X):
+            start = time.perf_counter()
+            votes = super().predict(X)
+            if recorder.active:
+                recorder.branch_times.append(time.perf_counter() - start)
+                branch = np.average(votes)
+                recorder.confs.append(abs(branch - 0.5))
+                if branch < 0.5:
+                    recorder.left += 1
+                else:
+                    recorder.right += 1
+            return votes
+
+    Instrumented.__name__ = model.__name__
+    return Instrumented
+
+
+def synthetic_playlists(n, dims=6, genres=12, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0, 2, (genres, dims))
+    playlists = []
+    for _ in range(n):
+        centre = centres[rng.integers(genres)] + rng.normal(0, 0.5, dims)
+        playlists.append(rng.normal(centre, 1, (int(rng.integers(10, 80)), dims)))
+    return playlists
+
+
+def snapshot_playlists(path):
+    import treemodel.snapshot as tree_snapshot
+    tree = tree_snapshot.load(path, mmap=False)
+    if tree is None:
+        raise ValueError(f'No snapshot in {path}')
+    return [np.asarray(l) for l in tree.leaves]
+
+
+def leaf_depths(tree):
+    depths = []
+    if tree.head == NO_NODE:
+        return depths
+    stack = [(tree.head, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if tree.left[node] == NO_NODE:
+            depths.append(depth)
+        else:
+            stack.append((tree.left[node], depth + 1))
+            stack.append((tree.right[node], depth + 1))
+    return depths
+
+
+def tree_bytes(tree):
+    """Deterministic size of the tree: node arrays, leaf matrices, the pickled state of the classifiers and their side summaries."""
+    nodes = sum(a.itemsize * len(a) for a in (tree.left, tree.right, tree.parent, tree.slot, tree.leaf_count))
+    leaves = sum(np.asarray(l).nbytes for l in tree.leaves)
+    classifiers = sum(len(pk.dumps(vars(c))) for c in tree.classifiers if c is not None)
+    sides = sum(s.nbytes for s in tree.sides if s is not None)
+    return nodes + leaves + classifiers + sides
+
+
+def percentiles(samples):
+    if not samples:
+        return [0.0, 0.0, 0.0]
+    return list(np.percentile(samples, [50, 90, 99]))
+
+
+def self_recall(tree, playlists, limit):
+    # share of (up to `limit` evenly spread) built playlists whose query lands on their own leaf
+    step = max(1, len(playlists) // limit)
+    checked = range(0, len(playlists), step)
+    hits = sum(tree.query(playlists[i]) == [f'p{i}'] for i in checked)
+    return hits / len(checked)
+
+
+def run_trial(name, playlists, queries, seed=0, rebalance=False, leaves='full', fast_path=None, bulk=False):
+    """Builds a tree from `playlists` with the classifier `name` and queries it.
+
+    With `rebalance` unbalanced subtrees are rebuilt after every push, as part of its time. With `bulk` the tree is
+    built by `Tree.bulk_load` instead of pushes. `leaves` is the leaf policy, `fast_path` the centroid routing threshold.
+
+    Returns:
+        tuple: (list of trial rows, summary row)
+    """
+    model, model_args = MODELS[name]
+    recorder = Recorder()
+    tree = Tree(instrumented(model, recorder), **model_args)
+    tree.use_leaf_policy(parse_policy(leaves, seed))
+    tree.use_fast_path(fast_path)
+
+    np.random.seed(seed)
+    rows = []
+    push_times = []
+    build_start = time.perf_counter()
+    if bulk:
+        recorder.active = False
+        tree.bulk_load(playlists, [f'p{i}' for i in range(len(playlists))], seed=seed)
+    for i, data in enumerate([] if bulk else playlists):
+        recorder.reset()
+        start = time.perf_counter()
+        tree.push(data, f'p{i}')
+        if rebalance:
+            recorder.active = False
+            tree.rebalance(seed=seed)
+            recorder.active = True
+        elapsed = time.perf_counter() - start
+        push_times.append(elapsed)
+
+        rows.append([elapsed, recorder.score, recorder.fit_time,
+                     float(np.mean(recorder.branch_times)) if recorder.branch_times else 0,
+                     float(np.mean(recorder.confs)) if recorder.confs else 0,
+                     recorder.left, recorder.right])
+    build_time = time.perf_counter() - build_start
+
+    recorder.active = False
+    query_times = []
+    for data in queries:
+        start = time.perf_counter()
+        tree.query(data)
+        query_times.append(time.perf_counter() - start)
+
+    tree.reclaim(0)
+    depths = leaf_depths(tree)
+    scores = [r[1] for r in rows[1:]] # the first push only makes a leaf
+    name += ('+bulk' if bulk else '') + ('+rebalance' if rebalance else '') + \
+            ('' if leaves == 'full' else '+' + leaves.replace(':', '')) + ('' if fast_path is None else f'+fast{fast_path:g}')
+    routes = tree.fast_routes + tree.slow_routes
+    summary = [name, len(playlists), build_time] + percentiles(push_times) + percentiles(query_times) + \
+              [max(depths), float(np.mean(depths)), tree_bytes(tree), float(np.mean(scores)) if scores else 0.0,
+               sum(np.asarray(l).nbytes for l in tree.leaves), self_recall(tree, playlists, len(queries)),
+               tree.fast_routes / routes if routes else 0.0]
+    return rows, summary
+
+
+def write_csv(path, columns, rows):
+    f = open(path, 'w', newline='')
+    f.write(', '.join(columns) + '\n')
+    for row in rows:
+        f.write(', '.join(str(v) for v in row) + '\n')
+    f.close()
+
+
+def read_summary(path):
+    f = open(path, 'r', newline='')
+    rows = list(csv.DictReader(f, skipinitialspace=True))
+    f.close()
+    return {(r['Model'], int(r['Playlists'])): r for r in rows}
+
+
+def compare(baseline_path, summary_path, tolerance=0.25):
+    """Prints every summary value that moved by more than `tolerance` (relative) from the baseline, and any change at all in the exact columns.
+
+    Returns:
+        int: Number of regressions found.
+    """
+    baseline = read_summary(baseline_path)
+    current = read_summary(summary_path)
+    regressions = 0
+    for key, row in current.items():
+        if key not in baseline:
+            print(f'{key[0]} x {key[1]}: not in baseline')
+            continue
+        for column in SUMMARY_COLUMNS[2:]:
+            if column not in baseline[key]:
+                continue
+            old, new = float(baseline[key][column]), float(row[column])
+            change = (new - old) / old if old else (0.0 if new == old else float('inf'))
+            exact = column in EXACT_COLUMNS
+            if (exact and abs(change) > 1e-9) or (not exact and change > tolerance):
+                regressions += 1
+                print(f'{key[0]} x {key[1]}: {column} {old:.6g} -> {new:.6g} ({100 * change:+.1f}%)')
+    if regressions == 0:
+        print('No differences from baseline.')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline tree benchmarks in the trial_logs format.')
+    parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100, 500])
+    parser.add_argument('--queries', type=int, default=200, help='held out playlists queried after each build')
+    parser.add_argument('--data', help='snapshot directory to take playlists from instead of synthetic ones')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rebalance', action='store_true', help='rebuild unbalanced subtrees after every push')
+    parser.add_argument('--bulk', action='store_true', help='build each tree with Tree.bulk_load instead of pushes')
+    parser.add_argument('--sorted', action='store_true', help='push playlists sorted by their first feature')
+    parser.add_argument('--fast-path', type=float, help='margin threshold for centroid routing, off by default')
+    parser.add_argument('--leaves', nargs='+', default=['full'], help='leaf policies: full, reservoir:<size>, summary')
+    parser.add_argument('--out', default='bench_results', help='directory for the trial csv files and summary.csv')
+    parser.add_argument('--compare', help='baseline summary.csv to diff against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown in a timing column reported by --compare')
+    args = parser.parse_args()
+
+    # the small two playlist fits often stop before converging, that is expected here
+    warnings.filterwarnings('ignore', category=ConvergenceWarning)
+
+    total = max(args.sizes) + args.queries
+    playlists = snapshot_playlists(args.data) if args.data else synthetic_playlists(total, seed=args.seed)
+    if len(playlists) < total:
+        raise ValueError(f'Need {total} playlists, only have {len(playlists)}')
+    queries = playlists[len(playlists) - args.queries:]
+
+    os.makedirs(args.out, exist_ok=True)
+    summaries = []
+    for name in args.models:
+        for size in args.sizes:
+            build = playlists[:size]
+            if args.sorted:
+                build = sorted(build, key=lambda d: float(np.mean(d[:, 0])))
+            for leaves in args.leaves:
+                rows, summary = run_trial(name, build, queries, seed=args.seed, rebalance=args.rebalance, leaves=leaves,
+                                          fast_path=args.fast_path, bulk=args.bulk)
+                write_csv(os.path.join(args.out, f'{summary[0]}_{size}.csv'), TRIAL_COLUMNS, rows)
+                summaries.append(summary)
+                print(', '.join(f'{c}={v:.4g}' if isinstance(v, float) else f'{c}={v}' for c, v in zip(SUMMARY_COLUMNS, summary)) +
+                      f', Log2={math.log2(size):.4g}')
+
+    summary_path = os.path.join(args.out, 'summary.csv')
+    write_csv(summary_path, SUMMARY_COLUMNS, summaries)
+
+    if args.compare:
+        return 1 if compare(args.compare, summary_path, args.tolerance) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,24 +1,64 @@
 import requests
 import json
 
+# one pooled session for the whole process so requests reuse the same connection
+session = requests.Session()
+_config = None
+
 def load_config(path='conf.json'):
     f = open(path)
     config = json.load(f)
     f.close()
     return config
 
+def client_config():
+    # only read conf.json once, it is not going to change under a running client
+    global _config
+    if _config is None:
+        _config = load_config()['client']
+    return _config
+
 def run(playlist_id, r_type):
-    config = load_config()['client']
-    
+    config = client_config()
+
     headers = {"Accept":"application/json", "Content-Type":"application/json"}
     params = {'playlist':playlist_id}
 
-    response = requests.get(f'http://{config["url"]}:{config["port"]}/{r_type}/', params=params, headers=headers)
-    
+    response = session.get(f'http://{config["url"]}:{config["port"]}/{r_type}/', params=params, headers=headers)
+
     if response.status_code == 200:
         if r_type == 'push':
             return True
-        elif r_type == 'recommend':
+        elif r_type in ('recommend', 'query'):
             return response.json()['ret']
     else:
-        return response.json()['ret']
\ No newline at end of file
+        return response.json()['ret']
+
+def run_batch(playlist_ids, batch_size=100):
+    """Streams playlist ID's to the server's bulk ingest endpoint.
+
+    The ID's are sent as a newline delimited stream over a single pooled connection, and the server answers with one json result per playlist as it works through them.
+
+    Args:
+        playlist_ids (iterable): Playlist ID's, can be a generator.
+        batch_size (int, optional): Number of playlists the server handles together. Defaults to 100.
+
+    Yields:
+        tuple: (playlist_id, success, ret) for every playlist pushed, where `ret` is the servers message on failure.
+    """
+    config = client_config()
+
+    headers = {"Accept":"application/x-ndjson", "Content-Type":"application/x-ndjson"}
+    params = {'batch_size':batch_size}
+    body = (f'{pid}\n'.encode() for pid in playlist_ids)
+
+    response = session.post(f'http://{config["url"]}:{config["port"]}/push_batch/', params=params, headers=headers, data=body, stream=True)
+
+    if response.status_code != 200:
+        raise RuntimeError(f'Bulk ingest failed with status {response.status_code}')
+
+    for line in response.iter_lines():
+        if not line:
+            continue
+        result = json.loads(line)
+        yield result['playlist'], result['status'] == 200, result['ret']
@@ -1,25 +1,49 @@
 from client import client
 import os
+import sys
 
-if __name__ == '__main__':
+from server.playlist_store import PlaylistStore
 
-    inp = 'D:\\spotify_data_dump\\integrated_data\\'
-    
+def playlist_ids(inp, break_num):
     N = 0
-    break_num = 10000
+
+    # a packed playlist store (see server/playlist_store.py) lists its playlists without touching the filesystem
+    if PlaylistStore.exists(inp):
+        for pid in PlaylistStore(inp).ids():
+            yield pid
+
+            if N >= break_num:
+                break
+            N += 1
+        return
 
     for filename in os.listdir(inp):
         if filename.endswith('.INDEX'):
-            pid = filename.split('.')[0]
-
-            rv = client.run(pid, 'push')            
-        if rv == True:
-            print(pid)
-        else:
-            print('ERROR ----- %s' % pid)
-
-        if N >= break_num:
-            break;
-        
-        N+=1
+            yield filename.split('.')[0]
+
+            if N >= break_num:
+                break
+            N += 1
+
+if __name__ == '__main__':
+
+    inp = 'D:\\spotify_data_dump\\integrated_data\\'
+
+    break_num = 10000
+
+    # `python main.py single` goes back to one push request per playlist
+    if len(sys.argv) > 1 and sys.argv[1] == 'single':
+        for pid in playlist_ids(inp, break_num):
+            rv = client.run(pid, 'push')
+            if rv == True:
+                print(pid)
+            else:
+                print('ERROR ----- %s' % pid)
+    else:
+        for pid, ok, ret in client.run_batch(playlist_ids(inp, break_num), batch_size=100):
+            if ok:
+                print(pid)
+            else:
+                print('ERROR ----- %s (%s)' % (pid, ret))
+
     print('Done...')
@@ -0,0 +1,140 @@
+"""Builds the recommendation tree from a whole dataset at once and saves it as a snapshot the server can start from.
+
+    python -m server.bulk_build --store <playlist store> --feature-cache <dir> --out snapshots/ --workers 4
+    python -m server.bulk_build --snapshot snapshots/ --out rebuilt/
+
+With --store every playlist of a packed PlaylistStore (see server/playlist_store.py) is read, its track features come
+from a FeatureCache and it goes through the same preprocessing and PCA as a push. Nothing is asked from spotify, tracks
+without cached features are left out and playlists without any are skipped. With --snapshot the leaves of an existing
+snapshot are rebuilt into a balanced tree with the same node model.
+
+Instead of one push per playlist the tree is built top down by `Tree.bulk_load`: the playlists are bisected into two
+groups by their centroids, one classifier is fitted per split and the playlists are moved to the side it routes them to,
+and with --workers the subtrees below the top splits are fitted in parallel processes. Point "snapshot_dir" in conf.json at --out to serve the result.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pickle as pk
+import argparse
+import math
+import time
+
+from spotifyapi.cache import FeatureCache
+from server.playlist_store import PlaylistStore
+from server.processing import Preprocessor
+from server.initialize import init_tree
+from treemodel.tree import Tree, NO_NODE
+from treemodel.balance import MAX_SPLIT_ROWS
+from treemodel.leaves import parse_policy
+import treemodel.snapshot as tree_snapshot
+
+
+def store_playlists(store_path, cache_path, pca_path='pca_reduce.pkl', limit=None, batch_size=1000):
+    """Reduced feature matrices of the playlists in a PlaylistStore, with features from a FeatureCache.
+
+    Returns:
+        tuple: (list of feature matrices, list of playlist ids)
+    """
+    store = PlaylistStore(store_path)
+    cache = FeatureCache(cache_path, hot_size=0)
+
+    f = open(pca_path, 'rb')
+    pca = pk.load(f)
+    f.close()
+    if not Preprocessor.supports(pca):
+        raise ValueError(f'{pca_path} is not a linear PCA, bulk builds need the fused preprocessor.')
+    preprocessor = Preprocessor(pca)
+
+    datas, labels = [], []
+    batch, batch_ids = [], []
+    skipped = 0
+    for playlist_id in store.ids():
+        if limit is not None and len(labels) + len(batch_ids) >= limit:
+            break
+        # float32 like decode_features, so the leaves match what a push of the same playlist would store
+        X = cache.feature_rows(store.track_ids(playlist_id)).astype(np.float32)
+        if X.shape[0] == 0:
+            skipped += 1
+            continue
+        batch.append(X)
+        batch_ids.append(playlist_id)
+
+        if len(batch) >= batch_size:
+            datas += preprocessor.transform_batch(batch)
+            labels += batch_ids
+            batch, batch_ids = [], []
+    datas += preprocessor.transform_batch(batch)
+    labels += batch_ids
+
+    cache.close()
+    if skipped:
+        print(f'Skipped {skipped} playlists without cached track features')
+    return datas, labels
+
+
+def snapshot_leaves(path):
+    """Node model, leaf matrices and labels of the latest snapshot in `path`."""
+    tree = tree_snapshot.load(path, mmap=True)
+    if tree is None:
+        raise ValueError(f'No snapshot in {path}')
+    leaves = tree.subtree_leaves(tree.head) if tree.head != NO_NODE else []
+    return tree, [tree.leaf_rows(l) for l in leaves], [tree.leaf_label(l) for l in leaves]
+
+
+def depth_stats(tree):
+    depths = []
+    stack = [(tree.head, 0)] if tree.head != NO_NODE else []
+    while stack:
+        node, depth = stack.pop()
+        if tree.is_leaf(node):
+            depths.append(depth)
+        else:
+            stack += [(tree.left[node], depth + 1), (tree.right[node], depth + 1)]
+    return (max(depths), float(np.mean(depths))) if depths else (0, 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk build of the recommendation tree into a snapshot directory.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--store', help='packed playlist store to read the playlists from')
+    source.add_argument('--snapshot', help='snapshot directory whose leaves are rebuilt')
+    parser.add_argument('--feature-cache', help='feature cache directory with the track features, needed with --store')
+    parser.add_argument('--pca', default='pca_reduce.pkl', help='fitted PCA, used with --store')
+    parser.add_argument('--leaves', help='leaf policy: full, reservoir:<size> or summary. Defaults to full, or the policy of --snapshot')
+    parser.add_argument('--out', required=True, help='snapshot directory to write the tree to')
+    parser.add_argument('--workers', type=int, default=1, help='processes fitting independent subtrees')
+    parser.add_argument('--limit', type=int, help='only take the first LIMIT playlists of the store')
+    parser.add_argument('--max-rows', type=int, default=MAX_SPLIT_ROWS, help='max training rows per side of a split')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.store:
+        if not args.feature_cache:
+            parser.error('--store needs --feature-cache')
+        datas, labels = store_playlists(args.store, args.feature_cache, args.pca, args.limit)
+        tree = init_tree()
+    else:
+        source_tree, datas, labels = snapshot_leaves(args.snapshot)
+        tree = Tree(source_tree.model, **source_tree.model_args)
+        tree.use_leaf_policy(source_tree.leaf_policy)
+    if args.leaves:
+        tree.use_leaf_policy(parse_policy(args.leaves))
+    print(f'Loaded {len(datas)} playlists in {time.perf_counter() - start:.1f}s')
+
+    start = time.perf_counter()
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    # a few subtrees per worker so one slow subtree doesn't hold up the rest
+    tree.bulk_load(datas, labels, seed=args.seed, max_rows=args.max_rows, executor=executor, tasks=4 * args.workers)
+    if executor is not None:
+        executor.shutdown()
+    max_depth, mean_depth = depth_stats(tree)
+    print(f'Built tree in {time.perf_counter() - start:.1f}s, depth max {max_depth} mean {mean_depth:.2f} '
+          f'(log2 of {len(datas)} playlists is {math.log2(max(len(datas), 1)):.2f})')
+
+    print(f'Saved snapshot {tree_snapshot.save(tree, args.out)}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,9 +1,10 @@
 from treemodel.tree import Tree
 
-from sklearn.naive_bayes import GaussianNB
-from sklearn.svm import SVC
-
 def init_tree():
+    # imported here rather than at the top, sklearn is slow to import and a server restoring a snapshot gets it from the pickled classifiers
+    from sklearn.naive_bayes import GaussianNB
+    from sklearn.svm import SVC
+
     # choose which classifier model to use for the tree
     # models from scikit-learn should work out of the box
     # 
@@ -0,0 +1,175 @@
+from collections import Counter
+from contextlib import contextmanager
+import threading
+import time
+import sys
+import os
+
+# seconds, from sub-millisecond predict calls up to slow spotify round-trips and fits
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values):
+    return ','.join(f'{n}="{v}"' for n, v in zip(names, values))
+
+
+class Histogram():
+    """Cumulative histogram per label set, rendered in the Prometheus text format.
+
+    Args:
+        name (str): Metric name.
+        help (str): One line description.
+        labelnames (tuple, optional): Label names, values are passed to `observe` in the same order.
+        buckets (tuple, optional): Upper bounds of the buckets in seconds.
+    """
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.series.items()):
+                base = _labels(self.labelnames, labels)
+                sep = ',' if base else ''
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append(f'{self.name}_bucket{{{base}{sep}le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{base}{sep}le="+Inf"}} {count}')
+                suffix = f'{{{base}}}' if base else ''
+                lines.append(f'{self.name}_sum{suffix} {total}')
+                lines.append(f'{self.name}_count{suffix} {count}')
+        return '\n'.join(lines)
+
+
+class Gauge():
+    """Value read from a callback when the metrics are rendered. `kind` is 'counter' for values that only ever go up."""
+    def __init__(self, name, help, fn, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.kind = kind
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return ''
+        if value is None:
+            return ''
+        return f'# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n{self.name} {value}'
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(r for r in (m.render() for m in self.metrics) if r) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.add(Histogram('playlist_stage_seconds', 'Seconds spent per stage of a push or recommendation.', ('stage',)))
+branch_seconds = registry.add(Histogram('tree_branch_seconds', 'Seconds per classifier node on the way down the tree, by depth.', ('depth',)))
+fit_seconds = registry.add(Histogram('tree_fit_seconds', 'Seconds per classifier fit.'))
+
+# depths past this share one label so a lopsided tree can't blow up the number of series
+MAX_DEPTH_LABEL = 32
+
+
+@contextmanager
+def timed(stage):
+    """Times the body of a `with` block into playlist_stage_seconds{stage=...}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage)
+
+
+def tree_observer(stage, seconds, depth=None):
+    """Observer for `Tree.observer`, gets the time of every branch decision and classifier fit."""
+    if stage == 'branch':
+        branch_seconds.observe(seconds, str(depth) if depth < MAX_DEPTH_LABEL else f'{MAX_DEPTH_LABEL}+')
+    elif stage == 'fit':
+        fit_seconds.observe(seconds)
+
+
+class SamplingProfiler():
+    """Statistical profiler, samples the stack of every other thread every `interval` seconds.
+
+    Stacks are counted in the collapsed format flame graph tools read (`frame;frame;frame count`). Sampling only looks at
+    sys._current_frames(), so the cost is one stack walk per thread per interval and nothing on the request path.
+
+    Args:
+        interval (float, optional): Seconds between samples. Defaults to 0.01.
+        max_depth (int, optional): Innermost frames kept per stack. Defaults to 48.
+    """
+    def __init__(self, interval=0.01, max_depth=48):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        me = threading.get_ident()
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            stacks.append(';'.join(reversed(stack)))
+
+        with self.lock:
+            self.stacks.update(stacks)
+            self.samples += 1
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def report(self, limit=200, reset=False):
+        """The `limit` most sampled stacks in collapsed format, one per line."""
+        with self.lock:
+            lines = [f'{stack} {count}' for stack, count in self.stacks.most_common(limit)]
+            if reset:
+                self.stacks.clear()
+                self.samples = 0
+        return '\n'.join(lines) + '\n'
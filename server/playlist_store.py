@@ -0,0 +1,115 @@
+import numpy as np
+from array import array
+import sys
+import os
+
+STORE_FILES = ('playlist_ids.npy', 'offsets.npy', 'tracks.npy', 'track_ids.npy')
+
+
+class PlaylistStore():
+    """Packed, memory-mapped copy of the 1 million playlist dataset.
+
+    A store is a directory of four arrays:
+        playlist_ids.npy - playlist id of every playlist, fixed width bytes
+        offsets.npy      - playlist i owns tracks[offsets[i]:offsets[i + 1]]
+        tracks.npy       - int32 index into track_ids for every track of every playlist, back to back
+        track_ids.npy    - every distinct spotify track id once, fixed width bytes
+    Opening a playlist is a dict lookup and a slice of the memory-mapped arrays, no file is opened per playlist.
+
+    Args:
+        path (str): Store directory, see `convert_index_dir` for making one.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.playlist_ids = np.load(os.path.join(path, 'playlist_ids.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.track_table = np.load(os.path.join(path, 'track_ids.npy'), mmap_mode='r')
+        self.tracks = np.load(os.path.join(path, 'tracks.npy'), mmap_mode='r')
+
+        self.index = {p.decode(): i for i, p in enumerate(self.playlist_ids.tolist())}
+
+    @staticmethod
+    def exists(path):
+        return all(os.path.exists(os.path.join(path, f)) for f in STORE_FILES)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, playlist_id):
+        return playlist_id in self.index
+
+    def ids(self):
+        """Playlist ids in store order."""
+        return iter(self.index)
+
+    def track_indexes(self, playlist_id):
+        """Interned track numbers of a playlist as a slice of the mmap, None if the playlist is not in the store."""
+        i = self.index.get(playlist_id)
+        if i is None:
+            return None
+        return self.tracks[self.offsets[i]:self.offsets[i + 1]]
+
+    def track_ids(self, playlist_id):
+        """Spotify track ids of a playlist, None if the playlist is not in the store."""
+        indexes = self.track_indexes(playlist_id)
+        if indexes is None:
+            return None
+        return [t.decode() for t in self.track_table[indexes].tolist()]
+
+
+def read_index_file(path):
+    # same format the server reads, a count line followed by one track id per line
+    f = open(path, 'r')
+    num_tracks = int(f.readline())
+    track_ids = [t.strip() for t in f.readlines()]
+    f.close()
+    return [t for t in track_ids[:num_tracks] if t]
+
+
+def convert_index_dir(src, dst, verbose=False):
+    """Packs a directory of `<playlist id>.INDEX` files into a PlaylistStore.
+
+    Args:
+        src (str): Directory of .INDEX files.
+        dst (str): Store directory to write, created if it does not exist.
+        verbose (bool, optional): Print progress. Defaults to False.
+
+    Returns:
+        PlaylistStore: The new store.
+    """
+    os.makedirs(dst, exist_ok=True)
+
+    playlist_ids = []
+    offsets = array('q', [0])
+    tracks = array('i')
+    interned = {}
+
+    for entry in os.scandir(src):
+        if not entry.name.endswith('.INDEX'):
+            continue
+        try:
+            track_ids = read_index_file(entry.path)
+        except (OSError, ValueError):
+            print(f'Skipping unreadable playlist {entry.name}')
+            continue
+
+        for t in track_ids:
+            tracks.append(interned.setdefault(t, len(interned)))
+        offsets.append(len(tracks))
+        playlist_ids.append(entry.name.split('.')[0])
+
+        if verbose and len(playlist_ids) % 10000 == 0:
+            print(f'{len(playlist_ids)} playlists, {len(interned)} distinct tracks')
+
+    np.save(os.path.join(dst, 'playlist_ids.npy'), np.array([p.encode() for p in playlist_ids], dtype=bytes))
+    np.save(os.path.join(dst, 'offsets.npy'), np.frombuffer(offsets, dtype=np.int64))
+    np.save(os.path.join(dst, 'tracks.npy'), np.frombuffer(tracks, dtype=np.int32))
+    np.save(os.path.join(dst, 'track_ids.npy'), np.array([t.encode() for t in interned], dtype=bytes))
+
+    return PlaylistStore(dst)
+
+
+if __name__ == '__main__':
+    # python -m server.playlist_store <index dir> <store dir>
+    store = convert_index_dir(sys.argv[1], sys.argv[2], verbose=True)
+    print(f'Packed {len(store)} playlists with {len(store.track_table)} distinct tracks into {sys.argv[2]}')
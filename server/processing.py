@@ -1,18 +1,116 @@
-import pandas as pd
-from sklearn import preprocessing
+import numpy as np
+
+from spotifyapi.cache import FEATURE_COLUMNS
 
 def process_features(track_features):
     """Processes the raw output of spotifyapi.api.track_features(...)
 
     Args:
         track_features (zip): zip object of track id and tracks features.
-    
+
     Returns:
-        [panda.DataFrame, None] Returns a formatted dataframe containing only the scaled feature data, using sklearn.preprocessing. Returns None if processing failed. 
+        [panda.DataFrame, None] Returns a formatted dataframe containing only the scaled feature data, using sklearn.preprocessing. Returns None if processing failed.
     """
+    # pandas and sklearn take a second or so to import and only this fallback needs them, so they are imported on first use
+    import pandas as pd
+    from sklearn import preprocessing
+
     features = [f for _, f in track_features if f is not None]
     df = pd.DataFrame(features).drop(["type", "id", "uri", "track_href", "analysis_url"], axis=1)
 
     return pd.DataFrame(preprocessing.scale(df), columns=df.columns)
 
-    
\ No newline at end of file
+
+def decode_features(track_features, dtype=np.float32):
+    """Decodes the raw output of spotifyapi.api.track_features(...) straight into a numpy array.
+
+    Args:
+        track_features (iterable): (track id, track features) pairs, features of None are skipped.
+        dtype (numpy.dtype, optional): Array type. Defaults to np.float32.
+
+    Returns:
+        numpy.ndarray: One row per track, columns in the order of spotifyapi.cache.FEATURE_COLUMNS.
+    """
+    features = [f for _, f in track_features if f is not None]
+
+    X = np.empty((len(features), len(FEATURE_COLUMNS)), dtype=dtype)
+    for i, f in enumerate(features):
+        X[i] = [f[c] for c in FEATURE_COLUMNS]
+    return X
+
+
+class Preprocessor():
+    """Scaling and PCA projection of playlists in one step.
+
+    `process_features` followed by `pca.transform` standardizes every column of a playlist by its own mean and
+    standard deviation and then projects onto the PCA components. Both are affine, so for a playlist with column
+    means m and standard deviations s they fold into a single matrix product
+
+        ((X - m) / s - pca.mean_) @ C.T  =  X @ (C.T / s[:, None])  -  (m / s + pca.mean_) @ C.T
+
+    where C is pca.components_ (divided by the explained standard deviations for a whitened PCA).
+
+    Args:
+        pca (sklearn.decomposition.PCA): Fitted PCA from the EDA notebook.
+    """
+    def __init__(self, pca):
+        components = np.asarray(pca.components_, dtype=np.float64)
+        mean = np.asarray(pca.mean_, dtype=np.float64)
+
+        # pca fitted on a dataframe remembers its column order, line it up with ours
+        names = getattr(pca, 'feature_names_in_', None)
+        if names is not None:
+            order = [list(names).index(c) for c in FEATURE_COLUMNS]
+            components = components[:, order]
+            mean = mean[order]
+
+        self.projection = components.T # (features, components)
+        if getattr(pca, 'whiten', False):
+            self.projection = self.projection / np.sqrt(pca.explained_variance_)
+        self.offset = mean @ self.projection
+
+    @staticmethod
+    def supports(reducer):
+        """True if `reducer` is a linear PCA whose transform this class can reproduce."""
+        return hasattr(reducer, 'components_') and hasattr(reducer, 'mean_')
+
+    @staticmethod
+    def _scale(X):
+        if X.shape[0] == 0:
+            raise ValueError('Cannot preprocess a playlist without track features.')
+        mean = X.mean(axis=0, dtype=np.float64)
+        std = X.std(axis=0, dtype=np.float64)
+        std[std < 10 * np.finfo(np.float64).eps] = 1.0 # same as sklearn.preprocessing.scale for constant columns
+        return mean, std
+
+    def transform(self, X):
+        """Scales and projects the tracks of one playlist.
+
+        Args:
+            X (numpy.ndarray): Output of `decode_features`.
+
+        Returns:
+            numpy.ndarray: Reduced feature matrix, float64.
+        """
+        mean, std = self._scale(X)
+        return X @ (self.projection / std[:, None]) - ((mean / std) @ self.projection + self.offset)
+
+    def transform_batch(self, Xs):
+        """Scales and projects the tracks of several playlists, with one matrix product for the whole batch.
+
+        Args:
+            Xs (list): `decode_features` outputs, one per playlist.
+
+        Returns:
+            list: Reduced feature matrix for each playlist.
+        """
+        if not Xs:
+            return []
+
+        counts = np.array([X.shape[0] for X in Xs])
+        stats = [self._scale(X) for X in Xs]
+        means = np.repeat(np.stack([m for m, _ in stats]), counts, axis=0)
+        stds = np.repeat(np.stack([s for _, s in stats]), counts, axis=0)
+
+        reduced = ((np.concatenate(Xs) - means) / stds) @ self.projection - self.offset
+        return np.split(reduced, np.cumsum(counts)[:-1])
@@ -0,0 +1,70 @@
+import threading
+import hashlib
+import weakref
+from collections import OrderedDict
+
+
+class QueryCache():
+    """Bounded LRU cache of `/query/` answers.
+
+    An answer is keyed by the playlist id, a hash of its track list and the number of playlists asked for, so an edited
+    playlist misses. Along with the labels it keeps the node versions its walk down the tree recorded (see
+    `Tree.is_current`): a push or rebuild that changes one of those nodes makes the answer stale, changes anywhere else
+    in the tree leave it be. A repeat query then costs the track list, a hash and a check of one version per level,
+    instead of the features, PCA and `predict` at every node.
+
+    Args:
+        max_entries (int, optional): Answers kept at once, least recently used ones go first. Defaults to 10000.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    @staticmethod
+    def key(playlist_id, track_ids, k):
+        digest = hashlib.blake2b('\n'.join(track_ids).encode(), digest_size=16).hexdigest()
+        return (playlist_id, digest, k)
+
+    def get(self, key, tree):
+        """Cached answer for `key` if it is still what `tree` would say, else None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            labels, seen, tree_ref = entry
+            # answers of a tree that has since been replaced (a query worker loading a new snapshot) start with new versions
+            if tree_ref() is not tree or not tree.is_current(seen):
+                del self.entries[key]
+                self.stale += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return labels
+
+    def put(self, key, labels, seen, tree):
+        """Caches an answer with the (node, version) pairs `tree.query(..., seen=seen)` recorded for it."""
+        with self.lock:
+            self.entries[key] = (labels, seen, weakref.ref(tree))
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries)
+            }
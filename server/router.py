@@ -0,0 +1,458 @@
+"""Front end of a sharded tree: the top levels of the tree in one process, each subtree below them in a shard server.
+
+    python -m server.router --snapshot snapshots/ --shards 4 --dir shards/
+    python -m server.router --dir shards/
+
+A shard is a plain `server.server` process serving one subtree from a snapshot directory of its own, so it keeps the
+`/push/`, `/recommendation/`, `/query/`, `/update/` and `/remove/` contract. The router keeps the classifiers above
+the shards as a Tree whose leaves are labelled with shard names (see `Tree.extract`). For a request it works out the
+playlist's features the way the server does, walks its top tree down to a shard and forwards the request there over a
+pooled connection. The shard finds the features in the feature cache the router has just filled, so spotify is only
+asked once.
+
+The first run cuts the tree of `--snapshot` into `--shards` subtrees, biggest first, and writes the top tree and every
+shard under `--dir`; later runs start from `--dir`. Shards run as local processes on ports counting up from
+`--first-port`, standing in for separate machines. `/admin/shards/` lists them with the number of requests routed to
+each. `/admin/split/?shard=<name>` splits a shard in two at its top classifier, which moves up into the router, and
+`/admin/move/?shard=<name>` moves a shard to a fresh process. Both checkpoint the shard first and hold its requests
+until the new shards answer. The router doesn't know which shard holds a playlist, so `/remove/` asks them in turn, and
+`/update/` removes the playlist that way before pushing its new tracks to the shard they route to.
+"""
+from flask import Flask, Response, request
+import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
+import subprocess
+import threading
+import argparse
+import signal
+import shutil
+import json
+import time
+import sys
+import os
+
+import server.server as srv
+import server.metrics as metrics
+import spotifyapi.session as spotify_session
+from spotifyapi.authorization import SpotifyAuth
+from spotifyapi.cache import FeatureCache
+from server.playlist_store import PlaylistStore
+from treemodel.tree import NO_NODE
+from treemodel.concurrency import RWLock
+import treemodel.snapshot as tree_snapshot
+
+
+def cut(tree, num_shards):
+    """Nodes to cut a tree at so it falls apart into `num_shards` subtrees, splitting the one with the most leaves first.
+
+    Returns:
+        list: Top node of every subtree, fewer than `num_shards` if the tree runs out of classifiers.
+    """
+    tops = [tree.head]
+    while len(tops) < num_shards:
+        splittable = [n for n in tops if not tree.is_leaf(n)]
+        if not splittable:
+            break
+        node = max(splittable, key=tree.leaf_count.__getitem__)
+        tops.remove(node)
+        tops += [tree.left[node], tree.right[node]]
+    return tops
+
+
+class Shard():
+    """A shard server process as the router sees it."""
+    def __init__(self, name, url, process):
+        self.name = name
+        self.url = url
+        self.process = process
+
+        self.lock = RWLock() # forwarded requests hold the read side, a split or move the write side
+        self.retired = False # replaced by a split or move, requests that waited for it are routed again
+        self.requests = 0
+
+
+class Router():
+    """Top tree and shard table of a sharded tree.
+
+    Args:
+        path (str): Directory holding the top tree snapshot (`router/`), the shard list (`shards.json`) and the snapshot
+            root of every shard.
+        host (str): Host the shard servers listen on.
+        first_port (int): Port of the first shard server started, later ones count up.
+        conf (str, optional): Config file the shard servers are started with. Defaults to 'conf.json'.
+        pool_size (int, optional): Connections kept open per shard. Defaults to 16.
+    """
+    def __init__(self, path, host, first_port, conf='conf.json', pool_size=16):
+        self.path = path
+        self.host = host
+        self.next_port = first_port
+        self.conf = conf
+
+        self.top = None
+        self.shards = {}
+        self.next_id = 0
+        self.lock = threading.Lock() # one split or move at a time
+
+        self.http = requests.Session()
+        self.http.mount('http://', HTTPAdapter(pool_connections=64, pool_maxsize=pool_size))
+
+    def build(self, tree, num_shards):
+        """Cuts `tree` into shards, writes them and the top tree to `path` and starts the shard servers."""
+        if tree.head == NO_NODE:
+            raise ValueError('Can not shard an empty tree.')
+
+        names = {top: self.new_name() for top in cut(tree, num_shards)}
+        for top, name in names.items():
+            tree_snapshot.save(tree.extract(top), os.path.join(self.path, name))
+        self.top = tree.extract(tree.head, stubs=names)
+        self.top.use_kernels()
+
+        self.start(names.values())
+        self.save()
+
+    def resume(self):
+        """Picks up the top tree and shards written to `path` by an earlier run and starts the shard servers."""
+        f = open(os.path.join(self.path, 'shards.json'), 'r')
+        state = json.load(f)
+        f.close()
+
+        self.next_id = state['next_id']
+        self.top = tree_snapshot.load(os.path.join(self.path, 'router'))
+        self.top.use_kernels()
+        self.start(state['shards'])
+
+    def save(self):
+        tree_snapshot.save(self.top, os.path.join(self.path, 'router'))
+        tmp = os.path.join(self.path, 'shards.json.tmp')
+        f = open(tmp, 'w')
+        json.dump({'next_id': self.next_id, 'shards': sorted(self.shards)}, f)
+        f.close()
+        os.replace(tmp, os.path.join(self.path, 'shards.json'))
+
+    def new_name(self):
+        self.next_id += 1
+        return f's{self.next_id - 1}'
+
+    def start(self, names):
+        # start every shard before waiting on any, they load their snapshots side by side
+        started = [self.start_shard(name) for name in names]
+        for shard in started:
+            self.wait_ready(shard)
+            self.shards[shard.name] = shard
+        return started
+
+    def start_shard(self, name):
+        port = self.next_port
+        self.next_port += 1
+
+        # a shard is the plain server on its own port and snapshot directory, reading the router's feature cache
+        overrides = {'port': port, 'snapshot_dir': os.path.join(self.path, name), 'authorize': False,
+                     'feature_cache_read_only': True, 'query_workers': 0}
+        command = [sys.executable, '-m', 'server.server', '--conf', self.conf]
+        for key, value in overrides.items():
+            command += ['--set', f'{key}={json.dumps(value)}']
+        return Shard(name, f'http://{self.host}:{port}', subprocess.Popen(command))
+
+    def wait_ready(self, shard, timeout=300.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if shard.process.poll() is not None:
+                raise RuntimeError(f'Shard {shard.name} exited with code {shard.process.returncode}.')
+            try:
+                if self.http.get(shard.url + '/readyz', timeout=2).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError(f'Shard {shard.name} did not come up within {timeout} seconds.')
+
+    def stop_shard(self, shard):
+        try:
+            self.http.get(shard.url + '/kill/', timeout=5)
+            shard.process.wait(timeout=30)
+        except (requests.RequestException, subprocess.TimeoutExpired):
+            shard.process.terminate()
+
+    def checkpoint(self, shard):
+        response = self.http.get(shard.url + '/admin/checkpoint/', timeout=600)
+        if response.status_code != 200:
+            raise RuntimeError(f'Shard {shard.name} could not checkpoint: {response.text}')
+
+    def forward(self, data, path, params):
+        """Sends a request on to the shard the playlist `data` routes to.
+
+        Returns:
+            tuple: (body, status code, content type) of the shard's response.
+        """
+        while True:
+            shard = self.shards[self.top.leaf_label(self.top.route(data))]
+            with shard.lock.read:
+                if shard.retired:
+                    continue
+                shard.requests += 1
+                response = self.http.get(shard.url + path, params=params)
+                return response.content, response.status_code, response.headers.get('Content-Type', 'application/json')
+
+    def remove(self, label):
+        """Asks the shards to remove a playlist until one has it, the router doesn't know which shard holds which playlist.
+
+        Returns:
+            bool: Whether a shard had it.
+        """
+        # no split or move while going through the shards, the playlist could move to one already asked
+        with self.lock:
+            for shard in self.shards.values():
+                with shard.lock.read:
+                    shard.requests += 1
+                    if self.http.get(shard.url + '/remove/', params={'playlist': label}).status_code == 200:
+                        return True
+        return False
+
+    def split(self, name):
+        """Splits a shard in two at its top classifier, which becomes a node of the router's top tree.
+
+        Returns:
+            list: Names of the two new shards.
+        """
+        with self.lock:
+            shard = self.shards[name]
+            with shard.lock.write:
+                self.checkpoint(shard)
+                tree = tree_snapshot.load(os.path.join(self.path, name))
+                if tree.is_leaf(tree.head):
+                    raise ValueError(f'Shard {name} holds a single playlist.')
+
+                head = tree.head
+                halves = [self.new_name(), self.new_name()]
+                for child, half in zip((tree.left[head], tree.right[head]), halves):
+                    tree_snapshot.save(tree.extract(child), os.path.join(self.path, half))
+                self.start(halves)
+
+                top = self.top
+                left, right = [top.add_kept_leaf(np.zeros((0, 0)), half) for half in halves]
+                node = top.add_classifier(tree.classifier(head), left, right, sides=tree.sides[tree.slot[head]])
+                top.replace(next(n for n in top.subtree_leaves(top.head) if top.leaf_label(n) == name), node)
+
+                shard.retired = True
+                del self.shards[name]
+                self.save()
+
+            self.stop_shard(shard)
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        return halves
+
+    def move(self, name):
+        """Moves a shard to a new server process, from its latest checkpoint.
+
+        Returns:
+            Shard: The new shard.
+        """
+        with self.lock:
+            shard = self.shards[name]
+            with shard.lock.write:
+                # the old server stops first, two servers never checkpoint into the same directory
+                self.checkpoint(shard)
+                self.stop_shard(shard)
+                moved, = self.start([name])
+                shard.retired = True
+        return moved
+
+    def stop(self):
+        # a shard's /kill/ doesn't checkpoint, whatever was pushed since its last one would be lost
+        for shard in list(self.shards.values()):
+            try:
+                self.checkpoint(shard)
+            except (requests.RequestException, RuntimeError) as e:
+                print(f'Checkpoint of shard {shard.name} failed: {e}')
+            self.stop_shard(shard)
+
+
+#
+# Request handling
+#
+
+app = Flask(__name__)
+router = None
+
+
+def routed(r_type):
+    # works out the features of the playlist to pick its shard, the shard answers the request
+    if not isinstance(request.args.get('playlist'), str):
+        return {
+            'type': r_type,
+            'ret': 'Only Accepting Playlist ID\'s.'
+        }, 400
+
+    reduced_data, err = srv.playlist_data(request.args.get('playlist'), r_type)
+    if err is not None:
+        return err
+
+    with metrics.timed('shard_forward'):
+        body, status, content_type = router.forward(reduced_data, request.path, request.args.to_dict(flat=False))
+    return Response(body, status=status, content_type=content_type)
+
+@app.route('/push/')
+def playlist_push():
+    return routed('push')
+
+@app.route('/recommendation/')
+def playlist_recommendation():
+    return routed('recommend')
+
+@app.route('/query/')
+def playlist_query():
+    return routed('query')
+
+@app.route('/update/')
+def playlist_update():
+    # the new tracks may route to another shard than the old ones, so the playlist is removed wherever it is and pushed where it goes now
+    if not isinstance(request.args.get('playlist'), str):
+        return {
+            'type': 'update',
+            'ret': 'Only Accepting Playlist ID\'s.'
+        }, 400
+
+    playlist_id = request.args.get('playlist')
+    reduced_data, err = srv.playlist_data(playlist_id, 'update')
+    if err is not None:
+        return err
+
+    with metrics.timed('shard_forward'):
+        if not router.remove(playlist_id):
+            return {
+                'type': 'update',
+                'ret': 'Playlist is not in the tree.'
+            }, 404
+        body, status, content_type = router.forward(reduced_data, '/push/', {'playlist': playlist_id})
+    return Response(body, status=status, content_type=content_type)
+
+@app.route('/remove/')
+def playlist_remove():
+    if not isinstance(request.args.get('playlist'), str):
+        return {
+            'type': 'remove',
+            'ret': 'Only Accepting Playlist ID\'s.'
+        }, 400
+
+    with metrics.timed('shard_forward'):
+        removed = router.remove(request.args.get('playlist'))
+    if not removed:
+        return {
+            'type': 'remove',
+            'ret': 'Playlist is not in the tree.'
+        }, 404
+    return {
+        'type': 'remove',
+        'ret': None
+    }, 200
+
+@app.route('/callback/')
+def auth_callback():
+    if 'code' not in request.args:
+        return 'Authentication Failure'
+    srv.auth.get_tokens(request.args['code'])
+    return 'Done authorizing, close tab...'
+
+@app.route('/admin/shards/')
+def admin_shards():
+    return {
+        'type': 'shards',
+        'ret': [{'name': s.name, 'url': s.url, 'requests': s.requests} for s in router.shards.values()]
+    }, 200
+
+@app.route('/admin/split/')
+def admin_split():
+    name = request.args.get('shard')
+    if name not in router.shards:
+        return {
+            'type': 'split',
+            'ret': f'No shard {name}.'
+        }, 404
+    try:
+        halves = router.split(name)
+    except ValueError as e:
+        return {
+            'type': 'split',
+            'ret': str(e)
+        }, 409
+    return {
+        'type': 'split',
+        'ret': halves
+    }, 200
+
+@app.route('/admin/move/')
+def admin_move():
+    name = request.args.get('shard')
+    if name not in router.shards:
+        return {
+            'type': 'move',
+            'ret': f'No shard {name}.'
+        }, 404
+    return {
+        'type': 'move',
+        'ret': router.move(name).url
+    }, 200
+
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/kill/')
+def kill_router():
+    def shutdown():
+        time.sleep(0.5) # let this response go out first
+        router.stop()
+        os.kill(os.getpid(), signal.SIGTERM)
+    threading.Thread(target=shutdown).start()
+    return 'Router and shards are kill.'
+
+
+def main():
+    global router
+
+    parser = argparse.ArgumentParser(description='Routing front end of a tree sharded over several server processes.')
+    parser.add_argument('--dir', required=True, help='Directory of the top tree and the shard snapshots.')
+    parser.add_argument('--snapshot', help='Snapshot directory of the tree to shard, for the first run.')
+    parser.add_argument('--shards', type=int, default=4, help='Number of shards to cut the tree into on the first run.')
+    parser.add_argument('--conf', default='conf.json', help='Config file, the "server" section is used by the router and the shards.')
+    parser.add_argument('--port', type=int, help='Router port. Defaults to "port" of the config.')
+    parser.add_argument('--first-port', type=int, default=8101, help='Port of the first shard server.')
+    args = parser.parse_args()
+
+    config = srv.load_config(args.conf)['server']
+    if not config.get('feature_cache'):
+        parser.error('Shards read track features from the router\'s feature cache, set "feature_cache" in the config.')
+    port = args.port or config['port']
+
+    # the router works out playlist features like the server does, so it sets up the server module's helpers
+    srv.config = config
+    srv.auth = SpotifyAuth(f'http://{config["url"]}:{port}{config["callback"]}', config.get('token_file', 'spotify_tokens.json'))
+    spotify_session.configure(srv.auth, **config.get('spotify_session', {}))
+    srv.feature_cache = FeatureCache(config['feature_cache'], hot_size=config.get('feature_cache_hot_size', 100000))
+    if config.get('playlist_store'):
+        srv.playlist_store = PlaylistStore(config['playlist_store'])
+    srv.load_reducer()
+
+    router = Router(args.dir, config['url'], args.first_port, args.conf)
+    if os.path.exists(os.path.join(args.dir, 'shards.json')):
+        router.resume()
+    else:
+        if args.snapshot is None:
+            parser.error(f'Nothing to resume in {args.dir}, pass --snapshot to shard a tree.')
+        tree = tree_snapshot.load(args.snapshot)
+        if tree is None:
+            parser.error(f'No snapshot in {args.snapshot}.')
+        router.build(tree, args.shards)
+    print(f'Routing to {len(router.shards)} shards: ' + ', '.join(f'{s.name} at {s.url}' for s in router.shards.values()))
+
+    metrics.registry.add(metrics.Gauge('router_shards', 'Shards behind the router.', lambda: len(router.shards)))
+
+    threading.Thread(target=app.run, kwargs={'host': config['url'], 'port': port}).start()
+    if not srv.auth.has_tokens():
+        srv.auth.authorize()
+    srv.auth.start_refresher(config.get('token_refresh_margin', 300))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,114 @@
-from flask import Flask, request
+import time
+import_started = time.perf_counter()
+
+from flask import Flask, Response, request, stream_with_context
 import threading
 import json
-import time
 import os
 import signal
+import argparse
 import pickle as pk
-import time
+from concurrent.futures import ProcessPoolExecutor
 
 # spotify wranglers
 from spotifyapi.authorization import SpotifyAuth
 import spotifyapi.api as spotify_api
+from spotifyapi.cache import FeatureCache
+import spotifyapi.session as spotify_session
 
 # data processing and recommendation system
-from server.processing import process_features
+from server.processing import process_features, decode_features, Preprocessor
+from server.playlist_store import PlaylistStore
+from server.result_cache import QueryCache
 from server.initialize import init_tree
+import treemodel.snapshot as tree_snapshot
+import server.metrics as metrics
+from treemodel.concurrency import RWLock, TreeWriter
+from treemodel.balance import Rebalancer
+from treemodel.leaves import parse_policy
+from treemodel.ann import PlaylistIndex
+import server.workers as workers
+from server.startup import Startup
 
 pca_reducer = None
+preprocessor = None
+feature_cache = None
+playlist_store = None
+query_cache = None
+
+# number of playlists handled together by the bulk ingest endpoint
+BATCH_SIZE = 100
+
+# every change to the tree goes through the single tree writer, queries read the tree without locking
+# snapshots take the read side of the lock so the writer waits for them
+tree_lock = RWLock()
+tree_writer = None
+checkpointer = None
+rebalancer = None
+profiler = None
+
+# read only query worker processes started by the server, or in a worker the follower of the server's snapshots
+query_workers = []
+follower = None
 
 # objects for server handling
 app_server = Flask(__name__)
 kill_serv = threading.Event()
 server_thread, kill_thread, auth, config = None, None, None, None
 
+# the port is up from the start, the tree and the PCA model load behind /readyz
+startup = Startup(import_started)
+startup.record('import', time.perf_counter() - import_started)
+
 
 #
 # Server request handling
 #
 
+# endpoints that change the tree or the server, query workers send them back to the server process
+WRITE_ENDPOINTS = {'auth_callback', 'kill_server', 'admin_checkpoint', 'playlist_recommendation', 'playlist_push', 'playlist_push_batch',
+                   'playlist_update', 'playlist_remove'}
+
+# endpoints that answer while the server is still starting, everything else needs the tree or the PCA model
+STARTUP_ENDPOINTS = {'liveness', 'readiness', 'auth_callback', 'kill_server', 'metrics_page'}
+
+@app_server.before_request
+def read_only_worker():
+    if follower is not None and request.endpoint in WRITE_ENDPOINTS:
+        return {
+            'type': request.endpoint,
+            'ret': f'Read only query worker, send this to port {config["port"]}.'
+        }, 405
+
+@app_server.before_request
+def not_ready():
+    if not startup.is_ready() and request.endpoint not in STARTUP_ENDPOINTS:
+        return {
+            'type': request.endpoint,
+            'ret': f'Server is starting ({startup.current}), see /readyz.'
+        }, 503, {'Retry-After': '1'}
+
+@app_server.route('/healthz')
+def liveness():
+    # the process is up and serving, a failed start-up phase won't recover on its own so it counts as down
+    if startup.error is not None:
+        return {
+            'type': 'healthz',
+            'ret': startup.error
+        }, 500
+    return {
+        'type': 'healthz',
+        'ret': 'ok'
+    }, 200
+
+@app_server.route('/readyz')
+def readiness():
+    # 503 until every start-up phase is done, with the time each one took
+    return {
+        'type': 'readyz',
+        'ret': startup.report()
+    }, 200 if startup.is_ready() else 503
+
 @app_server.route('/callback/')
 def auth_callback():
     global auth
@@ -44,79 +126,75 @@ def kill_server():
     kill_serv.set()
     return 'Server is kill.'
 
+@app_server.route('/admin/checkpoint/')
+def admin_checkpoint():
+    if checkpointer is None:
+        return {
+            'type': 'checkpoint',
+            'ret': 'Snapshots are not enabled.'
+        }, 404
+
+    snapshot = checkpointer.checkpoint()
+    return {
+        'type': 'checkpoint',
+        'ret': snapshot
+    }, 200
+
+@app_server.route('/metrics')
+def metrics_page():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app_server.route('/metrics/profile')
+def metrics_profile():
+    # collapsed stacks from the sampling profiler, feed them to a flame graph tool
+    if profiler is None:
+        return Response('Profiler is not enabled, set "profile_interval" in conf.json.\n', status=404, mimetype='text/plain')
+    return Response(profiler.report(limit=request.args.get('limit', default=200, type=int), reset='reset' in request.args), mimetype='text/plain')
+
+@app_server.route('/feature_cache/')
+def feature_cache_stats():
+    if feature_cache is None:
+        return {
+            'type': 'feature_cache',
+            'ret': 'Feature cache is not enabled.'
+        }, 404
+
+    return {
+        'type': 'feature_cache',
+        'ret': feature_cache.stats()
+    }, 200
+
+@app_server.route('/query_cache/')
+def query_cache_stats():
+    if query_cache is None:
+        return {
+            'type': 'query_cache',
+            'ret': 'Query cache is not enabled.'
+        }, 404
+
+    return {
+        'type': 'query_cache',
+        'ret': query_cache.stats()
+    }, 200
+
 @app_server.route('/recommendation/')
 def playlist_recommendation():
     # pretty much exact same thing as push, but with return flag set true for recommendation tree
     if request.method == 'GET':
         if isinstance(request.args.get('playlist'), str):
-            # if the request is a string then assume it is a playlist id
-            # in that case we either need to 
-            #   1) poll spotify for the tracks / features
-            #   2) or load up tracks from disk and poll spotify for features
-            #   
-            # it is probably easier to just poll spotify for the relevant data
-            # only load from disk if it is from the 1_million playlists dataset
-
             playlist_id = request.args.get('playlist')
 
-            # check if a '1mil' playlist
-            if playlist_id[0:2] == 'm_':
-                src = config['playlist_source']
-                track_ids = None
-                try:
-                    f = open(f'{src}{playlist_id}.INDEX', 'r')
-                    num_tracks = int(f.readline())
-                    track_ids = ['']*num_tracks
-                    for i, t in enumerate(f.readlines()):
-                        track_ids[i] = t
-                    f.close()
-                except:
-                    return {
-                        'type': 'recommend',
-                        'ret': 'Could not find non-Spotify Playlist in database.'
-                    }, 404
-                
-                track_features = spotify_api.track_features(track_ids, auth)
-                if track_features is None:
-                    print(f'Track Features Error with Spotify API.')                    
-                    return {
-                        'type': 'recommend',
-                        'ret': 'Bad Track Features.'
-                    }, 400
-
-                data = process_features(track_features)
-                reduced_data = pca_reducer.transform(data)
-                recommendation = recommendation_tree.push(reduced_data, playlist_id, ret=True)
-
-                return {
-                    'type': 'recommend',
-                    'ret': recommendation
-                }, 200        
-            else:
-                track_ids = spotify_api.playlist_track_ids(playlist_id, auth)
-                if track_ids is None:
-                    print(f'Track IDs Error with Spotify API. Playlist ID = {playlist_id}')
-                    return {
-                        'type': 'recommend',
-                        'ret': 'Bad Track IDs.'
-                    }, 400
-
-                track_features = spotify_api.track_features(track_ids, auth)
-                if track_features is None:
-                    print(f'Track Features Error with Spotify API.')                    
-                    return {
-                        'type': 'recommend',
-                        'ret': 'Bad Track Features.'
-                    }, 400
-
-                data = process_features(track_features)
-                reduced_data = pca_reducer.transform(data)
-                recommendation = recommendation_tree.push(reduced_data, playlist_id, ret=True)
-
-                return {
-                    'type': 'recommend',
-                    'ret': recommendation
-                }, 200
+            reduced_data, err = playlist_data(playlist_id, 'recommend')
+            if err is not None:
+                return err
+
+            with metrics.timed('tree_push'):
+                recommendation = tree_writer.push(reduced_data, playlist_id, ret=True).result()
+
+            return {
+                'type': 'recommend',
+                'ret': recommendation
+            }, 200
         else:
             # error, only accepting playlist id's, not raw tracks or track features. Not enough time to implement
             return {
@@ -124,78 +202,142 @@ def playlist_recommendation():
                 'ret': 'Only Accepting Playlist ID\'s.'
             }, 400
     
+@app_server.route('/query/')
+def playlist_query():
+    # read only recommendation, the tree is only searched and the queried playlist is not added to it
+    if request.method == 'GET':
+        if isinstance(request.args.get('playlist'), str):
+            playlist_id = request.args.get('playlist')
+            k = request.args.get('k', default=1, type=int)
+            tree = recommendation_tree # a query worker may swap in a newer tree while this one is answered
+
+            track_ids, err = playlist_tracks(playlist_id, 'query')
+            if err is not None:
+                return err
+
+            # answers stay cached until the playlist's tracks or a node on its path through the tree change
+            recommendation = None
+            if query_cache is not None:
+                cache_key = query_cache.key(playlist_id, track_ids, k)
+                recommendation = query_cache.get(cache_key, tree)
+
+            if recommendation is None:
+                reduced_data, err = tracks_data(track_ids, 'query')
+                if err is not None:
+                    return err
+
+                seen = []
+                with metrics.timed('tree_query'):
+                    recommendation = tree.query(reduced_data, k=k, seen=seen)
+                if query_cache is not None:
+                    query_cache.put(cache_key, recommendation, seen, tree)
+
+            return {
+                'type': 'query',
+                'ret': recommendation if 'k' in request.args else (recommendation[0] if recommendation else None)
+            }, 200
+        else:
+            return {
+                'type': 'query',
+                'ret': 'Only Accepting Playlist ID\'s.'
+            }, 400
+
+@app_server.route('/similar/')
+def playlist_similar():
+    # top k playlists by mean track from the nearest neighbour index, the tree is not walked
+    # with `check` the tree's answer is looked up as well and compared against those candidates
+    if recommendation_tree.index is None:
+        return {
+            'type': 'similar',
+            'ret': 'Playlist index is not enabled.'
+        }, 404
+
+    if isinstance(request.args.get('playlist'), str):
+        playlist_id = request.args.get('playlist')
+        k = request.args.get('k', default=10, type=int)
+
+        reduced_data, err = playlist_data(playlist_id, 'similar')
+        if err is not None:
+            return err
+
+        with metrics.timed('ann_search'):
+            similar = [label for label, _ in recommendation_tree.similar(reduced_data, k=k)]
+
+        if 'check' not in request.args:
+            return {
+                'type': 'similar',
+                'ret': similar
+            }, 200
+
+        with metrics.timed('tree_query'):
+            recommendation = recommendation_tree.query(reduced_data)
+        tree_answer = recommendation[0] if recommendation else None
+        return {
+            'type': 'similar',
+            'ret': {
+                'similar': similar,
+                'tree': tree_answer,
+                'tree_in_similar': tree_answer in similar
+            }
+        }, 200
+    else:
+        return {
+            'type': 'similar',
+            'ret': 'Only Accepting Playlist ID\'s.'
+        }, 400
+
+@app_server.route('/query_batch/', methods=['POST'])
+def playlist_query_batch():
+    # read only recommendations for {"playlists": [...]}, routed down the tree together
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('playlists'), list):
+        return {
+            'type': 'query_batch',
+            'ret': 'Expected {"playlists": [...]}.'
+        }, 400
+
+    results = []
+    found_ids, found_data = [], []
+    for playlist_id in [str(p) for p in body['playlists']]:
+        try:
+            reduced_data, err = playlist_data(playlist_id, 'query_batch')
+        except Exception as e:
+            reduced_data, err = None, ({'ret': str(e)}, 500)
+
+        if err is not None:
+            results.append({'playlist': playlist_id, 'status': err[1], 'ret': err[0]['ret']})
+        else:
+            found_ids.append(playlist_id)
+            found_data.append(reduced_data)
+
+    with metrics.timed('tree_query'):
+        recommendations = recommendation_tree.recommend_many(found_data)
+
+    for playlist_id, recommendation in zip(found_ids, recommendations):
+        results.append({'playlist': playlist_id, 'status': 200, 'ret': recommendation})
+
+    return {
+        'type': 'query_batch',
+        'ret': results
+    }, 200
+
 @app_server.route('/push/')
 def playlist_push():
     if request.method == 'GET':
         if isinstance(request.args.get('playlist'), str):
-            # if the request is a string then assume it is a playlist id
-            # in that case we either need to 
-            #   1) poll spotify for the tracks / features
-            #   2) or load up tracks from disk and poll spotify for features
-            #   
-            # it is probably easier to just poll spotify for the relevant data
-            # only load from disk if it is from the 1_million playlists dataset
-
             playlist_id = request.args.get('playlist')
 
-            # check if a '1mil' playlist
-            if playlist_id[0:2] == 'm_':
-                src = config['playlist_source']
-                track_ids = None
-                try:
-                    f = open(f'{src}{playlist_id}.INDEX', 'r')
-                    num_tracks = int(f.readline())
-                    track_ids = ['']*num_tracks
-                    for i, t in enumerate(f.readlines()):
-                        track_ids[i] = t.split('\n')[0]
-                    f.close()
-                except:
-                    return {
-                        'type': 'push',
-                        'ret': 'Could not find non-Spotify Playlist in database.'
-                    }, 404
-                
-                track_features = spotify_api.track_features(track_ids, auth)
-                if track_features is None:
-                    print(f'Track Features Error with Spotify API.')                    
-                    return {
-                        'type': 'push',
-                        'ret': 'Bad Track Features.'
-                    }, 400
-
-                data = process_features(track_features)
-                reduced_data = pca_reducer.transform(data)
-                recommendation_tree.push(reduced_data, playlist_id, ret=False)
-
-                return {
-                    'type': 'push',
-                    'ret': None
-                }, 200          
-            else:
-                track_ids = spotify_api.playlist_track_ids(playlist_id, auth)
-                if track_ids is None:
-                    print(f'Track IDs Error with Spotify API. Playlist ID = {playlist_id}')
-                    return {
-                        'type': 'push',
-                        'ret': 'Bad Track IDs.'
-                    }, 400
-
-                track_features = spotify_api.track_features(track_ids, auth)
-                if track_features is None:
-                    print(f'Track Features Error with Spotify API.')                    
-                    return {
-                        'type': 'push',
-                        'ret': 'Bad Track Features.'
-                    }, 400
-
-                data = process_features(track_features)
-                reduced_data = pca_reducer.transform(data)
-                recommendation_tree.push(reduced_data, playlist_id, ret=False)
-
-                return {
-                    'type': 'push',
-                    'ret': None
-                }, 200
+            reduced_data, err = playlist_data(playlist_id, 'push')
+            if err is not None:
+                return err
+
+            with metrics.timed('tree_push'):
+                tree_writer.push(reduced_data, playlist_id, ret=False).result()
+
+            return {
+                'type': 'push',
+                'ret': None
+            }, 200
         else:
             # error, only accepting playlist id's, not raw tracks or track features. Not enough time to implement
             return {
@@ -203,6 +345,287 @@ def playlist_push():
                 'ret': 'Only Accepting Playlist ID\'s.'
             }, 400
 
+@app_server.route('/update/')
+def playlist_update():
+    # new tracks for a playlist already in the tree, it is taken out and pushed again instead of getting a second leaf
+    if isinstance(request.args.get('playlist'), str):
+        playlist_id = request.args.get('playlist')
+
+        reduced_data, err = playlist_data(playlist_id, 'update')
+        if err is not None:
+            return err
+
+        with metrics.timed('tree_update'):
+            updated = tree_writer.submit(lambda tree: tree.update(playlist_id, reduced_data)).result()
+
+        if not updated:
+            return {
+                'type': 'update',
+                'ret': 'Playlist is not in the tree.'
+            }, 404
+        return {
+            'type': 'update',
+            'ret': None
+        }, 200
+    else:
+        return {
+            'type': 'update',
+            'ret': 'Only Accepting Playlist ID\'s.'
+        }, 400
+
+@app_server.route('/remove/')
+def playlist_remove():
+    if isinstance(request.args.get('playlist'), str):
+        playlist_id = request.args.get('playlist')
+
+        with metrics.timed('tree_remove'):
+            removed = tree_writer.submit(lambda tree: tree.remove(playlist_id)).result()
+
+        if not removed:
+            return {
+                'type': 'remove',
+                'ret': 'Playlist is not in the tree.'
+            }, 404
+        return {
+            'type': 'remove',
+            'ret': None
+        }, 200
+    else:
+        return {
+            'type': 'remove',
+            'ret': 'Only Accepting Playlist ID\'s.'
+        }, 400
+
+@app_server.route('/push_batch/', methods=['POST'])
+def playlist_push_batch():
+    # bulk ingest, takes either a json body {"playlists": [...]} and answers with one json document,
+    # or a newline delimited stream of playlist id's and streams back one json result per line
+    #
+    # the features for every playlist in a batch are pulled from spotify together, so the number of
+    # api round-trips depends on the number of unique tracks in the batch, not the number of playlists
+    batch_size = request.args.get('batch_size', default=BATCH_SIZE, type=int)
+
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get('playlists'), list):
+            return {
+                'type': 'push_batch',
+                'ret': 'Expected {"playlists": [...]}.'
+            }, 400
+
+        playlist_ids = [str(p) for p in body['playlists']]
+        results = []
+        for offset in range(0, len(playlist_ids), batch_size):
+            results += push_many(playlist_ids[offset:offset + batch_size])
+
+        return {
+            'type': 'push_batch',
+            'ret': results
+        }, 200
+
+    stream = request.stream
+
+    def generate():
+        for batch in batched_lines(stream, batch_size):
+            for result in push_many(batch):
+                yield json.dumps(result) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+#
+# Playlist loading and feature handling
+#
+
+def read_index(playlist_id):
+    """Reads the track ID's of a playlist from the 1 million playlist dataset on disk.
+
+    Args:
+        playlist_id (str): Playlist id, in the `m_...` format.
+
+    Returns:
+        [list, None]: List of track ID's. Returns None if the playlist is not in the dataset.
+    """
+    if playlist_store is not None:
+        return playlist_store.track_ids(playlist_id)
+
+    src = config['playlist_source']
+    try:
+        f = open(f'{src}{playlist_id}.INDEX', 'r')
+        num_tracks = int(f.readline())
+        track_ids = ['']*num_tracks
+        for i, t in enumerate(f.readlines()):
+            track_ids[i] = t.split('\n')[0]
+        f.close()
+    except:
+        return None
+
+    return track_ids
+
+
+def playlist_tracks(playlist_id, r_type):
+    """Gets the track ID's of a playlist, either from disk for a '1mil' playlist or from spotify.
+
+    Returns:
+        [tuple]: (track_ids, None) on success, (None, (response, status)) on failure.
+    """
+    # if the request is a string then assume it is a playlist id
+    # in that case we either need to 
+    #   1) poll spotify for the tracks / features
+    #   2) or load up tracks from disk and poll spotify for features
+    #   
+    # it is probably easier to just poll spotify for the relevant data
+    # only load from disk if it is from the 1_million playlists dataset
+    if playlist_id[0:2] == 'm_':
+        with metrics.timed('index_read'):
+            track_ids = read_index(playlist_id)
+        if track_ids is None:
+            return None, ({
+                'type': r_type,
+                'ret': 'Could not find non-Spotify Playlist in database.'
+            }, 404)
+    else:
+        with metrics.timed('spotify_tracks'):
+            track_ids = spotify_api.playlist_track_ids(playlist_id, auth)
+        if track_ids is None:
+            print(f'Track IDs Error with Spotify API. Playlist ID = {playlist_id}')
+            return None, ({
+                'type': r_type,
+                'ret': 'Bad Track IDs.'
+            }, 400)
+
+    return track_ids, None
+
+
+def reduce_features(track_features):
+    # with the fused preprocessor the scaling happens inside the projection, so `pca` covers both
+    if preprocessor is not None:
+        with metrics.timed('preprocess'):
+            X = decode_features(track_features)
+        with metrics.timed('pca'):
+            return preprocessor.transform(X)
+
+    with metrics.timed('preprocess'):
+        data = process_features(track_features)
+    with metrics.timed('pca'):
+        return pca_reducer.transform(data)
+
+
+def reduce_many(playlists_features):
+    # scaling and pca for a list of playlists at once, falls back to one at a time without the fused preprocessor
+    if preprocessor is not None:
+        with metrics.timed('preprocess'):
+            Xs = [decode_features(f) for f in playlists_features]
+        with metrics.timed('pca'):
+            return preprocessor.transform_batch(Xs)
+    return [reduce_features(f) for f in playlists_features]
+
+
+def playlist_data(playlist_id, r_type):
+    """Loads the tracks of a playlist, gets their features and runs them through preprocessing and PCA.
+
+    Returns:
+        [tuple]: (reduced_data, None) on success, (None, (response, status)) on failure.
+    """
+    track_ids, err = playlist_tracks(playlist_id, r_type)
+    if err is not None:
+        return None, err
+    return tracks_data(track_ids, r_type)
+
+
+def tracks_data(track_ids, r_type):
+    """Gets the features of a playlist's tracks and runs them through preprocessing and PCA, see `playlist_data`."""
+    with metrics.timed('spotify_features'):
+        track_features = spotify_api.track_features(track_ids, auth, cache=feature_cache)
+    if track_features is None:
+        print(f'Track Features Error with Spotify API.')
+        return None, ({
+            'type': r_type,
+            'ret': 'Bad Track Features.'
+        }, 400)
+
+    return reduce_features(track_features), None
+
+
+def push_many(playlist_ids):
+    """Pushes a batch of playlists into the tree.
+
+    Track features of the whole batch are requested from spotify at once, duplicate tracks are only asked for once.
+
+    Returns:
+        [list]: One dict per playlist with the `playlist`, its `status` code and the `ret` message.
+    """
+    results = [None]*len(playlist_ids)
+    tracks = [None]*len(playlist_ids)
+
+    for i, playlist_id in enumerate(playlist_ids):
+        try:
+            track_ids, err = playlist_tracks(playlist_id, 'push')
+        except Exception as e:
+            track_ids, err = None, ({'ret': str(e)}, 500)
+
+        if err is not None:
+            results[i] = {'playlist': playlist_id, 'status': err[1], 'ret': err[0]['ret']}
+        else:
+            tracks[i] = track_ids
+
+    unique_ids = list(dict.fromkeys(t for track_ids in tracks if track_ids is not None for t in track_ids))
+    with metrics.timed('spotify_features'):
+        features = spotify_api.track_features(unique_ids, auth, cache=feature_cache) if unique_ids else zip([], [])
+    if features is None:
+        print(f'Track Features Error with Spotify API.')
+    else:
+        features = dict(features)
+
+    found = []
+    for i, playlist_id in enumerate(playlist_ids):
+        if results[i] is not None:
+            continue
+        if features is None:
+            results[i] = {'playlist': playlist_id, 'status': 400, 'ret': 'Bad Track Features.'}
+        elif all(features.get(t) is None for t in tracks[i]):
+            results[i] = {'playlist': playlist_id, 'status': 400, 'ret': 'No Track Features.'}
+        else:
+            found.append(i)
+
+    try:
+        reduced = reduce_many([[(t, features.get(t)) for t in tracks[i]] for i in found])
+    except Exception as e:
+        for i in found:
+            results[i] = {'playlist': playlist_ids[i], 'status': 500, 'ret': str(e)}
+        return results
+
+    # queue every push of the batch at once, the tree writer applies them together
+    pending = {}
+    for i, reduced_data in zip(found, reduced):
+        pending[i] = tree_writer.push(reduced_data, playlist_ids[i], ret=False)
+
+    for i, future in pending.items():
+        try:
+            future.result()
+        except Exception as e:
+            results[i] = {'playlist': playlist_ids[i], 'status': 500, 'ret': str(e)}
+            continue
+
+        results[i] = {'playlist': playlist_ids[i], 'status': 200, 'ret': None}
+
+    return results
+
+
+def batched_lines(stream, batch_size):
+    # groups a newline delimited stream of playlist id's into lists of at most batch_size id's
+    batch = []
+    for line in stream:
+        playlist_id = line.decode().strip() if isinstance(line, bytes) else line.strip()
+        if not playlist_id:
+            continue
+        batch.append(playlist_id)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 
 #
 # Helper server and authorization functions
@@ -221,6 +644,18 @@ def load_config(path='conf.json'):
     return config
 
 
+def parse_overrides(pairs):
+    # KEY=VALUE pairs from --set, VALUE is read as json where it parses and as a plain string where it doesn't
+    overrides = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
 def flask_thread(url, port):
     if url:
         app_server.run(host=url, port=port)
@@ -229,17 +664,109 @@ def flask_thread(url, port):
 def killer():
     kill_serv.wait() # get the ok to kill the server
     time.sleep(0.5) # wait a little bit for it to finish responding
+    for worker in query_workers:
+        worker.terminate()
     os.kill(os.getpid(), signal.SIGTERM) # end the program
 
 
+def load_reducer():
+    global pca_reducer, preprocessor
+    pca_reducer = pk.load(open('pca_reduce.pkl', 'rb'))
+    if Preprocessor.supports(pca_reducer):
+        preprocessor = Preprocessor(pca_reducer)
+
+
+def configure_tree(tree):
+    """Read side settings of a tree from the config, for the server's tree and every tree a query worker loads."""
+    # nearest neighbour index of the playlists for /similar/, e.g. "ann_index": {"nprobe": 8} in conf.json
+    if config.get('ann_index') is not None:
+        tree.use_index(PlaylistIndex(**config['ann_index']))
+
+    tree.observer = metrics.tree_observer
+
+    # centroid routing where the margin is clear, e.g. "fast_path_threshold": 0.3 in conf.json
+    if config.get('fast_path_threshold') is not None:
+        tree.use_fast_path(config['fast_path_threshold'])
+    # route with NumPy kernels instead of sklearn's predict where there is one, "predict_kernels": false turns it off
+    if config.get('predict_kernels', True):
+        tree.use_kernels()
+
+
+def start_query_cache():
+    # cached /query/ answers, e.g. "query_cache": 10000 (max answers) in conf.json
+    global query_cache
+    if config.get('query_cache'):
+        query_cache = QueryCache(config['query_cache'])
+        metrics.registry.add(metrics.Gauge('query_cache_hits_total', 'Query answers served from the cache.', lambda: query_cache.stats()['hits'], 'counter'))
+        metrics.registry.add(metrics.Gauge('query_cache_misses_total', 'Queries that walked the tree.', lambda: query_cache.stats()['misses'], 'counter'))
+        metrics.registry.add(metrics.Gauge('query_cache_stale_total', 'Cached answers dropped after their path through the tree changed.', lambda: query_cache.stats()['stale'], 'counter'))
+        metrics.registry.add(metrics.Gauge('query_cache_entries', 'Answers in the query cache.', lambda: query_cache.stats()['entries']))
+
+
+def publish_tree(tree):
+    # a query worker picked up a new snapshot, queries already running finish on the previous tree
+    global recommendation_tree
+    configure_tree(tree)
+    if feature_cache is not None:
+        feature_cache.refresh() # the tracks of the new pushes were stored by the server
+    recommendation_tree = tree
+
+
+def query_worker(sock, worker_config, worker_auth):
+    """Entry point of a query worker process (see server/workers.py).
+
+    Serves the read only endpoints from the latest snapshot of the server's tree on the shared `query_port` socket,
+    with the server's spotify tokens and read only views of its feature cache and playlist store.
+    """
+    global config, auth, follower, feature_cache, playlist_store
+    config = worker_config
+    auth = worker_auth
+
+    # the api rate limit is shared by the server and every worker
+    session_args = dict(config.get('spotify_session', {}))
+    session_args['rate'] = session_args.get('rate', 20.0) / (config['query_workers'] + 1)
+    spotify_session.configure(auth, **session_args)
+    # the server refreshes the tokens first, the worker then reads its new ones from the token file
+    auth.start_refresher(config.get('token_refresh_margin', 300) / 2)
+
+    if config.get('feature_cache'):
+        feature_cache = FeatureCache(config['feature_cache'], hot_size=config.get('feature_cache_hot_size', 100000), read_only=True)
+    if config.get('playlist_store'):
+        playlist_store = PlaylistStore(config['playlist_store'])
+    with startup.phase('pca'):
+        load_reducer()
+    start_query_cache()
+
+    with startup.phase('tree'):
+        follower = workers.SnapshotFollower(config['snapshot_dir'], config.get('reload_interval', 1.0), on_load=publish_tree)
+        follower.poll()
+        follower.start()
+    startup.mark_ready() # the worker only starts serving below, by then it is ready
+
+    metrics.registry.add(metrics.Gauge('tree_playlists', 'Playlists in the tree.', lambda: recommendation_tree.size))
+    metrics.registry.add(metrics.Gauge('tree_snapshot_loads_total', 'Snapshots loaded by this query worker.', lambda: follower.loads, 'counter'))
+    if feature_cache is not None:
+        metrics.registry.add(metrics.Gauge('feature_cache_hits_total', 'Track feature cache hits.', lambda: feature_cache.stats()['hits'], 'counter'))
+        metrics.registry.add(metrics.Gauge('feature_cache_misses_total', 'Track feature cache misses.', lambda: feature_cache.stats()['misses'], 'counter'))
+
+    workers.serve(app_server, sock, config['url'], config['query_port'])
+
+
 #
 # Main function
 #
 
 def main():
-    global config, auth, recommendation_tree, pca_reducer
+    global config, auth, recommendation_tree, feature_cache, playlist_store, checkpointer, tree_writer, rebalancer, profiler, query_workers
     
-    config = load_config()['server']
+    parser = argparse.ArgumentParser(description='Playlist recommendation server.')
+    parser.add_argument('--conf', default='conf.json', help='Config file, the "server" section is used.')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='Overrides a key of the server section, e.g. --set port=8101 --set snapshot_dir=shards/s0')
+    args = parser.parse_args()
+
+    config = load_config(args.conf)['server']
+    config.update(parse_overrides(args.set))
 
     # start a thread we will use to kill the server when done
     kill_thread = threading.Thread(target=killer)
@@ -249,15 +776,112 @@ def main():
     server_thread = threading.Thread(target=flask_thread, args=(config['url'], config['port']))
     server_thread.start()
 
-    # spotify authorizer
-    auth = SpotifyAuth(f'http://{config["url"]}:{config["port"]}{config["callback"]}')
-    auth.authorize()
-
-    # load dimensionality reducer
-    pca_reducer = pk.load(open('pca_reduce.pkl', 'rb'))
-
-    # recommendation tree
-    recommendation_tree = init_tree()
-
-
-main() # get it done!
\ No newline at end of file
+    # the rest of the start runs while the port already answers /healthz, requests that need the tree wait for /readyz
+    metrics.registry.add(metrics.Gauge('server_ready', 'Whether the server has finished starting.', lambda: int(startup.is_ready())))
+
+    with startup.phase('auth'):
+        # spotify authorizer, the tokens are kept in "token_file" so a restart doesn't need the browser again
+        auth = SpotifyAuth(f'http://{config["url"]}:{config["port"]}{config["callback"]}', config.get('token_file', 'spotify_tokens.json'))
+        # shards started by server.router run with "authorize": false, their track features come from the shared cache
+        # and they pick up the tokens the router keeps fresh in the same file
+        margin = config.get('token_refresh_margin', 300)
+        if config.get('authorize', True):
+            if not auth.has_tokens():
+                auth.authorize()
+            auth.start_refresher(margin)
+        else:
+            auth.start_refresher(margin / 2)
+
+        # pooled, rate limited connection to the api, e.g. {"workers": 8, "rate": 20} in conf.json
+        spotify_session.configure(auth, **config.get('spotify_session', {}))
+
+    with startup.phase('feature_cache'):
+        # local track feature store, tracks repeat a lot across playlists so most features never need the api
+        # "feature_cache_read_only": true when another process (e.g. the router of a sharded setup) writes the store
+        if config.get('feature_cache'):
+            feature_cache = FeatureCache(config['feature_cache'], hot_size=config.get('feature_cache_hot_size', 100000),
+                                         read_only=config.get('feature_cache_read_only', False))
+
+    with startup.phase('playlist_store'):
+        # packed copy of the 1 million playlist dataset, made with `python -m server.playlist_store <index dir> <store dir>`
+        # without one the .INDEX files in playlist_source are read instead
+        if config.get('playlist_store'):
+            playlist_store = PlaylistStore(config['playlist_store'])
+
+    with startup.phase('pca'):
+        # load dimensionality reducer
+        load_reducer()
+
+    with startup.phase('tree'):
+        # recommendation tree, restored from the latest snapshot if there is one
+        # e.g. "snapshot_dir": "snapshots/", "checkpoint_interval": 300 in conf.json
+        recommendation_tree = None
+        if config.get('snapshot_dir'):
+            recommendation_tree = tree_snapshot.load(config['snapshot_dir'])
+            if recommendation_tree is not None:
+                print(f'Restored tree with {recommendation_tree.size} playlists from {config["snapshot_dir"]}')
+        if recommendation_tree is None:
+            recommendation_tree = init_tree()
+            # what leaves keep of their playlist, e.g. "leaf_policy": "reservoir:64" or "summary" in conf.json
+            if config.get('leaf_policy'):
+                recommendation_tree.use_leaf_policy(parse_policy(config['leaf_policy']))
+
+        configure_tree(recommendation_tree)
+
+    with startup.phase('services'):
+        # fit new classifiers in worker processes, e.g. "fit_workers": 4 in conf.json
+        if config.get('fit_workers'):
+            recommendation_tree.use_fit_executor(ProcessPoolExecutor(max_workers=config['fit_workers']))
+
+        tree_writer = TreeWriter(recommendation_tree, lock=tree_lock).start()
+
+        # rebuild lopsided subtrees in the background, "rebalance_interval": 0 in conf.json turns it off
+        if config.get('rebalance_interval', 0):
+            rebalancer = Rebalancer(recommendation_tree, tree_writer, interval=config.get('rebalance_interval', 0)).start()
+
+        metrics.registry.add(metrics.Gauge('tree_playlists', 'Playlists in the tree.', lambda: recommendation_tree.size))
+        if recommendation_tree.fast_path is not None:
+            metrics.registry.add(metrics.Gauge('tree_fast_routes_total', 'Branch decisions made by centroid routing.', lambda: recommendation_tree.fast_routes, 'counter'))
+            metrics.registry.add(metrics.Gauge('tree_slow_routes_total', 'Branch decisions left to the classifier.', lambda: recommendation_tree.slow_routes, 'counter'))
+        if rebalancer is not None:
+            metrics.registry.add(metrics.Gauge('tree_unbalanced_subtrees', 'Subtrees waiting to be rebuilt.', lambda: len(recommendation_tree.unbalanced)))
+            metrics.registry.add(metrics.Gauge('tree_rebuilds_total', 'Subtrees rebuilt since start.', lambda: rebalancer.rebuilt, 'counter'))
+        if feature_cache is not None:
+            metrics.registry.add(metrics.Gauge('feature_cache_hits_total', 'Track feature cache hits.', lambda: feature_cache.stats()['hits'], 'counter'))
+            metrics.registry.add(metrics.Gauge('feature_cache_misses_total', 'Track feature cache misses.', lambda: feature_cache.stats()['misses'], 'counter'))
+
+        start_query_cache()
+
+        # opt in sampling profiler, e.g. "profile_interval": 0.01 in conf.json, results at /metrics/profile
+        if config.get('profile_interval'):
+            profiler = metrics.SamplingProfiler(interval=config['profile_interval']).start()
+
+        if config.get('snapshot_dir'):
+            checkpointer = tree_snapshot.Checkpointer(recommendation_tree, config['snapshot_dir'], config.get('checkpoint_interval', 300), lock=tree_lock.read)
+            checkpointer.start()
+
+    startup.mark_ready()
+    print(f'Ready {startup.ready_after:.2f} seconds after start: ' + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in startup.phases))
+
+    # read only query workers on a port of their own, e.g. "query_workers": 4, "query_port": 8081 in conf.json
+    # they serve the latest snapshot, so "checkpoint_interval" is how far behind the pushes their answers can be
+    if config.get('query_workers') and checkpointer is None:
+        print('Query workers serve snapshots of the tree, set "snapshot_dir" to start them.')
+    elif config.get('query_workers'):
+        if tree_snapshot.current_snapshot(config['snapshot_dir']) is None:
+            checkpointer.checkpoint()
+
+        # the workers get a copy of the tokens, so they start once they are loaded or the callback has delivered them
+        while not auth.bearer:
+            time.sleep(0.5)
+        query_socket = workers.listen(config['url'], config['query_port'])
+        query_workers = workers.start_workers(query_worker, config['query_workers'], (query_socket, config, auth))
+        print(f'Started {len(query_workers)} query workers on port {config["query_port"]}')
+
+    # the main thread stays until /kill/: once it returns, concurrent.futures refuses new work in every executor
+    # (the spotify session's threads, the fit workers) as if the interpreter were shutting down
+    kill_serv.wait()
+
+
+if __name__ == '__main__':
+    main() # get it done!
\ No newline at end of file
@@ -0,0 +1,58 @@
+"""Start-up phases of the server, for its liveness and readiness endpoints.
+
+The server listens right away, the slow parts of its start (spotify tokens, the feature cache, unpickling the PCA model
+and restoring the tree) then run one after another as named phases while `/healthz` already answers. Requests that need
+any of it get a 503 until every phase is done, `/readyz` reports the phase it is in and how long each one took.
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+
+class Startup():
+    """Times the phases of a start and flags when it is done.
+
+    Args:
+        started (float, optional): `time.perf_counter()` the start is counted from. Defaults to now.
+    """
+    def __init__(self, started=None):
+        self.started = time.perf_counter() if started is None else started
+        self.phases = [] # (name, seconds) of the finished phases, in order
+        self.current = None
+        self.error = None
+        self.ready = threading.Event()
+        self.ready_after = None # seconds from `started` until ready
+
+    @contextmanager
+    def phase(self, name):
+        self.current = name
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error = f'{name}: {e}'
+            raise
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+            self.current = None
+
+    def record(self, name, seconds):
+        """Adds a phase timed elsewhere, e.g. the imports that run before this object exists."""
+        self.phases.append((name, seconds))
+
+    def mark_ready(self):
+        self.ready_after = time.perf_counter() - self.started
+        self.ready.set()
+
+    def is_ready(self):
+        return self.ready.is_set()
+
+    def report(self):
+        return {
+            'ready': self.is_ready(),
+            'phase': self.current,
+            'error': self.error,
+            'uptime': time.perf_counter() - self.started,
+            'ready_after': self.ready_after,
+            'phases': [{'name': name, 'seconds': seconds} for name, seconds in self.phases]
+        }
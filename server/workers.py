@@ -0,0 +1,109 @@
+"""Read only query serving from several processes.
+
+A query holds the GIL for every predict on its way down the tree, so one server process tops out at one core. With
+query workers the server process stays the single writer: it applies every push and publishes the tree as a snapshot
+(treemodel/snapshot.py) with its Checkpointer. Each worker is a separate process that loads the latest snapshot with
+its leaves memory-mapped, so all of them share one copy of the leaf pages through the page cache, and swaps in the
+next snapshot once `CURRENT` moves to it. The workers accept connections on one listening socket opened by the server.
+"""
+import multiprocessing
+import threading
+import socket
+import time
+import os
+
+from werkzeug.serving import make_server
+
+import treemodel.snapshot as tree_snapshot
+
+
+class SnapshotFollower():
+    """Keeps the tree of the latest snapshot in `path` loaded, checking `CURRENT` every `interval` seconds.
+
+    Args:
+        path (str): Snapshot root directory the writer checkpoints to.
+        interval (float, optional): Seconds between checks. Defaults to 1.
+        on_load (callable, optional): on_load(tree) is called with every newly loaded tree, before `tree` points to it.
+    """
+    def __init__(self, path, interval=1.0, on_load=None):
+        self.path = path
+        self.interval = interval
+        self.on_load = on_load
+
+        self.name = None
+        self.tree = None
+        self.loads = 0
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def poll(self):
+        """Loads the latest snapshot if it isn't the one already loaded.
+
+        Returns:
+            bool: Whether a new tree was loaded.
+        """
+        name = tree_snapshot.current_snapshot(self.path)
+        if name is None or name == self.name:
+            return False
+
+        tree = tree_snapshot.load(self.path, name=name)
+        if self.on_load is not None:
+            self.on_load(tree)
+        # queries that already picked up the old tree finish on it, the mapped files stay valid even once deleted
+        self.tree = tree
+        self.name = name
+        self.loads += 1
+        return True
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                # the writer only keeps the last few snapshots, one can be gone before it is read; the next check finds a newer one
+                print(f'Snapshot reload failed: {e}')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def listen(host, port, backlog=128):
+    """Listening socket for the workers to share, opened once in the server process."""
+    return socket.create_server((host, port), backlog=backlog)
+
+
+def start_workers(target, num_workers, args=()):
+    """Starts `num_workers` processes running target(*args).
+
+    They are spawned rather than forked, since the server process already runs threads (Flask, the tree writer, ...) and
+    a forked child would inherit whatever locks those held. Sockets in `args` reach the children as duplicated descriptors.
+
+    Returns:
+        list: The started multiprocessing.Process objects.
+    """
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=target, args=args, daemon=True) for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def serve(app, sock, host, port):
+    """Serves a WSGI app on the shared socket until the process that started this one goes away."""
+    parent = os.getppid()
+
+    def watch_parent():
+        # the server ends itself with SIGTERM, which doesn't take daemon processes down with it
+        while os.getppid() == parent:
+            time.sleep(1.0)
+        os._exit(0)
+
+    threading.Thread(target=watch_parent, daemon=True).start()
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    server.serve_forever()
@@ -1,237 +1,207 @@
-import requests
 import pprint
 import json
-import time
 
-def get_user_profile(user_id, authorizer, verbose=False):
+from spotifyapi.session import default_session
+
+
+def _session(authorizer, session):
+    return session if session is not None else default_session(authorizer)
+
+
+def _error(response, verbose):
+    print('Error %d' % response.status_code)
+    if verbose:
+        print(json.loads(response.text))
+
+
+def get_user_profile(user_id, authorizer, verbose=False, session=None):
     """ Gets the specified user profile.
 
     Args:
         user_id (str): Username of Spotify user.
         authorizer (SpotifyAuth): Spotify API Authorization module.
         verbose (bool, optional): More detailed logs. Defaults to False.
+        session (SpotifySession, optional): Pooled API session. Defaults to the shared session of `authorizer`.
 
     Returns:
         [dict, None]: Returns the user profile in dictionary of JSON format as returned by the server. Returns None if request failed.
     """
-    while(True): # need to add loop incase of rate limiting, otherwise it shouldn't really be necessary
-        spotify_endpoint = 'https://api.spotify.com/v1/users/{user_id}'
+    response = _session(authorizer, session).get(f'/users/{user_id}')
 
-        headers = {"Accept":"application/json", "Content-Type":"application/json", "Authorization": "Bearer {bearer}".format(bearer=authorizer.bearer)}
-        response = requests.get(spotify_endpoint.format(user_id=user_id), headers=headers)
-        
-        if response.status_code == 200:
-            return response.json()
-        elif response.status_code == 429:
-            limit = int(response.headers['Retry-After'])
-            print('Hit rate limit, waiting for {} seconds to continue'.format(limit))
-            time.sleep(limit)
-        elif response.status_code == 404:
-            print('Error. User {user_id} not found.'.format(user_id=user_id))
-            return None
-        elif response.status_code == 401:
-            print('Access token expired, refreshing...')
-            authorizer.refresh()
-            headers = {"Accept":"application/json", "Content-Type":"application/json", "Authorization": "Bearer {bearer}".format(bearer=authorizer.bearer)}
-        else:
-            print('Error %d' % response.status_code)
-            if verbose:
-                print(json.loads(response.text)['error']['message'])
-            return None
+    if response.status_code == 200:
+        return response.json()
+    elif response.status_code == 404:
+        print('Error. User {user_id} not found.'.format(user_id=user_id))
+        return None
+    else:
+        _error(response, verbose)
+        return None
 
 
-def get_user_playlists(user_id, authorizer, verbose=False):
+def get_user_playlists(user_id, authorizer, verbose=False, session=None):
     """ Gets all public playlists from a user.
 
     Args:
         user_id (str): Username of Spotify user.
         authorizer (SpotifyAuth): Spotify API Authorization module.
         verbose (bool, optional): More detailed logs. Defaults to False.
+        session (SpotifySession, optional): Pooled API session. Defaults to the shared session of `authorizer`.
 
     Returns:
         [dict, None]: Dictionary containing all of the users public playlists where each subdictionary is in JSON format as returned by the server. Returns None if request failed.
     """
-    spotify_endpoint = 'https://api.spotify.com/v1/users/{user_id}/playlists'
+    session = _session(authorizer, session)
+    spotify_endpoint = f'/users/{user_id}/playlists'
+    limit = 50
 
     # there's a limit to the number of playlists that can be downloaded at a time
-    # keep downloading playlists until we run out (next = null)
-    playlists = {'items':None} 
-    while True:
-        params = {'limit': 50}
-        headers = {"Accept":"application/json", "Content-Type":"application/json", "Authorization": "Bearer {bearer}".format(bearer=authorizer.bearer)}
-        response = requests.get(spotify_endpoint.format(user_id=user_id), headers=headers, params=params)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if playlists['items'] is None:
-                playlists['items'] = data['items']
-            else:
-                playlists['items'] += data['items']
-            
-            if data['next'] is None:
-                return playlists ## look here for how we get out! ##
-            else:
-                spotify_endpoint = data['next']
-        elif response.status_code == 429:
-            limit = int(response.headers['Retry-After'])
-            print('Hit rate limit, waiting for {} seconds to continue'.format(limit))
-            time.sleep(limit)
-        elif response.status_code == 404:
-            print('Error. User {user_id} not found.'.format(user_id=user_id))
-            return None
-        elif response.status_code == 401:
-            print('Access token expired, refreshing...')
-            authorizer.refresh()
-            headers = {"Accept":"application/json", "Content-Type":"application/json", "Authorization": "Bearer {bearer}".format(bearer=authorizer.bearer)}
-        else:
-            print('Error %d' % response.status_code)
-            if verbose:
-                print(json.loads(response.text)['error']['message'])
+    # the first page tells us the total, the rest of the pages are then requested all at once
+    response = session.get(spotify_endpoint, params={'limit': limit})
+    if response.status_code == 404:
+        print('Error. User {user_id} not found.'.format(user_id=user_id))
+        return None
+    elif response.status_code != 200:
+        _error(response, verbose)
+        return None
+
+    data = response.json()
+    playlists = {'items': data['items']}
+
+    pages = [(spotify_endpoint, {'limit': limit, 'offset': offset}) for offset in range(limit, data['total'], limit)]
+    for response in session.get_many(pages):
+        if response.status_code != 200:
+            _error(response, verbose)
             return None
+        playlists['items'] += response.json()['items']
 
+    return playlists
 
-def track_indexes(track_out, authorizer, verbose=False):
+
+def track_indexes(track_out, authorizer, verbose=False, session=None):
     """ Returns a list of all of the track ID's for a given playlist.
 
     Args:
         track_out (str): Track GET URL. Found in a playlist's `tracks` field.
         authorizer (SpotifyAuth): Spotify API Authorization module.
         verbose (bool, optional): More detailed logs. Defaults to False.
+        session (SpotifySession, optional): Pooled API session. Defaults to the shared session of `authorizer`.
 
     Returns:
         [list, None]: Returns a list of all of the track ID's for a given playlist that are not None. Returns None if the request failed.
     """
+    session = _session(authorizer, session)
     href = track_out['href']
-    track_ids = [''] * track_out['total']
-
-    index = 0
+    limit = 100
 
-    while href is not None:
-        headers = {"Accept":"application/json", "Content-Type":"application/json", "Authorization": "Bearer {bearer}".format(bearer=authorizer.bearer)}
-        response = requests.get(href, headers=headers)
+    # we already know the total, so every page can be requested at once
+    pages = [(href, {'limit': limit, 'offset': offset}) for offset in range(0, track_out['total'], limit)]
 
+    track_ids = []
+    for response in session.get_many(pages):
         if response.status_code == 200:
-            tracks = response.json()
-            for track in tracks['items']:
+            for track in response.json()['items']:
                 if track is None or track['track'] is None:
                     continue
-                track_ids[index] = track['track']['id']
-                #track_ids.append(ntrack)
-                index += 1
-            href = tracks['next']
-        elif response.status_code == 429:
-            limit = int(response.headers['Retry-After'])
-            print('Hit rate limit, waiting for {} seconds to continue'.format(limit))
-            time.sleep(limit)
+                track_ids.append(track['track']['id'])
         elif response.status_code == 404:
             if verbose:
                 print('Warning {}: Problem with getting tracks from playlists, verify url {} is correct.'.format(response.status_code, href))
             return None
-        elif response.status_code == 401:
-            print('Access token expired, refreshing...')
-            authorizer.refresh()
-            headers = {"Accept":"application/json", "Content-Type":"application/json", "Authorization": "Bearer {bearer}".format(bearer=authorizer.bearer)}
         else:
-            print('Error %d' % response.status_code)
-            if verbose:
-                print(json.loads(response.text)['error']['message'])
+            _error(response, verbose)
             return None
 
     return [x for x in track_ids if x is not None] # filters out None values that can sometimes occur
 
 
-def track_features(tracks, authorizer, verbose=False):
+def track_features(tracks, authorizer, verbose=False, cache=None, session=None):
     """ Returns the features for given Spotify tracks.
 
     Args:
         tracks (list): List of Spotify track ID's
         authorizer (SpotifyAuth): Spotify API Authorization module.
         verbose (bool, optional): More detailed logs. Defaults to False.
+        cache (FeatureCache, optional): Local feature store checked before the API, only the misses are requested and then stored. Defaults to None.
+        session (SpotifySession, optional): Pooled API session. Defaults to the shared session of `authorizer`.
 
     Returns:
         [zip, None]: Returns a zip object of a `track_id` and its associated `track_features`. Returns None if request failed.
     """
-    spotify_endpoint = 'https://api.spotify.com/v1/audio-features'
-    headers = {"Accept":"application/json", "Content-Type":"application/json", "Authorization": "Bearer {bearer}".format(bearer=authorizer.bearer)}
+    if cache is None:
+        return fetch_track_features(tracks, authorizer, verbose, session)
 
-    remainder = len(tracks)
-    offset = 0
-    stride = 100
-    features = []
-    while remainder > 0:
-        params = {'ids': ','.join(tracks[offset:offset + stride])} # spotify can only process 100 tracks at a time
+    found, misses = cache.lookup(tracks)
+    if misses:
+        fetched = fetch_track_features(misses, authorizer, verbose, session)
+        if fetched is None:
+            return None
+        fetched = list(fetched)
+        cache.store(fetched)
+        found.update(fetched)
 
-        response = requests.get(spotify_endpoint, params=params, headers=headers)
+    return zip(tracks, [found[t] for t in tracks])
 
-        if response.status_code == 200:
-            features += response.json()['audio_features']
-            offset += stride
-            remainder -= stride
-        elif response.status_code == 429:
-            limit = int(response.headers['Retry-After'])
-            print('Hit rate limit, waiting for {} seconds to continue'.format(limit))
-            time.sleep(limit)
-        elif response.status_code == 401:
-            print('Access token expired, refreshing...')
-            authorizer.refresh()
-            headers = {"Accept":"application/json", "Content-Type":"application/json", "Authorization": "Bearer {bearer}".format(bearer=authorizer.bearer)}
-        else:
-            print('Error %d' % response.status_code)
-            if verbose:
-                print(json.loads(response.text))
+
+def fetch_track_features(tracks, authorizer, verbose=False, session=None):
+    """ Requests the features for given Spotify tracks from the API, 100 at a time with all chunks in flight at once.
+
+    Args:
+        tracks (list): List of Spotify track ID's
+        authorizer (SpotifyAuth): Spotify API Authorization module.
+        verbose (bool, optional): More detailed logs. Defaults to False.
+        session (SpotifySession, optional): Pooled API session. Defaults to the shared session of `authorizer`.
+
+    Returns:
+        [zip, None]: Returns a zip object of a `track_id` and its associated `track_features`. Returns None if request failed.
+    """
+    session = _session(authorizer, session)
+    stride = 100 # spotify can only process 100 tracks at a time
+
+    chunks = [('/audio-features', {'ids': ','.join(tracks[offset:offset + stride])}) for offset in range(0, len(tracks), stride)]
+
+    features = []
+    for response in session.get_many(chunks):
+        if response.status_code != 200:
+            _error(response, verbose)
             return None
+        features += response.json()['audio_features']
 
     return zip(tracks, features)
 
 
-def playlist_track_ids(playlist_id, authorizer, verbose=False):
+def playlist_track_ids(playlist_id, authorizer, verbose=False, session=None):
     """ Gets all track id's of a given playlist.
 
     Args:
         playlist_id (str): Playlist id.
         authorizer ([type]): Spotify API Authorization module.
         verbose (bool, optional): More detailed logs. Defaults to False.
+        session (SpotifySession, optional): Pooled API session. Defaults to the shared session of `authorizer`.
 
     Returns:
         [list, None]: Returns a list of all non-None track ID's in the playlist. Returns None if request failed.
     """
-    spotify_endpoint = f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks'
-    params = {'fields':'items(track(id)),next,total'} # only get id's of tracks, and total number of tracks in playlist
-    headers = {"Accept":"application/json", "Content-Type":"application/json", "Authorization": "Bearer {bearer}".format(bearer=authorizer.bearer)}
-
-    tracks = None
-    index = 0
-    
-    # stops when no more pages left
-    while spotify_endpoint:
-        response = requests.get(spotify_endpoint, params=params, headers=headers)
-
-        if response.status_code == 200:
-            data = response.json()
-            
-            # allocate array for tracks
-            if tracks is None:
-                tracks = [''] * data['total']
-            
-            # add tracks to array
-            for track in data['items']:
-                i = track['track']['id']
-                tracks[index] = i
-                index += 1
-
-            # move forward in paging
-            spotify_endpoint = data['next']
-        elif response.status_code == 429:
-            limit = int(response.headers['Retry-After'])
-            print('Hit rate limit, waiting for {} seconds to continue'.format(limit))
-            time.sleep(limit)
-        elif response.status_code == 401:
-            print('Access token expired, refreshing...')
-            authorizer.refresh()
-        else:
-            print('Error %d' % response.status_code)
-            if verbose:
-                print(json.loads(response.text))
+    session = _session(authorizer, session)
+    spotify_endpoint = f'/playlists/{playlist_id}/tracks'
+    fields = 'items(track(id)),next,total' # only get id's of tracks, and total number of tracks in playlist
+    limit = 100
+
+    # the first page tells us how many tracks there are, the remaining pages are then requested all at once
+    response = session.get(spotify_endpoint, params={'fields': fields, 'limit': limit})
+    if response.status_code != 200:
+        _error(response, verbose)
+        return None
+
+    data = response.json()
+    pages = [data]
+
+    rest = [(spotify_endpoint, {'fields': fields, 'limit': limit, 'offset': offset}) for offset in range(limit, data['total'], limit)]
+    for response in session.get_many(rest):
+        if response.status_code != 200:
+            _error(response, verbose)
             return None
+        pages.append(response.json())
+
+    tracks = [track['track']['id'] for page in pages for track in page['items'] if track['track'] is not None]
 
-    return [t for t in tracks if t is not None] # filter out null tracks
\ No newline at end of file
+    return [t for t in tracks if t is not None] # filter out null tracks
@@ -1,23 +1,89 @@
 import requests
+import threading
 import json
 import random
 import webbrowser
 import base64
+import time
+import os
 
 class SpotifyAuth():
-    def __init__(self, redirect):
+    """Spotify API tokens of the server.
+
+    With a `token_path` the tokens are written there whenever they change and read back on start, so a restart only
+    needs the browser if there are no tokens yet (see `has_tokens`). `start_refresher` renews the access token in the
+    background `margin` seconds before it expires. A refresh that still has to happen (a 401) is single flight: callers
+    pass the token that was turned down, and the ones that come in while a refresh is running wait for it and use its
+    token instead of refreshing again. The same goes across processes sharing the token file.
+
+    Args:
+        redirect (str): Redirect uri of the authorization callback.
+        token_path (str, optional): File to keep the tokens in. Defaults to None, tokens are only kept in memory.
+    """
+    def __init__(self, redirect, token_path=None):
         f = open('tokens.jsonc', mode='r+')
         tkn = json.load(f)
 
         self.authorization_token = ''
         self.bearer = ''
         self.refresh_token = ''
+        self.expires_at = 0.0 # unix time the bearer runs out
 
         self.client_id = tkn['client_id']
         self.client_secret = tkn['client_secret']
 
         self.redirect = redirect
-    
+        self.token_path = token_path
+
+        self.refresh_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        if token_path is not None:
+            self.load()
+
+    def __getstate__(self):
+        # handed to worker processes without the locks and the refresher thread
+        state = self.__dict__.copy()
+        for key in ('refresh_lock', 'stop_event', 'thread'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.refresh_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+
+    def has_tokens(self):
+        return bool(self.refresh_token)
+
+
+    def load(self):
+        """Reads the tokens from `token_path`, returns False if there are none."""
+        try:
+            f = open(self.token_path, 'r')
+            tokens = json.load(f)
+            f.close()
+        except (OSError, ValueError):
+            return False
+
+        self.bearer = tokens['access_token']
+        self.refresh_token = tokens['refresh_token']
+        self.expires_at = tokens['expires_at']
+        return True
+
+
+    def save(self):
+        if self.token_path is None:
+            return
+        tmp = self.token_path + '.tmp'
+        f = open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w')
+        json.dump({'access_token': self.bearer, 'refresh_token': self.refresh_token, 'expires_at': self.expires_at}, f)
+        f.close()
+        os.replace(tmp, self.token_path)
+
 
     def generate_rand_string(self, length):
         return ''.join(random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789', k=length))
@@ -31,14 +97,14 @@ class SpotifyAuth():
                     'redirect_uri':self.redirect,
                     'state':state,
                     'scope':' '.join(scope)}
-        
+
         response = requests.get(spotify_endpoint, params=params)
 
         if response.status_code == 200:
             webbrowser.open(response.url, new=2)
         else:
             print('Authorization Error {code}'.format(code=response.status_code))
-    
+
 
     def get_tokens(self, auth_code):
         spotify_endpoint = 'https://accounts.spotify.com/api/token'
@@ -50,24 +116,78 @@ class SpotifyAuth():
         response = requests.post(spotify_endpoint, params=params, headers=headers)
 
         if response.status_code == 200:
-            self.bearer = response.json()['access_token']
-            self.refresh_token = response.json()['refresh_token']
+            with self.refresh_lock:
+                self.refresh_token = response.json()['refresh_token']
+                self.expires_at = time.time() + response.json().get('expires_in', 3600)
+                self.bearer = response.json()['access_token']
+                self.save()
         else:
            print(response.text)
            return 'Error.'
-    
-    
-    def refresh(self):
-        spotify_endpoint = 'https://accounts.spotify.com/api/token'
-        params = {  'grant_type':'refresh_token',
-                    'refresh_token':self.refresh_token}
-        enc = base64.b64encode(("{}:{}".format(self.client_id, self.client_secret)).encode())
-        headers = {"Authorization": "Basic {}".format(enc.decode()), "Content-Type": "application/x-www-form-urlencoded"}
-        response = requests.post(spotify_endpoint, params=params, headers=headers)
-        
-        if response.status_code == 200:
-            self.bearer = response.json()['access_token']
-            print('Refreshed Token...')
-        else:
-           print(response.text)
-           return None
\ No newline at end of file
+
+
+    def refresh(self, stale=None):
+        """Swaps the refresh token for a new access token.
+
+        Args:
+            stale (str, optional): The access token the caller saw turned down. If it has been replaced already, by a
+                refresh in another thread or another process sharing the token file, that one is used and nothing is
+                asked from spotify. Defaults to None, always refresh.
+
+        Returns:
+            [str, None]: The access token, None if the refresh failed.
+        """
+        with self.refresh_lock:
+            if stale is not None and self.bearer != stale:
+                return self.bearer
+            if stale is not None and self.token_path is not None and self.load() and self.bearer != stale:
+                return self.bearer
+
+            spotify_endpoint = 'https://accounts.spotify.com/api/token'
+            params = {  'grant_type':'refresh_token',
+                        'refresh_token':self.refresh_token}
+            enc = base64.b64encode(("{}:{}".format(self.client_id, self.client_secret)).encode())
+            headers = {"Authorization": "Basic {}".format(enc.decode()), "Content-Type": "application/x-www-form-urlencoded"}
+            try:
+                response = requests.post(spotify_endpoint, params=params, headers=headers, timeout=30)
+            except requests.RequestException as e:
+                print(f'Token refresh failed: {e}')
+                return None
+
+            if response.status_code == 200:
+                tokens = response.json()
+                # spotify may hand out a new refresh token along with the access token
+                self.refresh_token = tokens.get('refresh_token', self.refresh_token)
+                self.expires_at = time.time() + tokens.get('expires_in', 3600)
+                self.bearer = tokens['access_token']
+                self.save()
+                print('Refreshed Token...')
+                return self.bearer
+            else:
+               print(response.text)
+               return None
+
+
+    def run_refresher(self, margin, retry):
+        while True:
+            if not self.refresh_token:
+                wait = 1.0 # no tokens until the authorization callback
+            else:
+                wait = max(self.expires_at - margin - time.time(), 0.0)
+            if self.stop_event.wait(wait):
+                return
+
+            if self.refresh_token and time.time() >= self.expires_at - margin:
+                if self.refresh(stale=self.bearer) is None and self.stop_event.wait(retry):
+                    return
+
+
+    def start_refresher(self, margin=300.0, retry=30.0):
+        """Refreshes the access token in a background thread `margin` seconds before it expires, `retry` seconds apart while that fails."""
+        self.thread = threading.Thread(target=self.run_refresher, args=(margin, retry), daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop_refresher(self):
+        self.stop_event.set()
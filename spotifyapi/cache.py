@@ -0,0 +1,228 @@
+import numpy as np
+import threading
+import os
+from collections import OrderedDict
+
+# numeric audio features in the order spotify returns them, one float64 column each
+FEATURE_COLUMNS = ['danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness', 'acousticness',
+                   'instrumentalness', 'liveness', 'valence', 'tempo', 'duration_ms', 'time_signature']
+INT_COLUMNS = {'key', 'mode', 'duration_ms', 'time_signature'}
+
+
+def features_to_row(features):
+    """Packs a spotify audio features dict into a fixed width float row. A `None` feature (track without analysis) becomes a row of NaN."""
+    if features is None:
+        return np.full(len(FEATURE_COLUMNS), np.nan)
+    return np.array([features[c] for c in FEATURE_COLUMNS], dtype=np.float64)
+
+
+def row_to_features(track_id, row):
+    """Rebuilds the audio features dict as spotify would have returned it, `None` for a NaN row."""
+    if np.isnan(row[0]):
+        return None
+
+    values = {c: (int(v) if c in INT_COLUMNS else float(v)) for c, v in zip(FEATURE_COLUMNS, row)}
+    # keep the key order of the api response, the numeric columns end up in the same order in the dataframe
+    features = {c: values[c] for c in FEATURE_COLUMNS[:11]}
+    features['type'] = 'audio_features'
+    features['id'] = track_id
+    features['uri'] = f'spotify:track:{track_id}'
+    features['track_href'] = f'https://api.spotify.com/v1/tracks/{track_id}'
+    features['analysis_url'] = f'https://api.spotify.com/v1/audio-analysis/{track_id}'
+    features['duration_ms'] = values['duration_ms']
+    features['time_signature'] = values['time_signature']
+    return features
+
+
+class FeatureCache():
+    """On disk store of track audio features with an in memory LRU hot tier.
+
+    The store is two append only files in `path`: `ids.txt` with one track id per line, and `features.f8`
+    with one row of float64's per track in the same order. The feature file is memory-mapped for reads.
+
+    Args:
+        path (str): Directory holding the store, created if it does not exist.
+        hot_size (int, optional): Max number of tracks kept decoded in memory. Defaults to 100000.
+        read_only (bool, optional): Never write the store, for processes sharing it with the one that does. Fetched
+            features only go to the hot tier, and `refresh` picks up tracks the writing process stored since. Defaults to False.
+    """
+    def __init__(self, path, hot_size=100000, read_only=False):
+        os.makedirs(path, exist_ok=True)
+        self.id_path = os.path.join(path, 'ids.txt')
+        self.feature_path = os.path.join(path, 'features.f8')
+        self.hot_size = hot_size
+        self.read_only = read_only
+        self.id_offset = 0 # bytes of ids.txt read so far, read only caches only
+
+        self.lock = threading.Lock()
+        self.hot = OrderedDict()
+        self.rows = {}
+        self.mapped = None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._load()
+
+    def _load(self):
+        if self.read_only:
+            self.refresh()
+            return
+
+        track_ids = []
+        if os.path.exists(self.id_path):
+            f = open(self.id_path, 'r')
+            track_ids = [t.strip() for t in f.readlines()]
+            f.close()
+
+        row_bytes = len(FEATURE_COLUMNS) * 8
+        num_rows = os.path.getsize(self.feature_path) // row_bytes if os.path.exists(self.feature_path) else 0
+
+        # a crash between the two appends can leave the files out of step, drop the partial entry
+        n = min(len(track_ids), num_rows)
+        if n != len(track_ids) or n != num_rows:
+            f = open(self.id_path, 'w')
+            f.writelines(t + '\n' for t in track_ids[:n])
+            f.close()
+            f = open(self.feature_path, 'ab')
+            f.truncate(n * row_bytes)
+            f.close()
+
+        self.rows = {t: i for i, t in enumerate(track_ids[:n])}
+        self.id_file = open(self.id_path, 'a')
+        self.feature_file = open(self.feature_path, 'ab')
+        self._remap()
+
+    def refresh(self):
+        """Reads the tracks appended to the store since it was last read, for read only caches.
+
+        Returns:
+            int: Number of tracks picked up.
+        """
+        row_bytes = len(FEATURE_COLUMNS) * 8
+        num_rows = os.path.getsize(self.feature_path) // row_bytes if os.path.exists(self.feature_path) else 0
+        if not os.path.exists(self.id_path):
+            return 0
+
+        with self.lock:
+            f = open(self.id_path, 'rb')
+            f.seek(self.id_offset)
+            appended = f.read()
+            f.close()
+
+            # the writer flushes a feature row before its id, so every complete id line within num_rows has its row on disk
+            added = 0
+            for line in appended[:appended.rfind(b'\n') + 1].splitlines(keepends=True):
+                if len(self.rows) >= num_rows:
+                    break
+                self.rows[line.decode().strip()] = len(self.rows)
+                self.id_offset += len(line)
+                added += 1
+            if added or self.mapped is None:
+                self._remap()
+        return added
+
+    def _remap(self):
+        n = len(self.rows)
+        self.mapped = np.memmap(self.feature_path, dtype=np.float64, mode='r', shape=(n, len(FEATURE_COLUMNS))) if n > 0 else None
+
+    def _touch(self, track_id, features):
+        self.hot[track_id] = features
+        self.hot.move_to_end(track_id)
+        if len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+
+    def lookup(self, track_ids):
+        """Looks up track features. Every unique track id counts once in the stats, as a hit or as a miss.
+
+        Returns:
+            [tuple]: (found, misses) where `found` is a dict of track id to features (None for tracks spotify has no features for) and `misses` is the list of unique track ids not in the store.
+        """
+        found, misses = self._lookup(dict.fromkeys(track_ids))
+        if misses and self.read_only and self.refresh():
+            # the writing process may have stored them since the last refresh
+            more, misses = self._lookup(misses)
+            found.update(more)
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(misses)
+        return found, misses
+
+    def _lookup(self, track_ids):
+        # `track_ids` without repeats
+        found = {}
+        misses = []
+        with self.lock:
+            for t in track_ids:
+                if t in self.hot:
+                    self.hot.move_to_end(t)
+                    found[t] = self.hot[t]
+                elif t in self.rows:
+                    if self.mapped is None or self.rows[t] >= self.mapped.shape[0]:
+                        self.feature_file.flush()
+                        self._remap()
+                    features = row_to_features(t, self.mapped[self.rows[t]])
+                    self._touch(t, features)
+                    found[t] = features
+                    self.disk_hits += 1
+                else:
+                    misses.append(t)
+
+        return found, misses
+
+    def feature_rows(self, track_ids):
+        """Stored feature rows of tracks as one array, straight from the memory map without decoding.
+
+        Tracks that are not in the store or that spotify has no features for are left out. Doesn't go through the hot
+        tier or count as lookups, it is meant for offline bulk reads.
+
+        Returns:
+            numpy.ndarray: One float64 row per track, columns in the order of FEATURE_COLUMNS.
+        """
+        with self.lock:
+            indexes = [self.rows[t] for t in track_ids if t in self.rows]
+            if not indexes:
+                return np.zeros((0, len(FEATURE_COLUMNS)))
+            if self.mapped is None or max(indexes) >= self.mapped.shape[0]:
+                self.feature_file.flush()
+                self._remap()
+            X = self.mapped[indexes]
+        return X[~np.isnan(X[:, 0])]
+
+    def store(self, track_features):
+        """Adds (track id, features) pairs to the store, tracks already stored are skipped."""
+        with self.lock:
+            if self.read_only:
+                for t, features in track_features:
+                    self._touch(t, row_to_features(t, features_to_row(features)))
+                return
+
+            for t, features in track_features:
+                if t in self.rows:
+                    continue
+                self.feature_file.write(features_to_row(features).tobytes())
+                self.id_file.write(t + '\n')
+                self.rows[t] = len(self.rows)
+                self._touch(t, row_to_features(t, features_to_row(features)))
+            self.feature_file.flush()
+            self.id_file.flush()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'stored': len(self.rows),
+                'hot': len(self.hot)
+            }
+
+    def close(self):
+        with self.lock:
+            if not self.read_only:
+                self.id_file.close()
+                self.feature_file.close()
+            self.mapped = None
@@ -0,0 +1,143 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import threading
+import random
+import json
+import time
+
+from spotifyapi.cache import FEATURE_COLUMNS
+
+
+def fake_features(track_id):
+    """Deterministic made up audio features for a track id."""
+    rng = random.Random(track_id)
+    features = {c: rng.random() for c in FEATURE_COLUMNS[:11]}
+    features['key'] = rng.randrange(12)
+    features['mode'] = rng.randrange(2)
+    features['loudness'] = -60 * rng.random()
+    features['tempo'] = 60 + 140 * rng.random()
+    features.update({'type': 'audio_features', 'id': track_id, 'uri': f'spotify:track:{track_id}',
+                     'track_href': '', 'analysis_url': '', 'duration_ms': rng.randrange(60000, 400000), 'time_signature': 4})
+    return features
+
+
+class FakeSpotify():
+    """Local stand-in for the parts of the Spotify Web API used by `spotifyapi.api`.
+
+    Serves `/v1/audio-features`, `/v1/playlists/<id>/tracks`, `/v1/users/<id>` and `/v1/users/<id>/playlists` with made up data.
+    Every response is delayed by `latency` seconds, and every `rate_limit_every`-th request is answered with a 429.
+
+    Args:
+        playlists (dict, optional): Playlist id to list of track ids.
+        latency (float, optional): Seconds added to every response. Defaults to 0.
+        rate_limit_every (int, optional): Answer every n-th request with a 429, 0 never does. Defaults to 0.
+        retry_after (int, optional): Retry-After sent with a 429. Defaults to 1.
+        port (int, optional): Port to listen on, 0 picks a free one. Defaults to 0.
+    """
+    def __init__(self, playlists=None, latency=0.0, rate_limit_every=0, retry_after=1, port=0):
+        self.playlists = playlists or {}
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}/v1'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reply(self, handler, status, body=None, headers=None):
+        handler.send_response(status)
+        for k, v in (headers or {}).items():
+            handler.send_header(k, v)
+        data = json.dumps(body if body is not None else {'error': {'status': status, 'message': 'fake'}}).encode()
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def page(self, path, items, params):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+        nxt = f'{self.url}{path}?offset={offset + limit}&limit={limit}' if offset + limit < len(items) else None
+        return {'items': items[offset:offset + limit], 'total': len(items), 'next': nxt}
+
+    def handle(self, handler):
+        with self.lock:
+            self.requests += 1
+            n = self.requests
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.rate_limit_every and n % self.rate_limit_every == 0:
+            return self.reply(handler, 429, headers={'Retry-After': str(self.retry_after)})
+
+        parsed = urlparse(handler.path)
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        path = parsed.path[len('/v1'):] if parsed.path.startswith('/v1') else parsed.path
+        parts = [p for p in path.split('/') if p]
+
+        if parts == ['audio-features']:
+            ids = params.get('ids', '').split(',')
+            if len(ids) > 100:
+                return self.reply(handler, 400)
+            return self.reply(handler, 200, {'audio_features': [fake_features(t) for t in ids]})
+        elif len(parts) == 3 and parts[0] == 'playlists' and parts[2] == 'tracks':
+            if parts[1] not in self.playlists:
+                return self.reply(handler, 404)
+            items = [{'track': {'id': t}} for t in self.playlists[parts[1]]]
+            return self.reply(handler, 200, self.page(path, items, params))
+        elif len(parts) == 2 and parts[0] == 'users':
+            return self.reply(handler, 200, {'id': parts[1], 'display_name': parts[1]})
+        elif len(parts) == 3 and parts[0] == 'users' and parts[2] == 'playlists':
+            items = [{'id': p, 'tracks': {'href': f'{self.url}/playlists/{p}/tracks', 'total': len(t)}} for p, t in self.playlists.items()]
+            return self.reply(handler, 200, self.page(path, items, params))
+
+        return self.reply(handler, 404)
+
+
+if __name__ == '__main__':
+    # rough latency check, features for a 500 track playlist with 50ms per request
+    from spotifyapi.session import SpotifySession
+    import spotifyapi.api as spotify_api
+
+    class FakeAuth():
+        bearer = 'fake'
+        def refresh(self, stale=None):
+            pass
+
+    tracks = [f'track{i}' for i in range(500)]
+    fake = FakeSpotify(playlists={'p': tracks}, latency=0.05).start()
+
+    for workers in (1, 8):
+        session = SpotifySession(FakeAuth(), base_url=fake.url, workers=workers)
+        start = time.time()
+        track_ids = spotify_api.playlist_track_ids('p', None, session=session)
+        features = list(spotify_api.track_features(track_ids, None, session=session))
+        print(f'workers={workers}: {len(features)} tracks in {time.time() - start:.3f}s')
+        session.close()
+
+    fake.stop()
@@ -0,0 +1,144 @@
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+SPOTIFY_API = 'https://api.spotify.com/v1'
+
+
+class RateLimiter():
+    """Token bucket shared by every request going through a SpotifySession.
+
+    Requests take a token before they are sent, tokens refill at `rate` per second up to `burst`. A 429 pauses the whole bucket
+    until its Retry-After has passed, so every in-flight thread backs off together instead of each one finding out on its own.
+
+    Args:
+        rate (float): Tokens added per second.
+        burst (int): Max tokens held at once.
+    """
+    def __init__(self, rate=20.0, burst=20):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.resume_at:
+                    wait = self.resume_at - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                    self.last = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            resume_at = time.monotonic() + seconds
+            if resume_at > self.resume_at:
+                self.resume_at = resume_at
+                # nothing was sent while paused, start again with an empty bucket so we don't burst straight back into the limit
+                self.tokens = 0.0
+                self.last = resume_at
+
+
+class SpotifySession():
+    """Connection pooled, rate limited access to the Spotify Web API.
+
+    Args:
+        authorizer (SpotifyAuth): Spotify API Authorization module.
+        base_url (str, optional): API root, point it at a local fake server for testing. Defaults to the Spotify Web API.
+        workers (int, optional): Number of requests allowed in flight at once. Defaults to 8.
+        rate (float, optional): Requests per second allowed by the shared rate limiter. Defaults to 20.
+        burst (int, optional): Burst size of the shared rate limiter. Defaults to 20.
+    """
+    def __init__(self, authorizer, base_url=SPOTIFY_API, workers=8, rate=20.0, burst=20):
+        self.authorizer = authorizer
+        self.base_url = base_url.rstrip('/')
+        self.limiter = RateLimiter(rate, burst)
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def headers(self, bearer):
+        return {"Accept":"application/json", "Content-Type":"application/json", "Authorization": "Bearer {bearer}".format(bearer=bearer)}
+
+    def get(self, url, params=None):
+        """GET against the API, waiting out rate limits and refreshing expired tokens.
+
+        Args:
+            url (str): Full url, or a path relative to `base_url`.
+            params (dict, optional): Query parameters.
+
+        Returns:
+            requests.Response: The first response that is not a 429 or 401.
+        """
+        if not url.startswith('http'):
+            url = self.base_url + url
+
+        while True:
+            self.limiter.acquire()
+            bearer = self.authorizer.bearer
+            response = self.http.get(url, params=params, headers=self.headers(bearer))
+
+            if response.status_code == 429:
+                limit = float(response.headers.get('Retry-After', 1))
+                print('Hit rate limit, waiting for {} seconds to continue'.format(limit))
+                self.limiter.pause(limit)
+            elif response.status_code == 401:
+                # every thread turned down with this token waits on the one refresh and then retries with its token
+                self.authorizer.refresh(stale=bearer)
+            else:
+                return response
+
+    def get_many(self, requests_):
+        """Runs independent GET's concurrently.
+
+        Args:
+            requests_ (list): List of (url, params) pairs.
+
+        Returns:
+            list: Responses in the same order as `requests_`.
+        """
+        futures = [self.executor.submit(self.get, url, params) for url, params in requests_]
+        return [f.result() for f in futures]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.http.close()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def default_session(authorizer):
+    """Returns the shared session for an authorizer, created on first use."""
+    with _sessions_lock:
+        session = _sessions.get(id(authorizer))
+        if session is None or session.authorizer is not authorizer:
+            session = SpotifySession(authorizer)
+            _sessions[id(authorizer)] = session
+        return session
+
+
+def configure(authorizer, **kwargs):
+    """Replaces the shared session of an authorizer with one built from `kwargs` (see SpotifySession)."""
+    session = SpotifySession(authorizer, **kwargs)
+    with _sessions_lock:
+        old = _sessions.get(id(authorizer))
+        _sessions[id(authorizer)] = session
+    if old is not None:
+        old.close()
+    return session
@@ -0,0 +1,55 @@
+import unittest
+
+import numpy as np
+from sklearn.naive_bayes import GaussianNB
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.svm import LinearSVC, SVC
+
+from treemodel.tree import Tree
+from treemodel.kernels import compile_classifier
+from benchmarks.trials import synthetic_playlists
+
+
+class KernelTest(unittest.TestCase):
+    def setUp(self):
+        self.playlists = synthetic_playlists(60, seed=1)
+        rng = np.random.default_rng(0)
+        self.inputs = [rng.normal(0, 2, (40, self.playlists[0].shape[1])) for _ in range(200)] + self.playlists
+
+    def fitted(self, model, **model_args):
+        # fitted the way `Tree.push` fits a split, on two playlists
+        X = np.concatenate(self.playlists[:2])
+        y = np.concatenate((np.zeros(len(self.playlists[0])), np.ones(len(self.playlists[1]))))
+        return model(**model_args).fit(X, y)
+
+    def test_same_predictions(self):
+        for model in (GaussianNB, LogisticRegression, LinearSVC, SGDClassifier):
+            classifier = self.fitted(model)
+            kernel = compile_classifier(classifier)
+            self.assertIsNotNone(kernel, model.__name__)
+            for X in self.inputs:
+                for dtype in (np.float64, np.float32):
+                    self.assertTrue(np.array_equal(classifier.predict(X.astype(dtype)), kernel.predict(X.astype(dtype))), model.__name__)
+
+    def test_no_kernel(self):
+        self.assertIsNone(compile_classifier(self.fitted(SVC)))
+
+        class Flipped(GaussianNB):
+            def predict(self, X):
+                return 1 - super().predict(X)
+        self.assertIsNone(compile_classifier(self.fitted(Flipped)))
+
+    def test_same_leaves(self):
+        tree = Tree(GaussianNB)
+        np.random.seed(0)
+        for i, data in enumerate(self.playlists[:40]):
+            tree.push(data, f'p{i}')
+        plain = [tree.route(data) for data in self.playlists]
+        tree.use_kernels()
+        self.assertEqual([tree.route(data) for data in self.playlists], plain)
+        self.assertEqual([tree.route(data.astype(np.float32)) for data in self.playlists], plain)
+        self.assertEqual(tree.route_batch(self.playlists), plain)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+from sklearn.decomposition import PCA
+
+from spotifyapi.fake_server import fake_features
+from server.processing import process_features, decode_features, Preprocessor
+
+
+def playlist(start, tracks=100):
+    return [(f'track{i}', fake_features(f'track{i}')) for i in range(start, start + tracks)]
+
+
+class PreprocessorTest(unittest.TestCase):
+    def setUp(self):
+        self.playlists = [playlist(100 * i) for i in range(10)]
+        self.pca = PCA(n_components=6).fit(process_features([t for p in self.playlists for t in p]))
+
+    def assert_matches_pandas(self, pca, tolerance, dtype=np.float32):
+        preprocessor = Preprocessor(pca)
+        for p in self.playlists:
+            df = process_features(p)
+            expected = pca.transform(df[list(pca.feature_names_in_)])
+            self.assertLess(np.abs(preprocessor.transform(decode_features(p, dtype=dtype)) - expected).max(), tolerance)
+
+    def test_same_as_pandas(self):
+        self.assert_matches_pandas(self.pca, 1e-9, dtype=np.float64)
+        self.assert_matches_pandas(self.pca, 1e-5)
+
+    def test_whitened(self):
+        pca = PCA(n_components=6, whiten=True).fit(process_features([t for p in self.playlists for t in p]))
+        self.assert_matches_pandas(pca, 1e-9, dtype=np.float64)
+
+    def test_column_order_of_the_fitted_pca(self):
+        # a PCA fitted on a dataframe with its columns in another order than FEATURE_COLUMNS
+        df = process_features([t for p in self.playlists for t in p])
+        pca = PCA(n_components=6).fit(df[list(reversed(df.columns))])
+        self.assert_matches_pandas(pca, 1e-9, dtype=np.float64)
+
+    def test_constant_column(self):
+        p = [(t, dict(f, mode=1)) for t, f in self.playlists[0]]
+        expected = self.pca.transform(process_features(p))
+        self.assertLess(np.abs(Preprocessor(self.pca).transform(decode_features(p, dtype=np.float64)) - expected).max(), 1e-9)
+
+    def test_batch_same_as_one_at_a_time(self):
+        preprocessor = Preprocessor(self.pca)
+        Xs = [decode_features(p) for p in self.playlists]
+        for batched, X in zip(preprocessor.transform_batch(Xs), Xs):
+            self.assertLess(np.abs(batched - preprocessor.transform(X)).max(), 1e-9)
+        self.assertEqual(preprocessor.transform_batch([]), [])
+
+    def test_no_tracks(self):
+        with self.assertRaises(ValueError):
+            Preprocessor(self.pca).transform(decode_features([('track0', None)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import http.client
+import subprocess
+import tempfile
+import unittest
+import pickle
+import random
+import json
+import time
+import sys
+import os
+
+import numpy as np
+from sklearn.decomposition import PCA
+
+from spotifyapi.cache import FEATURE_COLUMNS
+from spotifyapi.fake_server import FakeSpotify
+from benchmarks.startup import free_port
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def request(port, method, path, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        conn.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+        return response.status, json.loads(data) if response.getheader('Content-Type') == 'application/json' else data
+    finally:
+        conn.close()
+
+
+class ServedTree():
+    """`python -m server.server` in a temporary directory, with its spotify calls going to a FakeSpotify."""
+    def __init__(self, fake, **settings):
+        self.path = tempfile.mkdtemp(prefix='server-')
+        self.port = free_port()
+
+        pca = PCA(n_components=6).fit(np.random.default_rng(0).normal(size=(2000, len(FEATURE_COLUMNS))))
+        f = open(os.path.join(self.path, 'pca_reduce.pkl'), 'wb')
+        pickle.dump(pca, f)
+        f.close()
+
+        files = {
+            'tokens.jsonc': {'client_id': 'test', 'client_secret': 'test'},
+            'spotify_tokens.json': {'access_token': 'fake', 'refresh_token': 'fake', 'expires_at': time.time() + 3600},
+            'conf.json': {'server': dict({'url': '127.0.0.1', 'port': self.port, 'callback': '/callback/', 'authorize': False,
+                                          'spotify_session': {'base_url': fake.url, 'workers': 4}}, **settings)}
+        }
+        for name, content in files.items():
+            f = open(os.path.join(self.path, name), 'w')
+            json.dump(content, f)
+            f.close()
+
+    def __enter__(self):
+        self.process = subprocess.Popen([sys.executable, '-m', 'server.server'], cwd=self.path, env=dict(os.environ, PYTHONPATH=REPO),
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        start = time.monotonic()
+        while True:
+            if self.process.poll() is not None or time.monotonic() - start > 60:
+                self.__exit__()
+                raise RuntimeError('server did not become ready')
+            try:
+                if request(self.port, 'GET', '/readyz')[0] == 200:
+                    return self
+            except OSError:
+                pass
+            time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        try:
+            request(self.port, 'GET', '/kill/')
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.playlists = {f'p{i}': [f'track{rng.randrange(400)}' for _ in range(30)] for i in range(12)}
+        self.fake = FakeSpotify(playlists=self.playlists).start()
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def check_requests(self, server):
+        # none of the tracks are cached, every request fetches its features through the spotify session
+        status, body = request(server.port, 'POST', '/push_batch/', {'playlists': [f'p{i}' for i in range(8)]})
+        self.assertEqual(status, 200)
+        self.assertEqual([r['status'] for r in body['ret']], [200] * 8, body)
+
+        self.assertEqual(request(server.port, 'GET', '/push/?playlist=p8')[0], 200)
+        self.assertEqual(request(server.port, 'GET', '/recommendation/?playlist=p9')[0], 200)
+        self.assertEqual(request(server.port, 'GET', '/update/?playlist=p1')[0], 200)
+
+        status, body = request(server.port, 'GET', '/query/?playlist=p10')
+        self.assertEqual(status, 200)
+        self.assertIn(body['ret'], self.playlists)
+
+        status, body = request(server.port, 'POST', '/query_batch/', {'playlists': ['p10', 'p11']})
+        self.assertEqual(status, 200)
+        self.assertEqual([r['status'] for r in body['ret']], [200, 200], body)
+
+    def test_requests_after_start(self):
+        with ServedTree(self.fake) as server:
+            self.check_requests(server)
+            self.assertGreater(self.fake.requests, 0)
+
+    def test_fit_workers(self):
+        # classifiers fitted in worker processes, with the features kept in a feature cache
+        with ServedTree(self.fake, fit_workers=2, feature_cache='features') as server:
+            self.check_requests(server)
+            status, body = request(server.port, 'GET', '/feature_cache/')
+            self.assertGreater(body['ret']['hits'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+from concurrent.futures import Future
+import tempfile
+import unittest
+
+import numpy as np
+from sklearn.naive_bayes import GaussianNB
+from sklearn.svm import SVC
+
+from treemodel.tree import Tree, PendingFit, NO_NODE
+import treemodel.snapshot as tree_snapshot
+from benchmarks.trials import synthetic_playlists
+
+
+def build(playlists, order=None, model=GaussianNB):
+    tree = Tree(model)
+    np.random.seed(0)
+    for i in (range(len(playlists)) if order is None else order):
+        tree.push(playlists[i], f'p{i}')
+    return tree
+
+
+def labels_in(tree):
+    return [tree.leaf_label(leaf) for leaf in tree.subtree_leaves(tree.head)] if tree.head != NO_NODE else []
+
+
+class DuplicateLabelTest(unittest.TestCase):
+    def setUp(self):
+        self.playlists = synthetic_playlists(40, seed=1)
+        self.tree = build(self.playlists[:30])
+        # the same playlist pushed again, once with its own tracks and once with another's
+        self.tree.push(self.playlists[5], 'p5')
+        self.tree.push(self.playlists[30], 'p5')
+
+    def test_remove_takes_every_copy(self):
+        self.assertEqual(labels_in(self.tree).count('p5'), 3)
+        self.assertTrue(self.tree.remove('p5'))
+        self.assertNotIn('p5', labels_in(self.tree))
+        self.assertEqual(self.tree.size, 29)
+        self.assertFalse(self.tree.remove('p5'))
+        for data in self.playlists:
+            self.assertNotEqual(self.tree.query(data), ['p5'])
+
+    def test_update_leaves_one_copy(self):
+        self.assertTrue(self.tree.update('p5', self.playlists[31]))
+        self.assertEqual(labels_in(self.tree).count('p5'), 1)
+        self.assertEqual(self.tree.size, 30)
+        self.assertEqual(len(self.tree.leaf_of['p5']), 1)
+
+    def test_remove_after_reload(self):
+        path = tempfile.mkdtemp(prefix='tree-')
+        tree_snapshot.save(self.tree, path)
+        tree = tree_snapshot.load(path)
+        self.assertEqual(len(tree.leaf_of['p5']), 3)
+
+        self.assertTrue(tree.remove('p5'))
+        tree_snapshot.save(tree, path)
+        tree = tree_snapshot.load(path)
+        self.assertNotIn('p5', labels_in(tree))
+        self.assertNotIn('p5', tree.leaf_of)
+        self.assertFalse(tree.remove('p5'))
+
+
+class RemoveRebuildFlagTest(unittest.TestCase):
+    def test_flag_moves_to_the_sibling_subtree(self):
+        playlists = synthetic_playlists(120, seed=1)
+        # sorted pushes grow a lopsided tree
+        tree = build(playlists, sorted(range(len(playlists)), key=lambda i: float(np.mean(playlists[i][:, 0]))))
+
+        # a leaf whose parent has a lopsided subtree on the other side
+        for leaf in tree.subtree_leaves(tree.head):
+            up = tree.parent[leaf]
+            if up != NO_NODE and tree.leaf_count[up] > 8:
+                break
+        tree.unbalanced = {up}
+        tree.remove(tree.leaf_label(leaf))
+
+        self.assertTrue(tree.unbalanced)
+        for node in tree.unbalanced:
+            self.assertTrue(tree.is_attached(node))
+            counts = tree.leaf_count
+            self.assertGreater(max(counts[tree.left[node]], counts[tree.right[node]]), tree.balance_alpha * counts[node])
+
+
+class RouteBatchTest(unittest.TestCase):
+    def test_same_leaves_as_route(self):
+        playlists = synthetic_playlists(100, seed=1)
+        for model in (GaussianNB, SVC):
+            tree = build(playlists[:60], model=model)
+            # built playlists and ones the tree has never seen
+            self.assertEqual(tree.route_batch(playlists), [tree.route(data) for data in playlists])
+            self.assertEqual(tree.recommend_many(playlists), [tree.query(data)[0] for data in playlists])
+
+    def test_empty(self):
+        tree = Tree(GaussianNB)
+        playlists = synthetic_playlists(2, seed=1)
+        self.assertEqual(tree.route_batch(playlists), [NO_NODE, NO_NODE])
+        self.assertEqual(tree.recommend_many(playlists), [None, None])
+        self.assertEqual(tree.route_batch([]), [])
+
+
+class HeldExecutor():
+    # runs submitted fits only when told to
+    def __init__(self):
+        self.held = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.held.append((future, fn, args))
+        return future
+
+    def release(self):
+        for future, fn, args in self.held:
+            future.set_result(fn(*args))
+        self.held = []
+
+
+class BackgroundFitTest(unittest.TestCase):
+    def test_swapping_in_a_fit_invalidates_answers(self):
+        playlists = synthetic_playlists(20, seed=1)
+        tree = Tree(GaussianNB)
+        executor = HeldExecutor()
+        tree.use_fit_executor(executor)
+        np.random.seed(0)
+        for i, data in enumerate(playlists[:10]):
+            tree.push(data, f'p{i}')
+
+        # routed by the centroid fallbacks while the fits are held
+        seen = []
+        tree.query(playlists[15], seen=seen)
+        self.assertTrue(tree.is_current(seen))
+
+        executor.release()
+        tree.wait_for_fits()
+        self.assertFalse(tree.is_current(seen))
+        self.assertFalse(any(isinstance(c, PendingFit) for c in tree.classifiers))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import numpy as np
+from array import array
+
+
+def nearest(X, C, chunk=65536):
+    """Index of the closest row of C for every row of X, in chunks so the distance matrix stays small."""
+    c_norms = (C ** 2).sum(axis=1)
+    out = np.empty(len(X), dtype=np.int32)
+    for start in range(0, len(X), chunk):
+        block = X[start:start + chunk]
+        out[start:start + chunk] = np.argmin(c_norms - 2 * block @ C.T, axis=1)
+    return out
+
+
+def kmeans(X, k, rng, iterations=10):
+    """Plain Lloyd's k-means from k random rows, empty clusters keep their previous centre."""
+    centres = X[rng.choice(len(X), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest(X, centres)
+        sums = np.zeros_like(centres)
+        np.add.at(sums, assignment, X)
+        counts = np.bincount(assignment, minlength=k)
+        filled = counts > 0
+        centres[filled] = sums[filled] / counts[filled, None]
+    return centres
+
+
+class PlaylistIndex():
+    """Approximate nearest neighbour index over playlist embeddings (the mean track of each playlist in PCA space).
+
+    An inverted file index: the embeddings are split into lists around k-means centres and a search only scans the
+    `nprobe` lists whose centres are closest to the query. Until `train_size` playlists are in, every search is an exact
+    scan. After that the centres are trained and retrained each time the index grows four fold, with about 4 * sqrt(n)
+    lists, so a search looks at roughly nprobe / (4 * sqrt(n)) of the playlists. Adds in between go to their closest list.
+
+    One thread adds (the tree writer), any number search. Vectors are written before their id is put in a list, and
+    the centres and their lists are only ever replaced together as one tuple, so a search needs no lock. A removed
+    playlist is taken out of its list and flagged in `live`, its vector stays where it is since ids are never reused.
+
+    Args:
+        nprobe (int, optional): Lists scanned per search. Defaults to 8.
+        train_size (int, optional): Playlists before the first training. Defaults to 4096.
+        max_lists (int, optional): Cap on the number of lists. Defaults to 4096.
+        seed (int, optional): Seed of the k-means initialisation. Defaults to 0.
+    """
+    def __init__(self, nprobe=8, train_size=4096, max_lists=4096, seed=0):
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.max_lists = max_lists
+        self.rng = np.random.default_rng(seed)
+
+        self.vectors = None
+        self.live = None # False for removed playlists
+        self.labels = []
+        self.ids = {} # label -> ids of the playlists added with it
+        self.count = 0
+        self.removed = 0
+
+        self.ivf = None # (centres, lists), None until trained
+        self.next_training = train_size
+
+    def __len__(self):
+        return self.count - self.removed
+
+    def add(self, vector, label):
+        """Adds the embedding of a playlist.
+
+        Returns:
+            int: Id of the playlist in the index.
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.vectors is None:
+            self.vectors = np.empty((1024, len(vector)), dtype=np.float32)
+            self.live = np.zeros(1024, dtype=bool)
+        elif self.count == len(self.vectors):
+            grown = np.empty((2 * len(self.vectors), self.vectors.shape[1]), dtype=np.float32)
+            grown[:self.count] = self.vectors
+            live = np.zeros(2 * len(self.live), dtype=bool)
+            live[:self.count] = self.live[:self.count]
+            self.vectors, self.live = grown, live
+
+        i = self.count
+        self.vectors[i] = vector
+        self.live[i] = True
+        self.labels.append(label)
+        self.ids.setdefault(label, []).append(i)
+        if self.ivf is not None:
+            centres, lists = self.ivf
+            lists[int(nearest(vector[None, :], centres)[0])].append(i)
+        self.count = i + 1
+
+        if self.count >= self.next_training:
+            self.train()
+        return i
+
+    def remove(self, label):
+        """Takes every playlist added with `label` out of the searches.
+
+        Returns:
+            bool: False if there is no such playlist.
+        """
+        ids = self.ids.pop(label, None)
+        if ids is None:
+            return False
+
+        for i in ids:
+            self.live[i] = False
+            self.removed += 1
+            if self.ivf is not None:
+                centres, lists = self.ivf
+                j = int(nearest(self.vectors[i:i + 1], centres)[0])
+                if i in lists[j]:
+                    lists[j].remove(i)
+                else:
+                    # assigned by a batched distance computation that rounded differently
+                    for l in lists:
+                        if i in l:
+                            l.remove(i)
+                            break
+        return True
+
+    def train(self):
+        """(Re)trains the list centres on a sample of the current embeddings and reassigns every playlist."""
+        n = self.count
+        vectors = self.vectors[:n]
+        num_lists = int(min(self.max_lists, max(1, 4 * np.sqrt(n))))
+        sample = vectors if n <= 64 * num_lists else vectors[self.rng.choice(n, 64 * num_lists, replace=False)]
+        centres = kmeans(sample, num_lists, self.rng)
+
+        assignment = nearest(vectors, centres)
+        order = np.argsort(assignment, kind='stable')
+        order = order[self.live[order]] # removed playlists stay out of the lists
+        bounds = np.searchsorted(assignment[order], np.arange(num_lists + 1))
+        lists = [array('i', order[bounds[j]:bounds[j + 1]].astype(np.int32).tobytes()) for j in range(num_lists)]
+
+        self.ivf = (centres, lists)
+        self.next_training = 4 * n
+
+    def search(self, vector, k=10):
+        """The `k` playlists closest to `vector`, closest first.
+
+        Returns:
+            list: (label, squared distance) pairs.
+        """
+        count = self.count
+        if count == 0:
+            return []
+        vector = np.asarray(vector, dtype=np.float32)
+
+        ivf = self.ivf
+        if ivf is None:
+            candidates = np.arange(count)
+            if self.removed:
+                candidates = candidates[self.live[:count]]
+        else:
+            centres, lists = ivf
+            probe = np.argsort(((centres - vector) ** 2).sum(axis=1))[:self.nprobe]
+            candidates = np.concatenate([np.array(lists[j], dtype=np.int32) for j in probe])
+        vectors = self.vectors
+
+        distances = ((vectors[candidates] - vector) ** 2).sum(axis=1)
+        if len(candidates) > k:
+            top = np.argpartition(distances, k)[:k]
+            candidates, distances = candidates[top], distances[top]
+        order = np.argsort(distances, kind='stable')
+        return [(self.labels[candidates[i]], float(distances[i])) for i in order]
@@ -0,0 +1,219 @@
+from concurrent.futures import Future
+import numpy as np
+import threading
+
+from treemodel.routing import side_summary
+
+# track rows taken from each side of a split to fit its classifier, sampled evenly across the playlists on that side
+MAX_SPLIT_ROWS = 1024
+# times the playlists of a split are routed by its classifier, which is refitted on the sides they went to in between
+ROUTE_ROUNDS = 3
+
+
+def centroid(data):
+    return np.asarray(data, dtype=np.float64).mean(axis=0)
+
+
+def bisect(centroids, iterations=5):
+    """Splits playlists into two groups of equal size (give or take one) by their centroids.
+
+    Starts from the median cut along the direction the centroids spread out the most, then runs a few rounds of
+    balanced 2-means: every playlist is scored by how much closer it is to one group mean than to the other and the
+    groups are cut again at the median score.
+
+    Args:
+        centroids (numpy.ndarray): Mean feature vector of each playlist, at least two rows.
+        iterations (int, optional): Rounds of balanced 2-means. Defaults to 5.
+
+    Returns:
+        tuple: (left indexes, right indexes) into `centroids`.
+    """
+    half = len(centroids) // 2
+    centred = centroids - centroids.mean(axis=0)
+    direction = np.linalg.svd(centred, full_matrices=False)[2][0]
+    order = np.argsort(centred @ direction, kind='stable')
+
+    for _ in range(iterations):
+        # |x - a|^2 - |x - b|^2 only depends on x through x @ (b - a)
+        a = centred[order[:half]].mean(axis=0)
+        b = centred[order[half:]].mean(axis=0)
+        new_order = np.argsort(centred @ (b - a), kind='stable')
+        if np.array_equal(np.sort(new_order[:half]), np.sort(order[:half])):
+            break
+        order = new_order
+
+    return order[:half], order[half:]
+
+
+def _sample_rows(datas, rng, max_rows):
+    per_playlist = max(1, max_rows // len(datas))
+    parts = [np.asarray(d) if d.shape[0] <= per_playlist else np.asarray(d)[rng.choice(d.shape[0], per_playlist, replace=False)]
+             for d in datas]
+    X = np.concatenate(parts)
+    return X if X.shape[0] <= max_rows else X[rng.choice(X.shape[0], max_rows, replace=False)]
+
+
+def training_set(left, right, rng, max_rows=MAX_SPLIT_ROWS):
+    """Training data for a split between two groups of playlists.
+
+    Like the split `Tree.push` fits on two playlists, the larger side is sampled down to the size of the smaller one.
+
+    Args:
+        left (list): Feature matrices of the playlists going left, labelled 0.
+        right (list): Feature matrices of the playlists going right, labelled 1.
+        rng (numpy.random.Generator): Source of the samples.
+        max_rows (int, optional): Max rows per side. Defaults to MAX_SPLIT_ROWS.
+
+    Returns:
+        tuple: (X, y)
+    """
+    X0 = _sample_rows(left, rng, max_rows)
+    X1 = _sample_rows(right, rng, max_rows)
+    N = min(X0.shape[0], X1.shape[0])
+    if X0.shape[0] != N:
+        X0 = X0[rng.choice(X0.shape[0], N, replace=False)]
+    if X1.shape[0] != N:
+        X1 = X1[rng.choice(X1.shape[0], N, replace=False)]
+    return np.concatenate((X0, X1)), np.concatenate((np.zeros(N), np.ones(N)))
+
+
+def routed_left(classifier, datas):
+    """Which playlists a split's classifier sends left, by the average vote over their tracks like `Tree.branch`."""
+    counts = np.array([d.shape[0] for d in datas])
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    votes = np.add.reduceat(classifier.predict(np.concatenate(datas)), starts) / counts
+    return votes < 0.5
+
+
+def plan_subtree(model, model_args, datas, items, seed=None, max_rows=MAX_SPLIT_ROWS, executor=None, tasks=1):
+    """Fits a subtree of close to even depth over a set of playlists, without touching any tree.
+
+    The playlists are bisected recursively by their centroids and one classifier is fitted per split. A classifier
+    fitted on a bisection does not send every playlist of it the way the bisection put it, so each playlist is then
+    placed on the side the classifier actually routes it to and the classifier is refitted on those sides, routing up to
+    `ROUTE_ROUNDS` times. A playlist's own tracks therefore lead back to its leaf, at the cost of the sides no longer
+    being exactly equal. Only when a classifier routes every playlist the same way is the bisection kept as it is.
+    Module level so it can run in a process pool.
+
+    With an `executor` the splits near the top are fitted here until the playlists are divided into about `tasks`
+    groups, and the subtree of each group is planned in the executor. The groups share nothing, so they fit in parallel.
+
+    Args:
+        model (class): Node classifier class.
+        model_args (dict): Arguments for `model`.
+        datas (list): Feature matrix of each playlist.
+        items (list): What stands for each playlist at the leaves of the plan, e.g. its leaf node id.
+        seed (int, optional): Seed for the training row samples.
+        max_rows (int, optional): Max training rows per side of a split. Defaults to MAX_SPLIT_ROWS.
+        executor (concurrent.futures.Executor, optional): Pool to plan independent subtrees in.
+        tasks (int, optional): Number of subtrees to hand to `executor`. Defaults to 1.
+
+    Returns:
+        The plan: `items[i]` for a single playlist, (classifier, left plan, right plan, side summary) for a split.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = np.stack([centroid(d) for d in datas])
+
+    def build(indexes, groups):
+        if len(indexes) == 1:
+            return items[indexes[0]]
+        if executor is not None and groups >= tasks:
+            return executor.submit(plan_subtree, model, model_args, [datas[i] for i in indexes], [items[i] for i in indexes],
+                                   int(rng.integers(2 ** 32)), max_rows)
+        left, right = bisect(centroids[indexes])
+        left, right = indexes[left], indexes[right]
+        X, y = training_set([datas[i] for i in left], [datas[i] for i in right], rng, max_rows)
+        classifier = model(**model_args)
+        classifier.fit(X, y)
+
+        # route every playlist with the classifier and refit on where they went, until the sides stop moving
+        group = [datas[i] for i in indexes]
+        candidate, before = classifier, None
+        for round in range(ROUTE_ROUNDS):
+            goes_left = routed_left(candidate, group)
+            if goes_left.all() or not goes_left.any():
+                break
+            classifier, left, right = candidate, indexes[goes_left], indexes[~goes_left]
+            X, y = training_set([datas[i] for i in left], [datas[i] for i in right], rng, max_rows)
+            if round == ROUTE_ROUNDS - 1 or (before is not None and np.array_equal(goes_left, before)):
+                break
+            before = goes_left
+            candidate = model(**model_args)
+            candidate.fit(X, y)
+        return (classifier, build(left, 2 * groups), build(right, 2 * groups), side_summary(X, y))
+
+    def resolve(plan):
+        if isinstance(plan, Future):
+            return plan.result()
+        if isinstance(plan, tuple):
+            return (plan[0], resolve(plan[1]), resolve(plan[2]), plan[3])
+        return plan
+
+    plan = build(np.arange(len(datas)), 1)
+    return resolve(plan) if executor is not None else plan
+
+
+class Rebalancer():
+    """Rebuilds the subtrees `Tree.push` flags as unbalanced, one at a time in the background.
+
+    The slow part of a rebuild, fitting the new classifiers, runs on this thread against the live tree without holding
+    anything. Only taking the next subtree and swapping the rebuilt one in go through the writer, so pushes and queries
+    carry on while a subtree is being refitted.
+
+    Args:
+        tree (Tree): Tree to keep balanced.
+        writer (TreeWriter, optional): Writer of the tree. Without one changes are made straight from this thread.
+        interval (float, optional): Seconds between looks for unbalanced subtrees. Defaults to 1.0.
+        grace (float, optional): Seconds a replaced subtree's classifiers are kept for queries still walking it. Defaults to 60.0.
+        max_rows (int, optional): Max training rows per side of a split. Defaults to MAX_SPLIT_ROWS.
+    """
+    def __init__(self, tree, writer=None, interval=1.0, grace=60.0, max_rows=MAX_SPLIT_ROWS):
+        self.tree = tree
+        self.writer = writer
+        self.interval = interval
+        self.grace = grace
+        self.max_rows = max_rows
+
+        self.rebuilt = 0
+        self.stale = 0 # rebuilds thrown away because the subtree changed while it was being refitted
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _write(self, fn, *args):
+        if self.writer is None:
+            return fn(self.tree, *args)
+        return self.writer.submit(fn, *args).result()
+
+    def step(self):
+        """Rebuilds the largest unbalanced subtree, if there is one.
+
+        Returns:
+            bool: False if there was nothing to rebuild.
+        """
+        node = self._write(lambda tree: tree.take_unbalanced())
+        if node < 0:
+            return False
+
+        planned = self.tree.plan_rebuild(node, max_rows=self.max_rows)
+        if self._write(lambda tree: tree.apply_rebuild(node, planned)):
+            self.rebuilt += 1
+        else:
+            self.stale += 1
+        return True
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                while not self.stop_event.is_set() and self.step():
+                    pass
+                self._write(lambda tree: tree.reclaim(self.grace))
+            except Exception as e:
+                print(f'Rebalance failed: {e}')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
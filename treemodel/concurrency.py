@@ -0,0 +1,125 @@
+from concurrent.futures import Future
+import threading
+import queue
+
+
+class _Side():
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class RWLock():
+    """Readers-writer lock. Any number of readers, or one writer. Waiting writers block new readers so they are not starved.
+
+    Use `with lock.read:` and `with lock.write:`.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+        self.read = _Side(self.acquire_read, self.release_read)
+        self.write = _Side(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+
+class TreeWriter():
+    """Applies every change to a tree from one thread.
+
+    Changes are queued and the writer thread takes them off in batches of up to `max_batch`, applying a whole batch under
+    one hold of the write lock. Queries never go through the writer: the tree only publishes a change with a single child
+    link (or head) assignment once all new nodes are in place, so a query running alongside a push sees either the tree
+    from before or after it. The write lock is only there for readers that need the tree to stand still, like snapshots.
+
+    Args:
+        tree (Tree): Tree to change.
+        lock (RWLock, optional): Lock shared with those readers.
+        max_batch (int, optional): Max number of queued changes applied per hold of the write lock. Defaults to 64.
+    """
+    def __init__(self, tree, lock=None, max_batch=64):
+        self.tree = tree
+        self.lock = lock if lock is not None else RWLock()
+        self.max_batch = max_batch
+
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues `fn(tree, *args, **kwargs)`.
+
+        Returns:
+            Future: Resolves to the return value of `fn`.
+        """
+        future = Future()
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def push(self, data, label, ret=False):
+        """Queues `tree.push(data, label, ret)`, returns a Future of its result."""
+        return self.submit(lambda tree: tree.push(data, label, ret=ret))
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            with self.lock.write:
+                for item in batch:
+                    if item is None:
+                        continue
+                    future, fn, args, kwargs = item
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        future.set_result(fn(self.tree, *args, **kwargs))
+                    except Exception as e:
+                        future.set_exception(e)
+
+            if None in batch:
+                return
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # everything queued before the stop is still applied
+        self.queue.put(None)
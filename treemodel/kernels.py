@@ -0,0 +1,69 @@
+"""Plain NumPy stand-ins for the `predict` of fitted sklearn classifiers.
+
+A traversal calls `predict` once per node on a few dozen tracks, where sklearn's input validation and dispatch cost
+more than the arithmetic. A kernel keeps only the fitted parameters and repeats sklearn's arithmetic operation for
+operation, so its predictions are bit for bit the same. Only models whose `predict` is known are compiled, anything
+else (including subclasses that override `predict`, and SVC, whose libsvm decision function can't be reproduced
+exactly) keeps its own `predict`.
+"""
+import numpy as np
+
+
+class GaussianNBKernel():
+    """GaussianNB._joint_log_likelihood followed by an argmax, with the per class constants worked out once."""
+    def __init__(self, model):
+        var = model.var_ if hasattr(model, 'var_') else model.sigma_ # sigma_ before sklearn 1.0
+        self.classes = model.classes_
+        self.theta = [model.theta_[i, :] for i in range(len(self.classes))]
+        self.var = [var[i, :] for i in range(len(self.classes))]
+        self.log_prior = [np.log(model.class_prior_[i]) for i in range(len(self.classes))]
+        self.norm = [-0.5 * np.sum(np.log(2.0 * np.pi * var[i, :])) for i in range(len(self.classes))]
+
+    def predict(self, X):
+        X = _as_float(X)
+        # np.add.reduce is what np.sum ends up calling, without the wrapper overhead
+        jll = [log_prior + (norm - 0.5 * np.add.reduce(((X - theta) ** 2) / var, axis=1))
+               for log_prior, norm, theta, var in zip(self.log_prior, self.norm, self.theta, self.var)]
+        if len(jll) == 2 and not np.isnan(jll[1]).any():
+            # argmax of two columns without stacking them, ties go to the first like argmax
+            return self.classes[(jll[1] > jll[0]).view(np.int8)]
+        return self.classes[np.stack(jll).T.argmax(axis=1)]
+
+
+class LinearKernel():
+    """LinearClassifierMixin.predict (LogisticRegression, LinearSVC, SGDClassifier, RidgeClassifier, ...): X @ w + b."""
+    def __init__(self, model):
+        self.classes = model.classes_
+        self.coef_T = model.coef_.T if model.coef_.ndim == 2 else model.coef_
+        self.intercept = model.intercept_
+
+    def predict(self, X):
+        scores = _as_float(X) @ self.coef_T + self.intercept
+        if scores.ndim > 1 and scores.shape[1] == 1:
+            return self.classes.take((scores.reshape(-1) > 0).astype(np.intp), axis=0)
+        return self.classes.take(np.argmax(scores, axis=1), axis=0)
+
+
+def _as_float(X):
+    # what sklearn's validation leaves of a dense array: float arrays as they are, anything else as float64
+    X = np.asarray(X)
+    return X if X.dtype.kind == 'f' else X.astype(np.float64)
+
+
+def compile_classifier(classifier):
+    """Kernel for a fitted classifier, None if its `predict` has no kernel."""
+    # nothing to compile unless the classifier comes from sklearn, which then is already imported
+    if not type(classifier).__module__.startswith('sklearn.'):
+        return None
+
+    from sklearn.naive_bayes import GaussianNB
+    from sklearn.linear_model._base import LinearClassifierMixin
+
+    cls = type(classifier)
+    if isinstance(classifier, GaussianNB) and cls.predict is GaussianNB.predict and \
+            cls._joint_log_likelihood is GaussianNB._joint_log_likelihood:
+        return GaussianNBKernel(classifier)
+    if isinstance(classifier, LinearClassifierMixin) and cls.predict is LinearClassifierMixin.predict and \
+            cls.decision_function is LinearClassifierMixin.decision_function and isinstance(getattr(classifier, 'coef_', None), np.ndarray):
+        return LinearKernel(classifier)
+    return None
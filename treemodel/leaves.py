@@ -0,0 +1,88 @@
+"""What a leaf keeps of its playlist.
+
+A leaf only needs its playlist's tracks for one thing: the training rows of the split made when a later push lands on
+it (or a rebuild covers it). A policy decides what is stored in place of the full feature matrix, and hands back rows
+to train on from what it stored. Whatever is stored is a float64 array, so snapshots stack and memory-map it the same way.
+"""
+import numpy as np
+
+
+class FullLeaves():
+    """Keeps the whole feature matrix, memory grows with playlist length. The default, and what `Tree.push` always did."""
+    name = 'full'
+
+    def keep(self, data):
+        return data
+
+    def rows(self, stored, limit=None):
+        """Track rows to train a split on, at most `limit` (or all of them) if the policy has to make them up."""
+        return stored
+
+    def centroid(self, stored):
+        """Mean track of the playlist."""
+        return np.asarray(stored, dtype=np.float64).mean(axis=0)
+
+
+class ReservoirLeaves():
+    """Keeps a uniform sample of at most `size` tracks of each playlist.
+
+    Args:
+        size (int): Max rows kept per leaf.
+        seed (int, optional): Seed of the sampler.
+    """
+    def __init__(self, size, seed=None):
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def name(self):
+        return f'reservoir:{self.size}'
+
+    def keep(self, data):
+        if data.shape[0] <= self.size:
+            return data
+        return data[np.sort(self.rng.choice(data.shape[0], self.size, replace=False))]
+
+    def rows(self, stored, limit=None):
+        return stored
+
+    def centroid(self, stored):
+        return np.asarray(stored, dtype=np.float64).mean(axis=0)
+
+
+class SummaryLeaves():
+    """Keeps the track count, mean and covariance of each playlist, (d + 2, d) floats whatever its length.
+
+    The stored array is the mean in row 0, the number of tracks at [1, 0] and the covariance in the remaining d rows.
+    Training rows are drawn from a normal distribution with that mean and covariance, as many as the playlist had tracks.
+    """
+    name = 'summary'
+
+    def keep(self, data):
+        data = np.asarray(data, dtype=np.float64)
+        d = data.shape[1]
+        stored = np.zeros((d + 2, d))
+        stored[0] = data.mean(axis=0)
+        stored[1, 0] = data.shape[0]
+        stored[2:] = np.cov(data, rowvar=False, bias=True).reshape(d, d)
+        return stored
+
+    def rows(self, stored, limit=None):
+        count = int(stored[1, 0])
+        n = count if limit is None else min(count, limit)
+        return np.random.multivariate_normal(stored[0], stored[2:], n, check_valid='ignore')
+
+    def centroid(self, stored):
+        return np.array(stored[0])
+
+
+def parse_policy(spec, seed=None):
+    """Policy from its name: 'full', 'reservoir:<size>' or 'summary'."""
+    name, _, arg = spec.partition(':')
+    if name == 'full':
+        return FullLeaves()
+    if name == 'reservoir':
+        return ReservoirLeaves(int(arg) if arg else 64, seed)
+    if name == 'summary':
+        return SummaryLeaves()
+    raise ValueError(f'Unknown leaf policy {spec}, expected full, reservoir:<size> or summary.')
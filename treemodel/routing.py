@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def side_summary(X, y):
+    """Centroid and spread of the tracks on each side of a split, from the rows the split classifier is fitted on.
+
+    Returns:
+        numpy.ndarray: (2, d + 1) array, row 0 for the left side (y == 0) and row 1 for the right. The first d columns
+            are the centroid, the last the root mean square distance of the side's tracks to it.
+    """
+    sides = np.empty((2, X.shape[1] + 1))
+    for side in (0, 1):
+        rows = np.asarray(X[y == side], dtype=np.float64)
+        sides[side, :-1] = rows.mean(axis=0)
+        sides[side, -1] = np.sqrt(((rows - sides[side, :-1]) ** 2).sum(axis=1).mean())
+    return sides
+
+
+def fast_votes(sides, means, threshold):
+    """Routes playlists by the distance of their mean track to each side's centroid, in units of that side's spread.
+
+    With d0 and d1 those distances the margin is (d1 - d0) / (d1 + d0), from -1 (right) to 1 (left).
+
+    Args:
+        sides (numpy.ndarray): `side_summary` of the node.
+        means (numpy.ndarray): Mean track of each playlist, (playlists, d).
+        threshold (float): Smallest margin that is trusted without asking the classifier.
+
+    Returns:
+        numpy.ndarray: 0.0 (left) or 1.0 (right) for each playlist, NaN where the margin is too small to tell.
+    """
+    spreads = np.maximum(sides[:, -1], 1e-12)
+    d0 = np.sqrt(((means - sides[0, :-1]) ** 2).sum(axis=1)) / spreads[0]
+    d1 = np.sqrt(((means - sides[1, :-1]) ** 2).sum(axis=1)) / spreads[1]
+    margin = (d1 - d0) / np.maximum(d1 + d0, 1e-12)
+
+    votes = np.full(len(means), np.nan)
+    votes[margin >= threshold] = 0.0
+    votes[margin <= -threshold] = 1.0
+    return votes
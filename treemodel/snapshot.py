@@ -0,0 +1,196 @@
+import numpy as np
+import pickle as pk
+import threading
+import shutil
+import json
+import time
+import os
+
+from treemodel.tree import Tree
+
+FORMAT_VERSION = 3
+
+
+def save(tree, path, keep=2):
+    """Writes a snapshot of the tree to `path`.
+
+    Every snapshot is its own directory `path/snapshot-<generation>` holding
+        manifest.json   - format version, head node and leaf labels
+        nodes.npy       - the left, right, parent, slot and leaf_count arrays of the tree as one (nodes, 5) int32 array
+        classifiers.pkl - the node model, its arguments, the leaf policy, every fitted classifier and its side summary
+        leaves.npy      - what every leaf keeps (its feature matrix with the default leaf policy) stacked into one float64 array
+        offsets.npy     - row offset of each leaf in leaves.npy
+    The `path/CURRENT` file is swapped to the new snapshot only once it is fully written, so a crash never leaves a half written snapshot behind.
+
+    Args:
+        tree (Tree): Tree to save.
+        path (str): Snapshot root directory.
+        keep (int, optional): Number of snapshots to keep around, older ones are deleted. Defaults to 2.
+
+    Returns:
+        str: Directory of the new snapshot.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    # classifiers still being fitted in the background can't be pickled
+    tree.wait_for_fits()
+
+    current = current_snapshot(path)
+    generation = 0 if current is None else int(current.split('-')[-1]) + 1
+    name = f'snapshot-{generation:08d}'
+    tmp = os.path.join(path, name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    nodes = np.stack([np.frombuffer(a, dtype=np.int32) for a in (tree.left, tree.right, tree.parent, tree.slot, tree.leaf_count)], axis=1)
+    np.save(os.path.join(tmp, 'nodes.npy'), nodes)
+
+    leaves = [np.asarray(l, dtype=np.float64) for l in tree.leaves]
+    offsets = np.zeros(len(leaves) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([l.shape[0] for l in leaves])
+    width = leaves[0].shape[1] if leaves else 0
+    np.save(os.path.join(tmp, 'leaves.npy'), np.concatenate(leaves) if leaves else np.zeros((0, width)))
+    np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+
+    f = open(os.path.join(tmp, 'classifiers.pkl'), 'wb')
+    pk.dump({'model': tree.model, 'model_args': tree.model_args, 'leaf_policy': tree.leaf_policy, 'classifiers': tree.classifiers,
+             'sides': tree.sides}, f)
+    f.close()
+
+    f = open(os.path.join(tmp, 'manifest.json'), 'w')
+    json.dump({'version': FORMAT_VERSION, 'generation': generation, 'tree_generation': tree.generation, 'created': time.time(),
+               'head': int(tree.head), 'size': tree.size, 'labels': tree.labels}, f)
+    f.close()
+
+    os.replace(tmp, os.path.join(path, name))
+    _set_current(path, name)
+
+    # clean up old snapshots
+    snapshots = sorted(d for d in os.listdir(path) if d.startswith('snapshot-') and not d.endswith('.tmp'))
+    for old in snapshots[:-keep]:
+        shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+
+    return os.path.join(path, name)
+
+
+def _set_current(path, name):
+    tmp = os.path.join(path, 'CURRENT.tmp')
+    f = open(tmp, 'w')
+    f.write(name)
+    f.close()
+    os.replace(tmp, os.path.join(path, 'CURRENT'))
+
+
+def current_snapshot(path):
+    """Name of the latest complete snapshot in `path`, None if there is none."""
+    try:
+        f = open(os.path.join(path, 'CURRENT'), 'r')
+        name = f.read().strip()
+        f.close()
+    except OSError:
+        return None
+    return name if os.path.isdir(os.path.join(path, name)) else None
+
+
+def load(path, mmap=True, name=None):
+    """Restores a tree from the latest snapshot in `path`.
+
+    Leaf matrices are slices of one memory-mapped array, so load time depends on the number of nodes and not on the amount of feature data.
+    Processes that load the same snapshot share the pages of the mapped leaves.
+
+    Args:
+        path (str): Snapshot root directory.
+        mmap (bool, optional): Memory-map the leaf matrices instead of reading them in. Defaults to True.
+        name (str, optional): Snapshot to load instead of the latest, as returned by `current_snapshot`.
+
+    Returns:
+        [Tree, None]: The restored tree, None if there is no snapshot in `path`.
+    """
+    if name is None:
+        name = current_snapshot(path)
+    if name is None:
+        return None
+    snapshot = os.path.join(path, name)
+
+    f = open(os.path.join(snapshot, 'manifest.json'), 'r')
+    manifest = json.load(f)
+    f.close()
+    if manifest['version'] != FORMAT_VERSION:
+        raise ValueError(f'Snapshot format version {manifest["version"]} is not supported (expected {FORMAT_VERSION}).')
+    nodes = np.load(os.path.join(snapshot, 'nodes.npy'))
+
+    f = open(os.path.join(snapshot, 'classifiers.pkl'), 'rb')
+    models = pk.load(f)
+    f.close()
+
+    leaves = np.load(os.path.join(snapshot, 'leaves.npy'), mmap_mode='r' if mmap else None)
+    offsets = np.load(os.path.join(snapshot, 'offsets.npy'))
+
+    tree = Tree(models['model'], **models['model_args'])
+    if 'leaf_policy' in models:
+        tree.use_leaf_policy(models['leaf_policy'])
+
+    for a, column in zip((tree.left, tree.right, tree.parent, tree.slot, tree.leaf_count), nodes.T):
+        a.frombytes(np.ascontiguousarray(column, dtype=np.int32).tobytes())
+    tree.version.frombytes(bytes(4 * len(nodes))) # versions only mean something within one process
+
+    tree.classifiers = list(models['classifiers'])
+    tree.sides = list(models.get('sides', [None] * len(tree.classifiers)))
+    tree.leaves = [leaves[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+    tree.labels = list(manifest['labels'])
+
+    tree.head = manifest['head']
+    tree.size = manifest['size']
+    tree.generation = manifest['tree_generation']
+
+    tree.index_labels()
+
+    return tree
+
+
+class Checkpointer():
+    """Saves the tree to a snapshot directory in the background every `interval` seconds, when it has changed.
+
+    Args:
+        tree (Tree): Tree to save.
+        path (str): Snapshot root directory.
+        interval (float): Seconds between checkpoints.
+        lock (optional): Held while saving so no change lands half way through a snapshot, e.g. the `read` side of the RWLock the tree writer uses.
+    """
+    def __init__(self, tree, path, interval, lock=None):
+        self.tree = tree
+        self.path = path
+        self.interval = interval
+        self.lock = lock if lock is not None else threading.Lock()
+
+        self.saved_generation = tree.generation
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def checkpoint(self):
+        """Saves a snapshot now.
+
+        Returns:
+            str: Directory of the new snapshot.
+        """
+        with self.lock:
+            generation = self.tree.generation
+            snapshot = save(self.tree, self.path)
+        self.saved_generation = generation
+        return snapshot
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            if self.tree.generation != self.saved_generation:
+                try:
+                    self.checkpoint()
+                except Exception as e:
+                    print(f'Checkpoint failed: {e}')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
@@ -1,91 +1,907 @@
 import numpy as np
+from array import array
+import math
+import time
 
-class TreeNode():
-    def __init__(self, elem, label):
-        self.elem = elem
-        self.label = label # label to keep track of a playlists name, since elem will either be full of features, or None if a classifier is elem
-        self.left = None
-        self.right = None
-        self.parent = None
+import treemodel.balance as balance
+from treemodel.leaves import FullLeaves
+from treemodel.routing import side_summary, fast_votes
+from treemodel.kernels import compile_classifier
+
+NO_NODE = -1
+
+
+def fit_classifier(model, model_args, X, y):
+    # module level so it can be sent to a process pool
+    classifier = model(**model_args)
+    classifier.fit(X, y)
+    return classifier
+
+
+class CentroidModel():
+    """Nearest centroid classifier, each track goes to the class whose mean it is closest to."""
+    def fit(self, X, y):
+        self.centroids = np.stack((X[y == 0].mean(axis=0), X[y == 1].mean(axis=0)))
+        return self
+
+    def predict(self, X):
+        d0 = ((X - self.centroids[0]) ** 2).sum(axis=1)
+        d1 = ((X - self.centroids[1]) ** 2).sum(axis=1)
+        return (d1 < d0).astype(np.float64)
+
+
+class PendingFit():
+    """Stands in for a classifier that is still being fitted in another process.
+
+    Until the fit is done the node routes with a nearest centroid model of the two playlists it was split on. Once it
+    is done `Tree` swaps the fitted classifier in. A failed fit keeps the centroid model for good.
+    """
+    def __init__(self, future, X, y):
+        self.future = future
+        self.fallback = CentroidModel().fit(X, y)
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        try:
+            return self.future.result()
+        except Exception as e:
+            print(f'Classifier fit failed, keeping nearest centroid routing: {e}')
+            return self.fallback
+
+    def predict(self, X):
+        return self.fallback.predict(X)
 
-    def is_leaf(self):
-        return self.left is None and self.right is None
 
 class Tree():
+    """Binary tree of classifiers with one playlist at every leaf.
+
+    Nodes are plain integer ids into parallel int32 arrays instead of linked objects:
+        left, right - child node ids, NO_NODE for a leaf
+        parent      - parent node id, NO_NODE for the head
+        slot        - index into `classifiers` for a classifier node, into `leaves` / `labels` for a leaf
+        leaf_count  - number of leaves under the node, 1 for a leaf
+        version     - bumped whenever the node's child links or classifier change, see `is_current`
+    Fitted classifiers and leaf feature matrices live in their own pools, the leaves in whatever form `leaf_policy`
+    keeps them (see treemodel.leaves). The arrays are `array.array`'s rather than numpy arrays, indexing them from
+    python hands back plain ints which is a lot cheaper than numpy scalars when walking the tree.
+
+    Changes only ever append new nodes and then link them in with one assignment, existing nodes are not rebuilt in place.
+    Read only methods (route, route_batch, query, recommend_many) therefore need no lock while a single writer changes
+    the tree, see treemodel.concurrency.TreeWriter.
+
+    Pushes keep `leaf_count` up to date on the way back up and, like a scapegoat tree, flag the highest subtree that is
+    more lopsided than `balance_alpha` whenever a new leaf lands deeper than log(size) / log(1 / balance_alpha).
+    Flagged subtrees are rebuilt as balanced bisections of their leaves (`rebalance`, or treemodel.balance.Rebalancer in
+    the background), which keeps the depth near log2(size) whatever order the playlists come in.
+    """
     def __init__(self, node_model, **kwargs):
         self.model = node_model
         self.model_args = kwargs
-        self.head = None
-    
+
+        self.left = array('i')
+        self.right = array('i')
+        self.parent = array('i')
+        self.slot = array('i')
+        self.leaf_count = array('i')
+        self.version = array('i')
+        self.head_version = 0 # version of the `head` link
+
+        self.classifiers = []
+        self.sides = [] # routing.side_summary of each classifier, None where there is none
+        self.leaves = []
+        self.labels = []
+        self.leaf_of = {} # label -> leaf node ids with that label, oldest first, see `update` and `remove`
+
+        self.leaf_policy = FullLeaves()
+        self.fast_path = None # margin threshold of centroid routing, None to always ask the classifiers
+        self.fast_routes = 0 # branch decisions made by centroid routing and by the classifier while it is on,
+        self.slow_routes = 0 # counted without a lock so concurrent queries may lose the odd count
+        self.kernels = None # classifier slot -> compiled predict kernel (None where there is none), see `use_kernels`
+        self.index = None # optional treemodel.ann.PlaylistIndex over the leaf centroids, see `use_index`
+        self.fit_executor = None
+        self.observer = None # optional observer(stage, seconds, depth=None), told about every branch decision and fit
+
+        self.head = NO_NODE
+        self.size = 0 # number of playlists (leaves) in the tree
+        self.generation = 0 # bumped on every change to the tree
+
+        self.balance_alpha = 0.6
+        self.unbalanced = set() # subtrees waiting to be rebuilt
+        self.retired = [] # (time, classifier slots, leaf slots) of nodes taken out by a rebuild, update or remove, see `reclaim`
+
+    def is_leaf(self, node):
+        return self.left[node] == NO_NODE and self.right[node] == NO_NODE
+
+    @property
+    def count(self):
+        # number of nodes, every node ever created keeps its id
+        return len(self.slot)
+
+    def _new_node(self, slot, left=NO_NODE, right=NO_NODE, parent=NO_NODE):
+        self.left.append(left)
+        self.right.append(right)
+        self.parent.append(parent)
+        self.slot.append(slot)
+        self.leaf_count.append(1 if left == NO_NODE else self.leaf_count[left] + self.leaf_count[right])
+        self.version.append(0)
+        return len(self.slot) - 1
+
+    def _changed(self, node):
+        # after relinking the children of `node` (the head link for NO_NODE) or swapping its classifier, never before:
+        # a reader that saw the old links has also read the old version, see `is_current`
+        if node == NO_NODE:
+            self.head_version += 1
+        else:
+            self.version[node] += 1
+
+    def is_current(self, seen):
+        """Whether the nodes a `route` or `query` recorded in `seen` are unchanged, so it would still give the same answer.
+
+        A reader records the version of every node before reading its links or classifier and the writer bumps a
+        version only after changing them, so a change that happens while the answer is worked out is never missed.
+        Changes elsewhere in the tree leave `seen` current.
+        """
+        version = self.version
+        for node, v in seen:
+            if (self.head_version if node == NO_NODE else version[node]) != v:
+                return False
+        return True
+
+    def add_leaf(self, data, label):
+        node = self.add_kept_leaf(self.leaf_policy.keep(data), label)
+        if self.index is not None:
+            self.index.add(np.asarray(data, dtype=np.float64).mean(axis=0), label)
+        return node
+
+    def add_kept_leaf(self, stored, label):
+        """Adds a leaf from data already in the form `leaf_policy` keeps, e.g. a leaf of another tree. Not indexed."""
+        node = self._new_node(len(self.leaves))
+        self.leaves.append(stored)
+        self.labels.append(label)
+        self.leaf_of.setdefault(label, []).append(node)
+        return node
+
+    def index_labels(self):
+        """Rebuilds `leaf_of` from the leaves reachable from the head, e.g. after loading a snapshot."""
+        self.leaf_of = {}
+        if self.head != NO_NODE:
+            # node ids only grow, so the leaves of a label stay oldest first
+            for leaf in sorted(self.subtree_leaves(self.head)):
+                self.leaf_of.setdefault(self.leaf_label(leaf), []).append(leaf)
+
+    def _forget_leaf(self, leaf):
+        label = self.leaf_label(leaf)
+        leaves = self.leaf_of.get(label)
+        if leaves is not None and leaf in leaves:
+            leaves.remove(leaf)
+            if not leaves:
+                del self.leaf_of[label]
+
+    def add_classifier(self, classifier, left, right, parent=NO_NODE, sides=None):
+        node = self._new_node(len(self.classifiers), left, right, parent)
+        self.classifiers.append(classifier)
+        self.sides.append(sides)
+        self.parent[left] = node
+        self.parent[right] = node
+        return node
+
+    def leaf_data(self, node):
+        return self.leaves[self.slot[node]]
+
+    def leaf_label(self, node):
+        return self.labels[self.slot[node]]
+
+    def leaf_rows(self, node, limit=None):
+        """Track rows of a leaf's playlist to fit a split on, see treemodel.leaves."""
+        return self.leaf_policy.rows(self.leaf_data(node), limit)
+
+    def use_index(self, index):
+        """Keeps a nearest neighbour index (treemodel.ann.PlaylistIndex) of every playlist's mean track up to date.
+
+        The playlists already in the tree are added first. None stops updating it.
+        """
+        if index is not None and self.head != NO_NODE:
+            for leaf in self.subtree_leaves(self.head):
+                index.add(self.leaf_policy.centroid(self.leaf_data(leaf)), self.leaf_label(leaf))
+        self.index = index
+
+    def similar(self, data, k=10):
+        """The `k` playlists whose mean track is closest to the playlist's, from the index.
+
+        Returns:
+            list: (label, squared distance) pairs, closest first.
+        """
+        if self.index is None:
+            raise ValueError('The tree has no playlist index, see Tree.use_index.')
+        return self.index.search(np.asarray(data, dtype=np.float64).mean(axis=0), k)
+
+    def use_leaf_policy(self, policy):
+        """Sets what leaves keep of their playlist (a policy from treemodel.leaves), before any playlist is added."""
+        if self.leaves:
+            raise ValueError('The leaf policy can only be changed on an empty tree.')
+        self.leaf_policy = policy
+
+    def classifier(self, node):
+        """Classifier of a node, swapping in a finished background fit if there is one."""
+        slot = self.slot[node]
+        classifier = self.classifiers[slot]
+        if isinstance(classifier, PendingFit) and classifier.done():
+            classifier = classifier.result()
+            self.classifiers[slot] = classifier # same result whichever thread gets here first
+            self._changed(node)
+        return classifier
+
+    def use_kernels(self, enabled=True):
+        """Routes with NumPy kernels compiled from the fitted classifiers instead of their `predict` (see treemodel.kernels).
+
+        Each classifier is compiled the first time it routes a playlist. Kernels give bit for bit the same predictions,
+        classifiers without one keep using `predict`.
+        """
+        self.kernels = {} if enabled else None
+
+    def predictor(self, node):
+        """What routes at a classifier node: its compiled kernel if kernels are on and it has one, else the classifier."""
+        classifier = self.classifier(node)
+        kernels = self.kernels
+        if kernels is None or isinstance(classifier, PendingFit):
+            return classifier
+
+        kernel = kernels.get(self.slot[node], False)
+        if kernel is False:
+            kernel = kernels[self.slot[node]] = compile_classifier(classifier)
+        return kernel if kernel is not None else classifier
+
+    def use_fit_executor(self, executor):
+        """Fits new classifiers in `executor` (e.g. a ProcessPoolExecutor) instead of inside `push`.
+
+        New classifier nodes route with a nearest centroid model until their fit comes back. None goes back to fitting inline.
+        """
+        self.fit_executor = executor
+
+    def wait_for_fits(self):
+        """Blocks until every background fit is done and swapped in."""
+        pending = {slot for slot, classifier in enumerate(self.classifiers) if isinstance(classifier, PendingFit)}
+        if not pending:
+            return
+        left, slots = self.left, self.slot
+        for node in range(self.count):
+            if left[node] != NO_NODE and slots[node] in pending:
+                self.classifiers[slots[node]].result()
+                # through `classifier` so the node's version moves on, answers routed by the centroid fallback are stale
+                self.classifier(node)
+
+    def use_fast_path(self, threshold):
+        """Routes by centroids where the margin is clear and only asks the classifier where it isn't.
+
+        Every classifier node keeps the centroid and spread of both sides of its split. A playlist whose mean track is
+        far enough towards one side (margin of at least `threshold`, see treemodel.routing.fast_votes) goes that way
+        without a `predict` over all its tracks. None turns it off.
+        """
+        self.fast_path = threshold
+
+    def _fast_votes(self, node, means):
+        # None for a node without side summary, e.g. one restored from an older snapshot
+        sides = self.sides[self.slot[node]]
+        if sides is None:
+            self.slow_routes += len(means)
+            return None
+        votes = fast_votes(sides, means, self.fast_path)
+        slow = int(np.isnan(votes).sum())
+        self.fast_routes += len(means) - slow
+        self.slow_routes += slow
+        return votes
+
+    def branch(self, node, data, depth=None):
+        """Average vote of a classifier node over the tracks of a playlist, below 0.5 goes left."""
+        if self.fast_path is not None:
+            votes = self._fast_votes(node, data.mean(axis=0, keepdims=True))
+            if votes is not None and not np.isnan(votes[0]):
+                return votes[0]
+
+        if self.observer is not None and depth is not None:
+            start = time.perf_counter()
+            vote = np.average(self.predictor(node).predict(data))
+            self.observer('branch', time.perf_counter() - start, depth)
+            return vote
+        return np.average(self.predictor(node).predict(data))
+
+    def branch_batch(self, node, datas, depth=None):
+        """Average vote of a classifier node for each of several playlists, using a single `predict` over all of their tracks."""
+        if len(datas) == 1:
+            return np.array([self.branch(node, datas[0], depth)])
+
+        if self.fast_path is not None:
+            votes = self._fast_votes(node, np.stack([d.mean(axis=0) for d in datas]))
+            if votes is not None:
+                slow = np.flatnonzero(np.isnan(votes))
+                if len(slow):
+                    votes[slow] = self._predict_batch(node, [datas[i] for i in slow], depth)
+                return votes
+        return self._predict_batch(node, datas, depth)
+
+    def _predict_batch(self, node, datas, depth):
+        counts = np.array([d.shape[0] for d in datas])
+        if np.any(counts == 0):
+            raise ValueError('Cannot route a playlist without tracks.')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+        start = time.perf_counter()
+        votes = self.predictor(node).predict(np.concatenate(datas))
+        if self.observer is not None and depth is not None:
+            self.observer('branch', time.perf_counter() - start, depth)
+        return np.add.reduceat(votes, starts) / counts
+
+    def route(self, data, seen=None):
+        """Follows a playlist down to a leaf without changing the tree.
+
+        Args:
+            data (numpy.ndarray): Feature matrix of the playlist.
+            seen (list, optional): Gets a (node, version) pair for every node the answer depends on, see `is_current`.
+
+        Returns:
+            int: Node id of the leaf, NO_NODE for an empty tree.
+        """
+        if seen is not None:
+            seen.append((NO_NODE, self.head_version))
+        current = self.head
+        if current == NO_NODE:
+            return NO_NODE
+
+        left, right, version = self.left, self.right, self.version
+        depth = 0
+        while left[current] != NO_NODE:
+            if seen is not None:
+                seen.append((current, version[current]))
+            current = left[current] if self.branch(current, data, depth) < 0.5 else right[current]
+            depth += 1
+        if seen is not None:
+            seen.append((current, version[current]))
+        return current
+
+    def route_batch(self, datas):
+        """Follows many playlists down to their leaves at once, without changing the tree.
+
+        Playlists that reach the same classifier node are routed together with one `predict` call on all of their tracks,
+        then split into the two branches by their own average vote. The leaves are the same as calling `route` on each.
+
+        Args:
+            datas (list): Feature matrices, one per playlist.
+
+        Returns:
+            list: Leaf node id for each playlist, NO_NODE for an empty tree.
+        """
+        leaves = [NO_NODE] * len(datas)
+        if self.head == NO_NODE or not datas:
+            return leaves
+
+        left, right = self.left, self.right
+        stack = [(self.head, list(range(len(datas))), 0)]
+        while stack:
+            node, group, depth = stack.pop()
+
+            if left[node] == NO_NODE:
+                for i in group:
+                    leaves[i] = node
+                continue
+
+            branches = self.branch_batch(node, [datas[i] for i in group], depth)
+            go_left = [i for i, b in zip(group, branches) if b < 0.5]
+            go_right = [i for i, b in zip(group, branches) if not b < 0.5]
+            if go_left:
+                stack.append((left[node], go_left, depth + 1))
+            if go_right:
+                stack.append((right[node], go_right, depth + 1))
+
+        return leaves
+
+    def recommend_many(self, datas):
+        """Recommended playlist for each of several playlists, the label of the leaf each one lands on.
+
+        Same answer as `push(data, label, ret=True)` would give for each playlist, but nothing is inserted into the tree.
+
+        Args:
+            datas (list): Feature matrices, one per playlist.
+
+        Returns:
+            list: Leaf label for each playlist, None for an empty tree.
+        """
+        return [self.leaf_label(node) if node != NO_NODE else None for node in self.route_batch(datas)]
+
+    def query(self, data, k=1, seen=None):
+        """Recommended playlists for a playlist, without changing the tree.
+
+        Only runs `predict` down the tree, nothing is fitted or inserted, so queries can run alongside each other.
+        The first label is the leaf the playlist lands on, what `push(data, label, ret=True)` would return. Further
+        labels come from walking back up the path and descending into each sibling subtree, preferred branch first.
+
+        Args:
+            data (numpy.ndarray): Feature matrix of the playlist.
+            k (int, optional): Number of playlists to return. Defaults to 1.
+            seen (list, optional): Gets a (node, version) pair for every node the answer depends on, see `is_current`.
+
+        Returns:
+            list: Up to `k` leaf labels, closest first. Empty for an empty tree.
+        """
+        leaf = self.route(data, seen)
+        if leaf == NO_NODE:
+            return []
+
+        labels = [self.leaf_label(leaf)]
+        left, right, parent, version = self.left, self.right, self.parent, self.version
+
+        node = leaf
+        while len(labels) < k and parent[node] != NO_NODE:
+            up = parent[node]
+            sibling = right[up] if left[up] == node else left[up]
+
+            # depth first through the sibling subtree, following the classifiers' preference
+            stack = [sibling]
+            while stack and len(labels) < k:
+                current = stack.pop()
+                if seen is not None:
+                    seen.append((current, version[current]))
+                if left[current] == NO_NODE:
+                    labels.append(self.leaf_label(current))
+                elif self.branch(current, data) < 0.5:
+                    stack += [right[current], left[current]]
+                else:
+                    stack += [left[current], right[current]]
+
+            node = up
+
+        return labels
+
     def push(self, data, label, ret=False):
-        if self.head is None:
-            self.head = TreeNode(elem=data, label=label)
+        self.size += 1
+        self.generation += 1
+
+        if self.head == NO_NODE:
+            self.head = self.add_leaf(data, label)
+            self._changed(NO_NODE)
             return None
-        
+
         current = self.head
         parent_branch = -1
 
-        while not current.is_leaf():
+        left, right = self.left, self.right
+        depth = 0
+        while left[current] != NO_NODE:
 
-            branch = np.average(current.elem.predict(data))
+            branch = self.branch(current, data, depth)
+            depth += 1
 
             if branch < 0.5:
-                current = current.left
+                current = left[current]
                 parent_branch = 0
             else:
-                current = current.right
+                current = right[current]
                 parent_branch = 1
 
         # since we've hit a leaf node we have a recommended playlist
-        # need to create a new classifier to distinguish between the 
-        new_classifier = self.model(**self.model_args)
-
+        # need to create a new classifier to distinguish between the
         # format data to be classified
+        current_data = self.leaf_rows(current, data.shape[0])
 
         # attempt to fix class imbalances
         # take a random sample from the larger class so that the sample size is the same size as smaller class
 
         # determine which playlist to sample
-        small, sample = ((current.elem , 'l'), (data, 'r')) if current.elem.shape[0] < data.shape[0] else ((data, 'r'), (current.elem, 'l'))
+        small, sample = ((current_data , 'l'), (data, 'r')) if current_data.shape[0] < data.shape[0] else ((data, 'r'), (current_data, 'l'))
         N = small[0].shape[0]
         # only sample if they are not the same size
         sample = (sample[0][np.random.choice(a=sample[0].shape[0], size=N, replace=False), :], sample[1]) if N != sample[0].shape[0] else sample
 
         # determine order to concatenate based on if it should be the right or left node
         # this way we can put the correct full size playlist dataset with the correct node and not continually truncate data
-        # in this case, the left branch data (from current.elem) always goes first and is associated with '0' in y array
+        # in this case, the left branch data (from the current leaf) always goes first and is associated with '0' in y array
         x_concat = (small[0], sample[0]) if small[1] == 'l' else (sample[0], small[0])
 
         X = np.concatenate(x_concat)
         y = np.concatenate((np.zeros(N), np.ones(N)))
 
-        # train new classifier
-        new_classifier.fit(X, y)
-
-        # create new nodes for the tree
-        classifier_node = TreeNode(elem=new_classifier, label=None)
-        new_playlist_node = TreeNode(elem=data, label=label)
+        # train new classifier, in the background if there is an executor for it
+        if self.fit_executor is not None:
+            new_classifier = PendingFit(self.fit_executor.submit(fit_classifier, self.model, self.model_args, X, y), X, y)
+        else:
+            new_classifier = self.model(**self.model_args)
+            start = time.perf_counter()
+            new_classifier.fit(X, y)
+            if self.observer is not None:
+                self.observer('fit', time.perf_counter() - start)
 
-        # set the classifier nodes branches to is respective classification
-        classifier_node.left = current
-        classifier_node.right = new_playlist_node
+        # create new nodes for the tree, the current leaf goes left and the new playlist right
+        # the new classifier node gets the current node's parent
+        parent = self.parent[current]
+        new_playlist_node = self.add_leaf(data, label)
+        classifier_node = self.add_classifier(new_classifier, current, new_playlist_node, parent, side_summary(X, y))
 
         # update the parent classifier node's correct branch
-        # also update the new classifiers parent node to be the current node's parent
+        # this single assignment is what makes the new nodes reachable, so anything walking the tree at the same
+        # time (see Tree.query) sees it either from before or after the push, never half way through
         if parent_branch == 0:
-            current.parent.left = classifier_node
-            classifier_node.parent = current.parent
+            self.left[parent] = classifier_node
         elif parent_branch == 1:
-            current.parent.right = classifier_node
-            classifier_node.parent = current.parent
+            self.right[parent] = classifier_node
         else:
             self.head = classifier_node # no parent, which means it is the head
+        self._changed(parent)
 
-        # update parent of the data nodes
-        current.parent = classifier_node
-        new_playlist_node.parent = classifier_node
+        self._grew(classifier_node, depth + 1)
 
         # if the return flag is set, return recommended playlist name
 
-        return current.label if ret else None
-        
\ No newline at end of file
+        return self.leaf_label(current) if ret else None
+
+    def _grew(self, node, depth):
+        # one more leaf under every ancestor of `node`, which has just been linked in above a new leaf at `depth`
+        parent, counts = self.parent, self.leaf_count
+        up = parent[node]
+        while up != NO_NODE:
+            counts[up] += 1
+            up = parent[up]
+
+        if self.size < 4 or depth <= math.log(self.size) / math.log(1 / self.balance_alpha) + 1:
+            return
+
+        # too deep, the highest lopsided subtree on the path gets rebuilt
+        self._flag_scapegoat(node)
+
+    def _flag_scapegoat(self, node):
+        # flags the highest subtree from classifier node `node` up to the head with one side over `balance_alpha` of its leaves
+        left, right, parent, counts = self.left, self.right, self.parent, self.leaf_count
+        scapegoat = NO_NODE
+        up = node
+        while up != NO_NODE:
+            if max(counts[left[up]], counts[right[up]]) > self.balance_alpha * counts[up]:
+                scapegoat = up
+            up = parent[up]
+        if scapegoat != NO_NODE:
+            self.unbalanced.add(scapegoat)
+
+    def subtree_leaves(self, node):
+        """Leaf node ids under `node`, left to right."""
+        left, right = self.left, self.right
+        leaves = []
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if left[current] == NO_NODE:
+                leaves.append(current)
+            else:
+                stack += [right[current], left[current]]
+        return leaves
+
+    def is_attached(self, node):
+        """True if `node` can still be reached from the head."""
+        left, right, parent = self.left, self.right, self.parent
+        while parent[node] != NO_NODE:
+            up = parent[node]
+            if left[up] != node and right[up] != node:
+                return False
+            node = up
+        return node == self.head
+
+    def take_unbalanced(self):
+        """Takes the largest subtree flagged as unbalanced that is still in the tree.
+
+        Returns:
+            int: Node id of the subtree, NO_NODE if there is none.
+        """
+        while self.unbalanced:
+            node = max(self.unbalanced, key=self.leaf_count.__getitem__)
+            self.unbalanced.discard(node)
+            if self.is_attached(node):
+                return node
+        return NO_NODE
+
+    def plan_rebuild(self, node, seed=None, max_rows=balance.MAX_SPLIT_ROWS):
+        """Fits a balanced replacement for the subtree under `node`, without changing the tree.
+
+        Only reads the tree, so it can run outside the writer while pushes carry on. See `apply_rebuild`.
+
+        Args:
+            node (int): Root of the subtree.
+            seed (int, optional): Seed for the training row samples.
+            max_rows (int, optional): Max training rows per side of a split. Defaults to treemodel.balance.MAX_SPLIT_ROWS.
+
+        Returns:
+            tuple: (node count when planned, plan from treemodel.balance.plan_subtree over the leaf node ids)
+        """
+        mark = self.count
+        leaves = self.subtree_leaves(node)
+        if len(leaves) < 2:
+            return mark, None
+        plan = balance.plan_subtree(self.model, self.model_args, [self.leaf_rows(l) for l in leaves], leaves, seed, max_rows)
+        return mark, plan
+
+    def apply_rebuild(self, node, planned):
+        """Swaps the balanced subtree from `plan_rebuild` in for the subtree under `node`.
+
+        A leaf that has been split by a push since the plan was made comes along with everything that grew out of it
+        (nodes made after the plan have ids of at least its mark). If the subtree changed in any other way the plan is
+        stale and nothing happens. The new subtree is published with a single link assignment, like a push.
+
+        Returns:
+            bool: True if the subtree was replaced.
+        """
+        mark, plan = planned
+        if plan is None or not self.is_attached(node):
+            return False
+
+        left, right, parent = self.left, self.right, self.parent
+
+        # planned leaf -> top of what grew out of it since
+        def grown(leaf):
+            while parent[leaf] >= mark:
+                leaf = parent[leaf]
+            return leaf
+
+        tops = {}
+        stack = [plan]
+        while stack:
+            p = stack.pop()
+            if isinstance(p, tuple):
+                stack += [p[1], p[2]]
+            else:
+                top = grown(p)
+                if top in tops:
+                    return False # split while the plan was being made
+                tops[top] = p
+
+        # the current subtree must be exactly those tops plus the classifier nodes above them
+        old_classifiers = []
+        reached = 0
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current in tops:
+                reached += 1
+            elif left[current] == NO_NODE:
+                return False
+            else:
+                old_classifiers.append(current)
+                stack += [left[current], right[current]]
+        if reached != len(tops):
+            return False
+
+        top_of = {leaf: top for top, leaf in tops.items()}
+        relink = []
+        root = self.add_plan(plan, top_of.__getitem__, relink)
+        up = parent[node]
+        parent[root] = up
+
+        # publish
+        if up == NO_NODE:
+            self.head = root
+        elif left[up] == node:
+            left[up] = root
+        else:
+            right[up] = root
+
+        for child, new in relink:
+            parent[child] = new
+        self._changed(up)
+
+        # what grew while the plan was being made is not balanced yet
+        counts = self.leaf_count
+        for top in tops:
+            if top >= mark and max(counts[left[top]], counts[right[top]]) > self.balance_alpha * counts[top]:
+                self.unbalanced.add(top)
+
+        self.retired.append((time.monotonic(), [self.slot[c] for c in old_classifiers], []))
+        self.generation += 1
+        return True
+
+    def add_plan(self, plan, node_of=None, relink=None):
+        """Adds the classifier nodes of a plan from treemodel.balance.plan_subtree, bottom up.
+
+        The new nodes are not linked into the tree, the caller does that with the returned root.
+
+        Args:
+            plan: Plan whose leaves stand for existing nodes.
+            node_of (callable, optional): Maps a plan leaf to its node id. Defaults to the plan leaf itself.
+            relink (list, optional): Collects (existing node, new parent) pairs instead of setting them, for when the
+                existing nodes are still reachable and must keep their old parent until the new subtree is published.
+
+        Returns:
+            int: Root node id of the new subtree.
+        """
+        parent = self.parent
+
+        def build(p):
+            if not isinstance(p, tuple):
+                return node_of(p) if node_of is not None else p
+            classifier, l, r, sides = p
+            l, r = build(l), build(r)
+            new = self._new_node(len(self.classifiers), l, r)
+            self.classifiers.append(classifier)
+            self.sides.append(sides)
+            for child in (l, r):
+                if relink is None or child in built:
+                    parent[child] = new # built just now, not reachable yet
+                else:
+                    relink.append((child, new))
+            built.add(new)
+            return new
+
+        built = set()
+        return build(plan)
+
+    def bulk_load(self, datas, labels, seed=None, max_rows=balance.MAX_SPLIT_ROWS, executor=None, tasks=1):
+        """Builds a tree of close to even depth from all of its playlists at once, instead of one push at a time.
+
+        Only for an empty tree. See treemodel.balance.plan_subtree for the arguments.
+        """
+        if self.head != NO_NODE:
+            raise ValueError('bulk_load needs an empty tree.')
+        if not datas:
+            return
+
+        leaves = [self.add_leaf(data, label) for data, label in zip(datas, labels)]
+        if len(leaves) == 1:
+            self.head = leaves[0]
+        else:
+            plan = balance.plan_subtree(self.model, self.model_args, datas, leaves, seed, max_rows, executor, tasks)
+            self.head = self.add_plan(plan)
+        self._changed(NO_NODE)
+        self.size = len(leaves)
+        self.generation += len(leaves)
+
+    def extract(self, node, stubs=None):
+        """A new tree holding the subtree under `node`, sharing its classifiers and stored leaves.
+
+        Args:
+            node (int): Top of the subtree.
+            stubs (dict, optional): Node id -> label of subtrees to leave out, each becomes a leaf with that label and
+                no tracks. E.g. the top levels of a tree with a stub for every subtree kept somewhere else.
+
+        Returns:
+            Tree: The copy, with the same node model and leaf policy.
+        """
+        tree = Tree(self.model, **self.model_args)
+        tree.leaf_policy = self.leaf_policy
+
+        def plan(n):
+            if stubs is not None and n in stubs:
+                return tree.add_kept_leaf(np.zeros((0, 0)), stubs[n])
+            if self.is_leaf(n):
+                return tree.add_kept_leaf(self.leaf_data(n), self.leaf_label(n))
+            return (self.classifier(n), plan(self.left[n]), plan(self.right[n]), self.sides[self.slot[n]])
+
+        tree.head = tree.add_plan(plan(node))
+        tree.size = len(tree.labels)
+        tree.generation = tree.size
+        return tree
+
+    def replace(self, node, new):
+        """Links the subtree `new` (built with add_* and not linked yet) into the tree in place of `node`."""
+        kept = set(self.subtree_leaves(new))
+        for leaf in self.subtree_leaves(node):
+            if leaf not in kept:
+                self._forget_leaf(leaf)
+
+        up = self.parent[node]
+        self.parent[new] = up
+        if up == NO_NODE:
+            self.head = new
+        elif self.left[up] == node:
+            self.left[up] = new
+        else:
+            self.right[up] = new
+        self._changed(up)
+
+        up = self.parent[new]
+        while up != NO_NODE:
+            self.leaf_count[up] = self.leaf_count[self.left[up]] + self.leaf_count[self.right[up]]
+            up = self.parent[up]
+        self.size += self.leaf_count[new] - self.leaf_count[node]
+        self.generation += 1
+
+    def update(self, label, data):
+        """Replaces the tracks of a playlist, instead of pushing it again as a second leaf.
+
+        A label pushed more than once ends up as a single leaf with the new tracks. Every classifier was fitted on just
+        two playlists, the leaf a push split and the pushed one, and the leaves below it are wherever its fit sends
+        them. Refitting the classifiers on the playlist's path in place would move those leaves too, so the playlist is
+        taken out like `remove` does and its new tracks are pushed, which fits one classifier where they land now. A
+        query in between doesn't find the playlist.
+
+        Returns:
+            bool: False if no playlist has that label.
+        """
+        if not self.remove(label):
+            return False
+        self.push(data, label)
+        return True
+
+    def remove(self, label):
+        """Takes a playlist out of the tree, every leaf of it if its label was pushed more than once.
+
+        The parent classifier of a leaf, which only told it apart from the sibling subtree, goes with it and the sibling
+        takes the parent's place with a single link assignment. If the parent was flagged for a rebuild the flag moves
+        to the highest lopsided subtree above the sibling, taking the leaf out may have left it lopsided as well.
+
+        Returns:
+            bool: False if no playlist has that label.
+        """
+        leaves = self.leaf_of.pop(label, None)
+        if not leaves:
+            return False
+
+        if self.index is not None:
+            self.index.remove(label)
+        for leaf in reversed(leaves):
+            self._remove_leaf(leaf)
+        return True
+
+    def _remove_leaf(self, leaf):
+        left, right, parent, counts = self.left, self.right, self.parent, self.leaf_count
+        up = parent[leaf]
+        if up == NO_NODE:
+            self.head = NO_NODE
+            self._changed(NO_NODE)
+            old_classifiers = []
+        else:
+            sibling = right[up] if left[up] == leaf else left[up]
+            top = parent[up]
+            if top == NO_NODE:
+                self.head = sibling
+            elif left[top] == up:
+                left[top] = sibling
+            else:
+                right[top] = sibling
+            # only once published, a query walking back up from the sibling meanwhile still finds it under `up`
+            parent[sibling] = top
+            self._changed(top)
+
+            node = top
+            while node != NO_NODE:
+                counts[node] -= 1
+                node = parent[node]
+            if up in self.unbalanced:
+                self.unbalanced.discard(up)
+                self._flag_scapegoat(top if self.is_leaf(sibling) else sibling)
+            old_classifiers = [self.slot[up]]
+
+        self.retired.append((time.monotonic(), old_classifiers, [self.slot[leaf]]))
+        self.size -= 1
+        self.generation += 1
+
+    def rebalance(self, seed=None, max_rows=balance.MAX_SPLIT_ROWS):
+        """Rebuilds every subtree flagged as unbalanced, right here in the caller's thread.
+
+        Returns:
+            int: Number of subtrees rebuilt.
+        """
+        rebuilt = 0
+        node = self.take_unbalanced()
+        while node != NO_NODE:
+            rebuilt += self.apply_rebuild(node, self.plan_rebuild(node, seed, max_rows))
+            node = self.take_unbalanced()
+        return rebuilt
+
+    def reclaim(self, grace=60.0):
+        """Drops the classifiers and leaf data of nodes taken out by a rebuild, update or remove at least `grace` seconds ago.
+
+        Queries don't lock, one that was already walking a subtree when it got replaced may still be in it for a moment,
+        so its classifiers are only let go after a grace period. The node ids themselves are never reused, and a dropped
+        leaf keeps its label and an empty matrix.
+
+        Returns:
+            int: Number of classifiers dropped.
+        """
+        cutoff = time.monotonic() - grace
+        dropped = 0
+        while self.retired and self.retired[0][0] <= cutoff:
+            _, classifier_slots, leaf_slots = self.retired.pop(0)
+            for slot in classifier_slots:
+                self.classifiers[slot] = None
+                self.sides[slot] = None
+                if self.kernels is not None:
+                    self.kernels.pop(slot, None)
+                dropped += 1
+            for slot in leaf_slots:
+                self.leaves[slot] = self.leaves[slot][:0]
+        return dropped